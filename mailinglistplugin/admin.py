@@ -1,17 +1,119 @@
 from trac.core import Component, implements, TracError
 from trac.util.compat import partial
 from trac.web.chrome import ITemplateProvider, add_stylesheet, add_script
-from trac.admin.api import IAdminPanelProvider
+from trac.admin.api import IAdminPanelProvider, IAdminCommandProvider
 from trac.web.chrome import Chrome, add_notice, add_warning
 from trac.util.translation import _
+from trac.util.text import printout
 from trac.resource import ResourceNotFound
 from mailinglistplugin.api import MailinglistSystem
+from mailinglistplugin.directory import MailinglistMembership
+from mailinglistplugin.search import MailinglistSearchIndex
+from mailinglistplugin.storage import FileRawStorage
 from mailinglistplugin.model import Mailinglist, MailinglistConversation, MailinglistMessage
 
 class MailinglistAdmin(Component):
 
-    implements(ITemplateProvider, IAdminPanelProvider)
+    implements(ITemplateProvider, IAdminPanelProvider, IAdminCommandProvider)
 
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('mailinglist rebuild-counters', '[list]',
+               """Recompute the stored message counts and last activity
+
+               Rebuilds the counters of the given mailinglist, or of every
+               mailinglist if none is given.""",
+               self._complete_list, self._do_rebuild_counters)
+        yield ('mailinglist sync-members', '',
+               """Bring the effective list membership up to date
+
+               Needed after changing groups or permissions with trac-admin,
+               as only changes made in the web admin are picked up.""",
+               None, self._do_sync_members)
+        yield ('mailinglist rebuild-index', '',
+               """Rebuild the full text search index of the archived messages""",
+               None, self._do_rebuild_index)
+        yield ('mailinglist migrate-raw', '<storage>',
+               """Move the stored raw messages to another storage
+
+               Moves every raw message not yet in the given storage, such
+               as `DatabaseRawStorage` or `FileRawStorage`, a batch at a
+               time. Set `[mailinglist] raw_storage` to the same storage
+               for new messages to be stored there too.""",
+               self._complete_raw_storage, self._do_migrate_raw)
+        yield ('mailinglist sweep-raw', '',
+               """Remove the raw message files no message uses
+
+               Only files stored longer ago than `[mailinglist]
+               raw_storage_sweep_age` seconds are removed, as are files
+               left by `migrate-raw` to another storage.""",
+               None, self._do_sweep_raw)
+
+    def _complete_list(self, args):
+        if len(args) == 1:
+            return [m.emailaddress for m in Mailinglist.select(self.env)]
+
+    def _complete_raw_storage(self, args):
+        if len(args) == 1:
+            return [storage.__class__.__name__
+                    for storage in MailinglistSystem(self.env).raw_storages]
+
+    def _do_rebuild_counters(self, emailaddress=None):
+        @self.env.with_transaction()
+        def do_rebuild(db):
+            if emailaddress:
+                mailinglists = [Mailinglist.select_by_address(self.env, emailaddress,
+                                                              localpart=True, db=db)]
+            else:
+                mailinglists = list(Mailinglist.select(self.env, db=db))
+            for mailinglist in mailinglists:
+                mailinglist.rebuild_counters(db=db)
+                printout(_("Rebuilt counters for %(name)s",
+                           name=mailinglist.emailaddress))
+
+    def _do_sync_members(self):
+        changed = MailinglistMembership(self.env).update_members()
+        printout(_("Updated %(num)s membership entries", num=changed))
+
+    def _do_rebuild_index(self):
+        if MailinglistSearchIndex(self.env).rebuild():
+            printout(_("Rebuilt the search index"))
+        else:
+            printout(_("Full text search is not available for this database"))
+
+    def _do_migrate_raw(self, name):
+        system = MailinglistSystem(self.env)
+        target = system.get_raw_storage(name)
+        name = target.__class__.__name__
+        moved = 0
+        while True:
+            replaced = []
+            @self.env.with_transaction()
+            def do_migrate(db):
+                cursor = db.cursor()
+                cursor.execute("SELECT id, storage, location FROM mailinglistraw "
+                               "WHERE coalesce(storage, 'DatabaseRawStorage') != %s "
+                               "ORDER BY id LIMIT 100", (name,))
+                for id, storage, location in cursor.fetchall():
+                    data = system.get_raw_storage(storage).read(id, location, db=db)
+                    new_location = target.store(id, str(data), db)
+                    cursor.execute("UPDATE mailinglistraw SET storage = %s, location = %s "
+                                   "WHERE id = %s", (name, new_location, id))
+                    replaced.append((id, storage, location))
+            if not replaced:
+                break
+            # only once the rows point to the new copies
+            @self.env.with_transaction()
+            def do_remove(db):
+                for id, storage, location in replaced:
+                    system.get_raw_storage(storage).remove(id, location, db)
+            moved += len(replaced)
+        printout(_("Moved %(num)s raw messages to %(storage)s", num=moved, storage=name))
+
+    def _do_sweep_raw(self):
+        removed = FileRawStorage(self.env).sweep()
+        printout(_("Removed %(num)s unused raw message files", num=removed))
 
     # IAdminPanelProvider methods
     
@@ -32,6 +134,7 @@ class MailinglistAdmin(Component):
                     mailinglist.private = req.args.get('private') == 'PRIVATE'
                     mailinglist.postperm = req.args.get('postperm')
                     mailinglist.replyto = req.args.get('replyto')
+                    mailinglist.skip_duplicates = bool(req.args.get('skip_duplicates'))
                     mailinglist.description = req.args.get('description')
                     if 'TRAC_ADMIN' in req.perm:
                         mailinglist.emailaddress = req.args.get('emailaddress')
@@ -15,8 +15,11 @@ from trac.db import Table, Column, Index
 from trac.db import DatabaseManager
 from trac.env import IEnvironmentSetupParticipant
 from trac.util.datefmt import from_utimestamp, to_utimestamp, utc, utcmax, format_datetime
-from trac.config import BoolOption, Option
+from trac.config import BoolOption, IntOption, Option, ChoiceOption
 from trac.resource import IResourceManager, ResourceNotFound
+from trac.attachment import IAttachmentChangeListener
+from trac.util.translation import _
+import copy
 import email
 from utils import decode_header
 from announcer.api import AnnouncementSystem, IAnnouncementProducer, \
@@ -33,7 +36,9 @@ class IMailinglistChangeListener(Interface):
         """Called when a mailinglist is modified."""
 
     def mailinglist_deleted(mailinglist):
-        """Called when a mailinglist is deleted."""
+        """Called when a mailinglist is deleted. Its `deleted_messages`
+        are the `(id, date)` of the messages deleted with it, the date a
+        timestamp."""
 
 class IMailinglistConversationChangeListener(Interface):
     """Extension point interface for components that require notification
@@ -46,7 +51,9 @@ class IMailinglistConversationChangeListener(Interface):
         """Called when a mailinglistconversation is modified."""
 
     def mailinglistconversation_deleted(mailinglistconversation):
-        """Called when a mailinglistconversation is deleted."""
+        """Called when a mailinglistconversation is deleted. Its
+        `deleted_messages` are the `(id, date)` of the messages deleted
+        with it, the date a timestamp."""
 
 class IMailinglistMessageChangeListener(Interface):
     """Extension point interface for components that require notification
@@ -56,25 +63,92 @@ class IMailinglistMessageChangeListener(Interface):
         """Called when a mailinglistmessage is created."""
 
     def mailinglistmessage_changed(mailinglistmessage):
-        """Called when a mailinglistmessage is modified."""
+        """Called when a mailinglistmessage is modified. Its `old_values`
+        are the `list` id and `date` timestamp it had before."""
 
     def mailinglistmessage_deleted(mailinglistmessage):
         """Called when a mailinglistmessage is deleted."""
 
+class IMailinglistRawStorage(Interface):
+    """Keeps the stored bytes of received messages.
+
+    The `mailinglistraw` row of a message names the storage its bytes
+    are in and the location the storage gave them."""
+
+    def store(id, data, db):
+        """Store `data` for the raw message with `id` and return its
+        location."""
+
+    def read(id, location, offset=0, length=None, db=None):
+        """Return `length` bytes, or all that follow, from `offset` of the
+        data at `location`."""
+
+    def remove(id, location, db):
+        """Remove the data of the raw message with `id` from `location`,
+        as part of the transaction of `db`. Storages that can not undo a
+        removal leave it for later."""
+
+# Trac has no portable binary column type; 'blob' is SQLite's
+_binary_types = {'postgres': 'bytea',
+                 'mysql': 'longblob'}
+
+def binary_type(env):
+    """Return the binary column type of the database of `env`."""
+    scheme = DatabaseManager(env).connection_uri.split(':', 1)[0]
+    return _binary_types.get(scheme, 'blob')
+
+def with_binary_type(env, table):
+    """Return `table` with its 'blob' columns of the binary type of the
+    database of `env`."""
+    binary = binary_type(env)
+    if binary == 'blob':
+        return table
+    columns = []
+    for column in table.columns:
+        if column.type == 'blob':
+            column = copy.copy(column)
+            column.type = binary
+        columns.append(column)
+    return Table(table.name, key=table.key)[columns + table.indices]
+
 class MailinglistSystem(Component):
     implements(IEnvironmentSetupParticipant, IPermissionRequestor,
-               IMailinglistMessageChangeListener,
+               IMailinglistMessageChangeListener, IRequestFilter,
                IAnnouncementProducer, IAnnouncementFormatter, IAnnouncementSubscriber,
-               IResourceManager)
+               IResourceManager, IAttachmentChangeListener)
 
     mailinglistchange_listeners  = ExtensionPoint(IMailinglistChangeListener)
     conversationchange_listeners = ExtensionPoint(IMailinglistConversationChangeListener)
     messagechange_listeners      = ExtensionPoint(IMailinglistMessageChangeListener)
+    raw_storages                 = ExtensionPoint(IMailinglistRawStorage)
+
+    raw_storage = ExtensionOption('mailinglist', 'raw_storage', IMailinglistRawStorage,
+                                  'DatabaseRawStorage',
+      """Where received messages are stored: `DatabaseRawStorage` in the
+      database, or `FileRawStorage` in files. Use `trac-admin $ENV
+      mailinglist migrate-raw` to move the messages already stored.""")
 
 
     email_domain = Option('mailinglist', 'email_domain', '',
       'Domain to show in the inbound email addresses.')
 
+    raw_compression = ChoiceOption('mailinglist', 'raw_compression', ['zlib', 'none'],
+      """How received messages are compressed when they are stored,
+      `zlib` or `none`. Messages stored before a change keep theirs.""")
+
+    outlook_thread_window = IntOption('mailinglist', 'outlook_thread_window', 30,
+      """Number of days a conversation stays open for Outlook replies that
+      are matched on their subject only. 0 means no limit.""")
+
+    def get_raw_storage(self, name):
+        """Return the raw message storage component called `name`. Rows
+        without one are in the database."""
+        name = name or 'DatabaseRawStorage'
+        for storage in self.raw_storages:
+            if storage.__class__.__name__ == name:
+                return storage
+        raise TracError(_('Mailinglist raw storage %(name)s is not enabled', name=name))
+
     # IPermissionRequestor methods
     def get_permission_actions(self):
         """ Permissions supported by the plugin. """
@@ -98,6 +172,11 @@ class MailinglistSystem(Component):
             Column('private', type='int'),
             Column('postperm'), # OPEN, MEMBERS, RESTRICTED
             Column('replyto'), # SENDER, LIST
+            Column('conversation_count', type='int'),
+            Column('message_count', type='int'),
+            Column('last_date', type='int64'),
+            Column('last_poster'),
+            Column('skip_duplicates', type='int'),
             Index(['email'], unique=True),
             ],
         Table('mailinglistconversations', key=('id'))[
@@ -106,11 +185,26 @@ class MailinglistSystem(Component):
             Column('date', type='int64'),
             Column('subject'),
             Column('first', type='int'),
+            Column('message_count', type='int'),
+            Column('last_date', type='int64'),
+            Column('last_poster'),
+            Column('normalized_subject'),
+            Column('thread_guid'),
+            Index(['list', 'date']),
+            Index(['list', 'normalized_subject']),
+            Index(['list', 'thread_guid']),
             ],
         Table('mailinglistraw', key=('id'))[
             Column('id', auto_increment=True),
             Column('list', type='int'),
-            Column('raw'),
+            Column('data', type='blob'),
+            Column('encoding'),
+            Column('size', type='int'),
+            Column('storage'),
+            Column('location'),
+            Column('hash'),
+            Index(['location']),
+            Index(['hash']),
             ],
         Table('mailinglistmessages', key=('id'))[
             Column('id', auto_increment=True),
@@ -119,14 +213,20 @@ class MailinglistSystem(Component):
             Column('raw', type='int'),
             Column('subject'),
             Column('body'),
+            Column('snippet'),
             Column('msg_id'),
             Column('date', type='int64'),
             Column('from_name'),
             Column('from_email'),
             Column('to_header'),
             Column('cc_header'),
+            Column('attachment_count', type='int'),
             Index(['list']),
-            Index(['conversation']),            
+            Index(['conversation']),
+            Index(['raw']),
+            Index(['list', 'msg_id']),
+            Index(['list', 'date']),
+            Index(['conversation', 'date']),
             ],
         Table('mailinglistusersubscription', key=('id'))[
             Column('id', auto_increment=True),
@@ -148,12 +248,66 @@ class MailinglistSystem(Component):
             Column('username'),
             Index(['list','username']),
             ],
+        Table('mailinglistmembers', key=('list', 'username'))[
+            Column('list', type='int'),
+            Column('username'),
+            Column('poster', type='int'),
+            Column('declined', type='int'),
+            Index(['username']),
+            ],
+        Table('mailinglisttimeline', key=('list', 'day'))[
+            Column('list', type='int'),
+            Column('day', type='int'),
+            Column('generation', type='int'),
+            ],
         ]
 
+    # Each version after the first has an upgrade module named
+    # upgrades/dbN.py. Version 1 had no entry in the system table.
+    schema_version = 12
+
     def environment_created(self):
         self.upgrade_environment(self.env.get_db_cnx())
 
     def environment_needs_upgrade(self, db):
+        return self._get_schema_version(db) < self.schema_version
+
+    def upgrade_environment(self, db):
+        self.log.debug("Upgrading schema for mailinglist plugin")
+        version = self._get_schema_version(db)
+        cursor = db.cursor()
+        if version == 0:
+            db_backend = DatabaseManager(self.env)._get_connector()[0]
+            for table in self._schema:
+                table = with_binary_type(self.env, table)
+                for stmt in db_backend.to_sql(table):
+                    self.log.debug(stmt)
+                    cursor.execute(stmt)
+            cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",
+                           ('mailinglist_version', str(self.schema_version)))
+            return
+        if version == 1:
+            cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",
+                           ('mailinglist_version', '1'))
+        for i in range(version + 1, self.schema_version + 1):
+            name = 'db%i' % i
+            try:
+                upgrades = __import__('mailinglistplugin.upgrades', globals(), locals(), [name])
+                script = getattr(upgrades, name)
+            except AttributeError:
+                raise TracError(_('No upgrade module for mailinglist version %(num)i '
+                                  '(%(version)s.py)', num=i, version=name))
+            script.do_upgrade(self.env, i, cursor)
+            cursor.execute("UPDATE system SET value = %s WHERE name = %s",
+                           (str(i), 'mailinglist_version'))
+            self.log.info('Upgraded mailinglist schema from version %d to %d', i - 1, i)
+
+    def _get_schema_version(self, db):
+        cursor = db.cursor()
+        cursor.execute("SELECT value FROM system WHERE name = %s", ('mailinglist_version',))
+        row = cursor.fetchone()
+        if row:
+            return int(row[0])
         try:
             @self.env.with_transaction()
             def check(db):
@@ -162,19 +316,24 @@ class MailinglistSystem(Component):
                 cursor.execute(sql)
                 cursor.fetchone()
         except Exception, e:
-            self.log.debug("Upgrade of schema needed for mailinglist plugin", exc_info=True)
-            return True
+            self.log.debug("Mailinglist tables not created yet", exc_info=True)
+            return 0
         else:
-            return False
+            return 1
 
-    def upgrade_environment(self, db):
-        self.log.debug("Upgrading schema for mailinglist plugin")
-        db_backend, _ = DatabaseManager(self.env)._get_connector()
-        cursor = db.cursor()
-        for table in self._schema:
-            for stmt in db_backend.to_sql(table):
-                self.log.debug(stmt)
-                cursor.execute(stmt)
+    # IRequestFilter
+
+    def pre_process_request(self, req, handler):
+        # Each request gets its own identity map, so model rows are
+        # loaded once per request, including while the template is
+        # rendered after post_process_request. It lasts until the request
+        # is garbage collected or the next request replaces it.
+        from mailinglistplugin.model import ModelIdentityMap
+        ModelIdentityMap.activate(self.env, req)
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
 
     # IResourceManager
 
@@ -237,6 +396,33 @@ class MailinglistSystem(Component):
     def mailinglistmessage_deleted(self, message):
         """Called when a mailinglistmessage is deleted."""
 
+    # IAttachmentChangeListener
+
+    def attachment_added(self, attachment):
+        self._count_attachments(attachment.parent_realm, attachment.parent_id)
+
+    def attachment_deleted(self, attachment):
+        self._count_attachments(attachment.parent_realm, attachment.parent_id)
+
+    def attachment_reparented(self, attachment, old_parent_realm, old_parent_id):
+        self._count_attachments(old_parent_realm, old_parent_id)
+        self._count_attachments(attachment.parent_realm, attachment.parent_id)
+
+    def _count_attachments(self, realm, id):
+        """Store the number of attachments of the message with resource
+        `id`, so listings know without asking the attachment table."""
+        parts = (realm == 'mailinglist' and id or '').split('/')
+        if len(parts) != 3 or not parts[2].isdigit():
+            return
+        @self.env.with_transaction()
+        def do_count(db):
+            cursor = db.cursor()
+            cursor.execute("UPDATE mailinglistmessages SET attachment_count = "
+                           "(SELECT count(*) FROM attachment WHERE type = %s AND id = %s) "
+                           "WHERE id = %s", (realm, id, int(parts[2])))
+        from mailinglistplugin.model import forget_message
+        forget_message(self.env, int(parts[2]))
+
     # IAnnouncementProducer methods
     
     def realms(self):
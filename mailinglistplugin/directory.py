@@ -0,0 +1,207 @@
+from trac.core import Component, implements
+from trac.cache import cached
+from trac.perm import PermissionSystem
+from trac.web.api import IRequestFilter
+
+class MailinglistSenderDirectory(Component):
+    """Maps sender email addresses to the Trac users who registered them.
+
+    The map is built from `session_attribute` once and shared between
+    processes through trac's cache generations. It is invalidated when a
+    logged in user's email address no longer agrees with it, which is
+    noticed on their first request after changing their preferences.
+    """
+
+    implements(IRequestFilter)
+
+    @cached
+    def _senders(self, db):
+        by_email = {}
+        by_sid = {}
+        cursor = db.cursor()
+        cursor.execute("SELECT sid, value FROM session_attribute "
+                       "WHERE name = 'email' AND authenticated = 1 "
+                       "ORDER BY sid")
+        for sid, email in cursor:
+            if not email:
+                continue
+            by_email.setdefault(email.strip().lower(), sid)
+            by_sid[sid] = email
+        return by_email, by_sid
+
+    def username(self, emailaddress):
+        """Return the sid of the user with `emailaddress`, or `None`."""
+        if not emailaddress:
+            return None
+        return self._senders[0].get(emailaddress.strip().lower())
+
+    def invalidate(self):
+        del self._senders
+
+    # IRequestFilter
+
+    def pre_process_request(self, req, handler):
+        if req.authname and req.authname != 'anonymous':
+            email = req.session.get('email') or None
+            if self._senders[1].get(req.authname) != email:
+                self.invalidate()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+def effective_members(env, cursor, list_id=None):
+    """Return the effective subscribers of every mailinglist, or of the
+    one with `list_id`, as `{list id: {username: details}}`.
+
+    Group subscriptions are expanded through the permission table.
+    """
+    all_perms = PermissionSystem(env).get_all_permissions()
+    permission_or_groupnames = set([p[1] for p in all_perms])
+    group_members = {}
+    # can't use
+    # store.get_users_with_permissions(groupname)
+    # because that requires users to be in session table as authenticated users
+    for user, permission in all_perms:
+        if user not in permission_or_groupnames:
+            group_members.setdefault(permission, []).append(user)
+
+    if list_id is None:
+        where, args = '', ()
+    else:
+        where, args = ' WHERE list = %s', (list_id,)
+    lists = {}
+    cursor.execute('SELECT list, groupname, poster FROM mailinglistgroupsubscription' + where, args)
+    for list_id, groupname, poster in cursor.fetchall():
+        res = lists.setdefault(list_id, {})
+        poster = bool(poster)
+        for user in group_members.get(groupname, []):
+            if user in res:
+                res[user]["poster"] |= poster
+                res[user]["gposter"] |= poster
+                res[user]["groups"].append(groupname)
+            else:
+                res[user] = {'groups': [groupname],
+                             'poster': poster,
+                             'gposter': poster,
+                             'individual': False,
+                             'decline': False}
+    cursor.execute('SELECT list, username, poster FROM mailinglistusersubscription' + where, args)
+    for list_id, username, poster in cursor.fetchall():
+        res = lists.setdefault(list_id, {})
+        poster = bool(poster)
+        if username in res:
+            res[username]["poster"] |= poster
+        else:
+            res[username] = {'groups': [],
+                             'poster': poster,
+                             'gposter': False,
+                             'decline': False}
+        res[username]['individual'] = username
+    cursor.execute('SELECT list, username FROM mailinglistuserdecline' + where, args)
+    for list_id, username in cursor.fetchall():
+        res = lists.get(list_id, {})
+        if username in res:
+            res[username]["decline"] = True
+    return lists
+
+def sync_members(env, cursor, list_id=None):
+    """Bring the `mailinglistmembers` table in line with the effective
+    subscribers of the list with `list_id`, or of every list. Only the
+    rows that differ are written; their number is returned."""
+    wanted = {}
+    for id, res in effective_members(env, cursor, list_id).iteritems():
+        for username, details in res.iteritems():
+            wanted[(id, username)] = (details['poster'] and 1 or 0,
+                                      details['decline'] and 1 or 0)
+    if list_id is None:
+        cursor.execute('SELECT list, username, poster, declined FROM mailinglistmembers')
+    else:
+        cursor.execute('SELECT list, username, poster, declined FROM mailinglistmembers '
+                       'WHERE list = %s', (list_id,))
+    existing = {}
+    for id, username, poster, declined in cursor.fetchall():
+        existing[(id, username)] = (poster, declined)
+
+    deleted = [key for key in existing if key not in wanted]
+    inserted = [key + flags for key, flags in wanted.iteritems() if key not in existing]
+    updated = [flags + key for key, flags in wanted.iteritems()
+               if key in existing and existing[key] != flags]
+    if deleted:
+        cursor.executemany('DELETE FROM mailinglistmembers WHERE list = %s AND username = %s',
+                           deleted)
+    if inserted:
+        cursor.executemany('INSERT INTO mailinglistmembers (list, username, poster, declined) '
+                           'VALUES (%s, %s, %s, %s)', inserted)
+    if updated:
+        cursor.executemany('UPDATE mailinglistmembers SET poster = %s, declined = %s '
+                           'WHERE list = %s AND username = %s', updated)
+    return len(deleted) + len(inserted) + len(updated)
+
+class MailinglistMembership(Component):
+    """Keeps the effective subscribers of every mailinglist.
+
+    Membership is materialized in the `mailinglistmembers` table, one
+    `(list, username, poster, declined)` row per effective subscriber,
+    which the permission policy and the list selections query. The
+    full details, including the groups a user is subscribed through,
+    are computed for all lists at once and shared between processes
+    through trac's cache generations.
+
+    Changing a subscription updates the rows of that list. Trac 0.12
+    has no notification for permission changes, so a form posted to the
+    web admin, where permissions and groups are edited, marks the session
+    and the next request of that user brings all rows up to date, once
+    the change is committed. After changes made with trac-admin run
+    `trac-admin $ENV mailinglist sync-members`.
+    """
+
+    implements(IRequestFilter)
+
+    @cached
+    def _subscribers(self, db):
+        return effective_members(self.env, db.cursor())
+
+    def subscribers(self, mailinglist):
+        """Return the subscribers of `mailinglist`, shared between callers
+        and not to be modified."""
+        return self._subscribers.get(mailinglist.id, {})
+
+    def member(self, mailinglist, username):
+        """Return `(poster, declined)` for `username` if they are a
+        member of `mailinglist`, else `None`."""
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute('SELECT poster, declined FROM mailinglistmembers '
+                       'WHERE list = %s AND username = %s', (mailinglist.id, username))
+        row = cursor.fetchone()
+        if row is not None:
+            return bool(row[0]), bool(row[1])
+        return None
+
+    def update_members(self, list_id=None, db=None):
+        """Recompute the members of the list with `list_id`, or of every
+        list, and return the number of rows changed."""
+        changed = []
+        @self.env.with_transaction(db)
+        def do_update(db):
+            changed.append(sync_members(self.env, db.cursor(), list_id))
+            self.invalidate()
+        return changed[0]
+
+    def invalidate(self):
+        del self._subscribers
+
+    # IRequestFilter
+
+    def pre_process_request(self, req, handler):
+        if req.session.get('mailinglist_sync_members'):
+            del req.session['mailinglist_sync_members']
+            self.update_members()
+        if req.method == 'POST' and req.path_info.startswith('/admin'):
+            # saved with the redirect or the page that follows the change
+            req.session['mailinglist_sync_members'] = '1'
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
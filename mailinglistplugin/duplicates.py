@@ -0,0 +1,63 @@
+from trac.core import Component
+from trac.cache import cached
+from trac.config import IntOption
+from trac.util.concurrency import threading
+
+from mailinglistplugin.utils import BloomFilter
+
+class MailinglistDuplicateFilter(Component):
+    """Tells whether a raw message with the same bytes may be stored.
+
+    Keeps a Bloom filter of the content hashes of the raw messages,
+    loaded on first use. When any process stores a raw message, a cache
+    generation shared between processes changes and the rows added since
+    are read by id. A "yes" has to be confirmed in the database. A "no"
+    saves that query, but is only a hint: rows committed out of id order,
+    or not yet committed when the filter caught up, can be missed. Such a
+    message is then stored once more, which is harmless.
+    """
+
+    capacity = IntOption('mailinglist', 'duplicate_filter_capacity', 1000000,
+        """Number of raw messages the filter for finding duplicates is
+        sized for, at 1.2 MB per million. When more are stored more
+        lookups are made.""")
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._filter = None
+        self._synced = None
+        self._last_raw = 0
+
+    # A new token every time a raw message is stored, possibly by another
+    # process; the filter remembers the token it was caught up under.
+
+    @cached
+    def _generation(self, db):
+        return object()
+
+    def may_have_raw(self, hash):
+        """Whether a raw message with the content `hash` may be stored."""
+        generation = self._generation
+        self._lock.acquire()
+        try:
+            if self._filter is None:
+                self._filter = BloomFilter(self.capacity)
+            if self._synced is not generation:
+                self._catch_up()
+                self._synced = generation
+            return hash in self._filter
+        finally:
+            self._lock.release()
+
+    def _catch_up(self):
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT id, hash FROM mailinglistraw WHERE id > %s", (self._last_raw,))
+        for id, hash in cursor:
+            if hash:
+                self._filter.add(hash)
+            self._last_raw = max(self._last_raw, id)
+
+    def invalidate(self):
+        """Have the filter catch up with the raw messages stored since."""
+        del self._generation
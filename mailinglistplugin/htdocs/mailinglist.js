@@ -15,11 +15,37 @@ jQuery(function($){
     	parent.next('.information').toggleClass('hidden');
     	
     });
-    $(".morebody").click(function(e){
+    $(".conversations").delegate(".morebody", "click", function(e){
     	$(this).next('pre').toggleClass('hidden');
     });
     $("#subscribe-link").click(function(){
       $("#subscribe-form").submit()
     });
 
+    // Append the later messages of a conversation as the reader
+    // scrolls down to them; the link is the fallback without script.
+    var more = $(".mailinglistconversation .more");
+    var loading = false;
+    function loadMore() {
+      var link = $("a", more);
+      if (loading || !link.length ||
+          $(window).scrollTop() + $(window).height() < more.offset().top - 400)
+        return;
+      loading = true;
+      $.getJSON(link.attr("href"), {format: "json"}, function(data) {
+        $(".mailinglistconversation .conversations").append(data.html);
+        if (data.next) {
+          link.attr("href", data.next);
+          loading = false;
+          loadMore();
+        } else {
+          more.remove();
+        }
+      });
+    }
+    if (more.length) {
+      $(window).scroll(loadMore);
+      loadMore();
+    }
+
 })
@@ -203,6 +203,7 @@ class mbox_to_mailinglist_importer(object):
         self.log.info('Importing mbox %s', mbox_file)
         mbox = mailbox.mbox(path)
         inserted = 0
+        skipped = 0
         errors = 0
         for mail in mbox:
             try_cnt = 5
@@ -213,8 +214,10 @@ class mbox_to_mailinglist_importer(object):
                         msg = msg.encode('utf-8')
                     except UnicodeEncodeError:
                         msg = msg.encode('iso-8859-15')
-                    mailinglist.insert_raw_email(msg)
-                    inserted += 1
+                    if mailinglist.insert_raw_email(msg) is None:
+                        skipped += 1
+                    else:
+                        inserted += 1
                     break
                 except Exception, e:
                     # Don't import specific OperatinalError (pg/sqlite)
@@ -232,6 +235,7 @@ class mbox_to_mailinglist_importer(object):
                         self.log.exception('Failed to insert message')
                         errors += 1
                         break
-        self.log.info('%s: Inserted %d/%d messages', mbox_file, inserted, inserted+errors)
+        self.log.info('%s: Inserted %d/%d messages, skipped %d already archived', mbox_file,
+                      inserted, inserted+errors, skipped)
         if tmpfile:
             os.unlink(tmpfile)
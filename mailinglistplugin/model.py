@@ -3,23 +3,300 @@
 from trac.core import *
 from trac.resource import Resource, ResourceNotFound
 from trac.mimeview.api import Mimeview, Context
-from trac.util.datefmt import utc, to_timestamp
+from trac.util.datefmt import utc, to_timestamp, from_utimestamp
 from trac.attachment import Attachment
 from trac.util.translation import _
+from trac.util.concurrency import ThreadLocal
 from datetime import datetime
 from cStringIO import StringIO
 
-from mailinglistplugin.utils import wrap_and_quote, parse_rfc2822_date, decode_header
+from mailinglistplugin.utils import wrap_and_quote, parse_rfc2822_date, decode_header, \
+     normalize_subject, decode_thread_index, make_snippet, pack_raw, unpack_raw
 import codecs
+import hashlib
+import weakref
+import zlib
 
 import email
 import re
 
 from mailinglistplugin.api import MailinglistSystem
-from trac.perm import PermissionSystem
+from mailinglistplugin.threader import MailinglistThreadResolver
+from mailinglistplugin.directory import MailinglistSenderDirectory, MailinglistMembership
+from mailinglistplugin.duplicates import MailinglistDuplicateFilter
+
+class ModelIdentityMap(object):
+    """Identity map for the rows backing the mailinglist model.
+
+    While a map is active for the current thread, every
+    `Mailinglist`, `MailinglistConversation` and `MailinglistMessage`
+    loaded by id reads its row through the map, so each row is fetched
+    from the database at most once. Building a message no longer costs
+    another query for its conversation and list when those have been
+    seen before.
+
+    `MailinglistSystem` activates a fresh map at the start of each web
+    request, replacing the one of the request before. The map is also
+    emptied and no longer used once the request object is freed. As the
+    request is in a reference cycle with its session, that takes a run
+    of the cyclic garbage collector, which trac's WSGI dispatcher starts
+    after each request; until then, or with other front ends until the
+    next request, code run later on the thread can still see the map.
+    Other callers (scripts, importers) can scope one explicitly:
+    {{{
+    idmap = ModelIdentityMap.activate(env)
+    try:
+        ...
+    finally:
+        idmap.deactivate()
+    }}}
+    """
+
+    _local = ThreadLocal(current=None)
+
+    def __init__(self, env):
+        self.env = env
+        self._rows = {}
+        self._request = None
+        self._ended = False
+
+    @classmethod
+    def activate(cls, env, req=None):
+        """Start a new, empty map for `env` in the current thread, which
+        ends when `req`, if given, is freed."""
+        idmap = cls(env)
+        if req is not None:
+            # the callback may run in whichever thread collects `req`
+            idmap._request = weakref.ref(req, idmap._end)
+        cls._local.current = idmap
+        return idmap
+
+    def deactivate(self):
+        if self._local.current is self:
+            self._local.current = None
+
+    @classmethod
+    def current(cls, env):
+        """Return the map active for `env` in this thread, if any."""
+        idmap = cls._local.current
+        if idmap is not None and idmap._ended:
+            idmap.deactivate()
+            return None
+        if idmap is not None and idmap.env is env:
+            return idmap
+        return None
+
+    def _end(self, ref):
+        self._ended = True
+        self._rows = {}
+
+    def _key(self, table, id):
+        try:
+            return table, int(id)
+        except (TypeError, ValueError):
+            return table, id
+
+    def get(self, table, id):
+        return self._rows.get(self._key(table, id))
+
+    def add(self, table, id, row):
+        self._rows[self._key(table, id)] = row
+
+    def discard(self, table, id):
+        self._rows.pop(self._key(table, id), None)
+
+    def clear(self):
+        self._rows.clear()
+
+def _select_columns(columns, alias=None):
+    if alias:
+        columns = ['%s.%s' % (alias, column) for column in columns]
+    return ', '.join(columns)
+
+def _fetch_row(env, table, columns, id):
+    """Fetch `columns` of the row with `id` from `table`, through the
+    active identity map if there is one."""
+    idmap = ModelIdentityMap.current(env)
+    if idmap is not None:
+        row = idmap.get(table, id)
+        if row is not None:
+            return row
+    db = env.get_read_db()
+    cursor = db.cursor()
+    cursor.execute('SELECT %s FROM %s WHERE id = %%s' % (_select_columns(columns), table),
+                   (id,))
+    row = cursor.fetchone()
+    if row and idmap is not None:
+        idmap.add(table, id, row)
+    return row
+
+def _seek_terms(desc, after=None, before=None, alias=None):
+    """Build the keyset condition and ordering for a listing sorted on
+    `(date, id)`.
+
+    `after` and `before` are `(timestamp, id)` keys of the row a page
+    starts after or ends before, in listing order. Seeking backwards
+    reads the rows in the opposite order; the caller reverses them when
+    `backwards` is returned True.
+
+    Returns `(condition, args, order, backwards)`.
+    """
+    prefix = alias and alias + '.' or ''
+    backwards = before is not None
+    descending = bool(desc) != backwards
+    key = backwards and before or after
+    condition, args = '', []
+    if key is not None:
+        op = descending and '<' or '>'
+        condition = (' AND (%(p)sdate %(op)s %%s OR (%(p)sdate = %%s AND %(p)sid %(op)s %%s))'
+                     % {'p': prefix, 'op': op})
+        args = [key[0], key[0], key[1]]
+    direction = descending and 'DESC' or 'ASC'
+    order = 'ORDER BY %(p)sdate %(d)s, %(p)sid %(d)s' % {'p': prefix, 'd': direction}
+    return condition, args, order, backwards
+
+def _remember_row(env, table, id, row):
+    """Record a row read by a set-based query in the active identity map."""
+    idmap = ModelIdentityMap.current(env)
+    if idmap is not None:
+        idmap.add(table, id, tuple(row))
+
+def _forget_row(env, table, id=None):
+    """Drop a changed row from the active identity map. Without an `id`
+    the whole map is dropped, for deletes that cascade."""
+    idmap = ModelIdentityMap.current(env)
+    if idmap is not None:
+        if id is None:
+            idmap.clear()
+        else:
+            idmap.discard(table, id)
+
+def forget_message(env, id):
+    """Drop the message with `id` from the active identity map, after
+    its row was changed by other means than the model."""
+    _forget_row(env, 'mailinglistmessages', id)
+
+def _last_message(table_alias, key_column):
+    return ("(SELECT %%s FROM mailinglistmessages m WHERE m.%s = %s.id "
+            "ORDER BY m.date DESC, m.id DESC LIMIT 1)" % (key_column, table_alias))
+
+def update_conversation_counters(cursor, where='1 = 1', args=()):
+    """Recompute the stored message count, first message and last
+    activity of the conversations matching `where`. The first message
+    is the one that started the conversation, the first archived."""
+    last = _last_message('mailinglistconversations', 'conversation')
+    cursor.execute("""
+        UPDATE mailinglistconversations SET
+        message_count = (SELECT count(m.id) FROM mailinglistmessages m
+                         WHERE m.conversation = mailinglistconversations.id),
+        last_date = %s,
+        last_poster = %s,
+        first = (SELECT m.id FROM mailinglistmessages m
+                 WHERE m.conversation = mailinglistconversations.id
+                 ORDER BY m.id LIMIT 1)
+        WHERE %s""" % (last % 'm.date', last % 'm.from_name', where), args)
+
+def update_list_counters(cursor, where='1 = 1', args=()):
+    """Recompute the stored conversation and message counts and last
+    activity of the mailinglists matching `where`."""
+    last = _last_message('mailinglist', 'list')
+    cursor.execute("""
+        UPDATE mailinglist SET
+        conversation_count = (SELECT count(c.id) FROM mailinglistconversations c
+                              WHERE c.list = mailinglist.id),
+        message_count = (SELECT count(m.id) FROM mailinglistmessages m
+                         WHERE m.list = mailinglist.id),
+        last_date = %s,
+        last_poster = %s
+        WHERE %s""" % (last % 'm.date', last % 'm.from_name', where), args)
+
+def _from_timestamp(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, utc)
+
+def _delete_raw(cursor, where, args=()):
+    """Delete the raw messages matching `where` and return the
+    `(id, storage, location)` of their stored bytes, to be removed with
+    `_remove_raw` once the rows are gone."""
+    cursor.execute("SELECT id, storage, location FROM mailinglistraw WHERE %s" % where, args)
+    rows = cursor.fetchall()
+    cursor.execute("DELETE FROM mailinglistraw WHERE %s" % where, args)
+    return rows
+
+def _raw_ids(cursor, where, args=()):
+    """Return the ids of the raw messages of the messages matching
+    `where`."""
+    cursor.execute("SELECT DISTINCT raw FROM mailinglistmessages WHERE raw IS NOT NULL AND %s"
+                   % where, args)
+    return [row[0] for row in cursor.fetchall()]
+
+# Raw messages are shared by the messages with the same bytes
+_unused_raw = ("NOT EXISTS (SELECT * FROM mailinglistmessages AS m "
+               "WHERE m.raw = mailinglistraw.id)")
+
+def _delete_unused_raw(cursor, ids):
+    """Delete those of the raw messages with `ids` no message uses any
+    more, returning what `_delete_raw` returns."""
+    if not ids:
+        return []
+    return _delete_raw(cursor, "id IN (%s) AND %s" % (','.join(['%s'] * len(ids)), _unused_raw),
+                       ids)
+
+def _remove_raw(env, rows):
+    if not rows:
+        return
+    system = MailinglistSystem(env)
+    @env.with_transaction()
+    def do_remove(db):
+        for id, storage, location in rows:
+            system.get_raw_storage(storage).remove(id, location, db)
+
+def select_attachments(env, messages, db=None):
+    """Return the attachments of `messages` as `{message id: [attachment]}`,
+    read in one query. Messages without attachments are not asked for."""
+    ids = dict([(message.resource.id, message.id) for message in messages
+                if message.attachment_count])
+    attachments = {}
+    if not ids:
+        return attachments
+    if not db:
+        db = env.get_read_db()
+    cursor = db.cursor()
+    cursor.execute("SELECT id, filename, description, size, time, author, ipnr "
+                   "FROM attachment WHERE type = 'mailinglist' AND id IN (%s) "
+                   "ORDER BY time" % ','.join(['%s'] * len(ids)), ids.keys())
+    for id, filename, description, size, time, author, ipnr in cursor:
+        attachment = Attachment(env, 'mailinglist', id)
+        attachment.filename = filename
+        attachment.description = description
+        attachment.size = size and int(size) or 0
+        attachment.date = from_utimestamp(time or 0)
+        attachment.author = author
+        attachment.ipnr = ipnr
+        attachments.setdefault(ids[id], []).append(attachment)
+    return attachments
+
+def select_first_snippets(env, conversations, db=None):
+    """Return the snippets of the first messages of `conversations` as
+    `{conversation id: snippet}`, read in one query."""
+    ids = [conversation._first for conversation in conversations
+           if conversation._first is not None]
+    if not ids:
+        return {}
+    if not db:
+        db = env.get_read_db()
+    cursor = db.cursor()
+    cursor.execute("SELECT conversation, snippet FROM mailinglistmessages WHERE id IN (%s)"
+                   % ','.join(['%s'] * len(ids)), ids)
+    return dict(cursor.fetchall())
 
 class Mailinglist(object):
 
+    _columns = ('email', 'name', 'description', 'private', 'date',
+                'postperm', 'replyto', 'conversation_count', 'message_count',
+                'last_date', 'last_poster', 'skip_duplicates')
+
     def __init__(self, env, id=None,
                  emailaddress=u'',
                  name=u'',
@@ -27,7 +304,8 @@ class Mailinglist(object):
                  private=False,
                  date=None,
                  postperm="MEMBERS",
-                 replyto="SENDER"):
+                 replyto="SENDER",
+                 skip_duplicates=False):
         self.env = env
         self.id = None
         self.emailaddress = emailaddress.lower()
@@ -40,24 +318,34 @@ class Mailinglist(object):
             self.date = date
         self.postperm = postperm
         self.replyto = replyto
+        self.skip_duplicates = skip_duplicates
+        self._conversation_count = 0
+        self._message_count = 0
+        self.last_date = None
+        self.last_poster = None
 
         if id is not None:
-            row = None
-            db = env.get_read_db()
-            cursor = db.cursor()
-            cursor.execute('SELECT email, name, description, private, date, postperm, replyto '
-                           'FROM mailinglist WHERE id = %s', (id,))
-            row = cursor.fetchone()
+            row = _fetch_row(env, 'mailinglist', self._columns, id)
             if row:
-                self.id = id
-                (self.emailaddress, self.name, self.description,
-                 private, date, self.postperm, self.replyto) = row
-                self.private = bool(private)
-                self.date = datetime.fromtimestamp(date, utc)
+                self._from_database(id, row)
             else:
                 raise ResourceNotFound(_('Mailinglist %s does not exist.' % id),
                                        _('Invalid Mailinglist Number'))
         self.resource = Resource('mailinglist', self.emailaddress)
+
+    def _from_database(self, id, row):
+        self.id = id
+        (self.emailaddress, self.name, self.description,
+         private, date, self.postperm, self.replyto,
+         conversation_count, message_count, last_date, self.last_poster,
+         skip_duplicates) = row
+        self.private = bool(private)
+        self.skip_duplicates = bool(skip_duplicates)
+        self.date = datetime.fromtimestamp(date, utc)
+        self._conversation_count = conversation_count or 0
+        self._message_count = message_count or 0
+        self.last_date = _from_timestamp(last_date)
+        self.resource = Resource('mailinglist', self.emailaddress)
         
     def __repr__(self):
         return '<%s %r: %s>' % (
@@ -73,21 +361,36 @@ class Mailinglist(object):
 
     def delete(self, db=None):
         """Delete a mailinglist"""
+        removed = []
         @self.env.with_transaction(db)
         def do_delete(db):
             cursor = db.cursor()
-            cursor.execute('SELECT conversation, id FROM mailinglistmessages WHERE list = %s', (self.id,))
-            for row in cursor:
+            cursor.execute('SELECT conversation, id, date FROM mailinglistmessages WHERE list = %s',
+                           (self.id,))
+            rows = cursor.fetchall()
+            for row in rows:
                 Attachment.delete_all(self.env, self.resource.realm,
                                       "%s/%d/%d" % (self.emailaddress, row[0], row[1]),
                                       db)
+            self.deleted_messages = [(row[1], row[2]) for row in rows]
             cursor.execute('DELETE FROM mailinglist WHERE id = %s', (self.id,))
             cursor.execute('DELETE FROM mailinglistconversations WHERE list = %s', (self.id,))
-            cursor.execute('DELETE FROM mailinglistraw WHERE list = %s', (self.id,))
+            # raw messages still used by other lists move to one of them
+            cursor.execute("UPDATE mailinglistraw SET list = "
+                           "(SELECT min(m.list) FROM mailinglistmessages AS m "
+                           " WHERE m.raw = mailinglistraw.id AND m.list != %s) "
+                           "WHERE list = %s AND id IN "
+                           "(SELECT raw FROM mailinglistmessages WHERE list != %s)",
+                           (self.id, self.id, self.id))
+            removed.extend(_delete_raw(cursor, 'list = %s', (self.id,)))
             cursor.execute('DELETE FROM mailinglistmessages WHERE list = %s', (self.id,))
             cursor.execute('DELETE FROM mailinglistusersubscription WHERE list = %s', (self.id,))
             cursor.execute('DELETE FROM mailinglistgroupsubscription WHERE list = %s', (self.id,))
             cursor.execute('DELETE FROM mailinglistuserdecline WHERE list = %s', (self.id,))
+            cursor.execute('DELETE FROM mailinglistmembers WHERE list = %s', (self.id,))
+        _forget_row(self.env, 'mailinglist')
+        _remove_raw(self.env, removed)
+        MailinglistMembership(self.env).invalidate()
 
         for listener in MailinglistSystem(self.env).mailinglistchange_listeners:
             listener.mailinglist_deleted(self)
@@ -113,10 +416,12 @@ class Mailinglist(object):
         def do_insert(db):
             cursor = db.cursor()
             cursor.execute('INSERT INTO mailinglist (email, name, description, '
-                           'date, private, postperm, replyto) '
-                           ' VALUES (%s, %s, %s, %s, %s, %s, %s)',
+                           'date, private, postperm, replyto, skip_duplicates, '
+                           'conversation_count, message_count) '
+                           ' VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 0, 0)',
                            (self.emailaddress.lower(), self.name, self.description, to_timestamp(self.date),
-                            self.private and 1 or 0, self.postperm, self.replyto))
+                            self.private and 1 or 0, self.postperm, self.replyto,
+                            self.skip_duplicates and 1 or 0))
             self.id = db.get_last_id(cursor, 'mailinglist')
 
         for listener in MailinglistSystem(self.env).mailinglistchange_listeners:
@@ -130,9 +435,12 @@ class Mailinglist(object):
         def do_save(db):
             cursor = db.cursor()
             cursor.execute('UPDATE mailinglist SET email=%s, name=%s, description=%s,'
-                           'date=%s, private=%s, postperm=%s, replyto=%s WHERE id = %s',
+                           'date=%s, private=%s, postperm=%s, replyto=%s, skip_duplicates=%s '
+                           'WHERE id = %s',
                            (self.emailaddress.lower(), self.name, self.description, to_timestamp(self.date),
-                            self.private and 1 or 0, self.postperm, self.replyto, self.id))
+                            self.private and 1 or 0, self.postperm, self.replyto,
+                            self.skip_duplicates and 1 or 0, self.id))
+        _forget_row(self.env, 'mailinglist', self.id)
             
         for listener in MailinglistSystem(self.env).mailinglistchange_listeners:
             listener.mailinglist_changed(self)
@@ -146,14 +454,21 @@ class Mailinglist(object):
             return "%s@%s" % (self.emailaddress, maildomain)
 
     def insert_raw_email(self, bytes):
+        """Archive the message `bytes` and return it as a
+        `MailinglistMessage`. Returns `None` instead when the list skips
+        duplicates and a message with the same Message-ID is archived."""
         msg = email.message_from_string(bytes)
-        
-        raw = MailinglistRawMessage(self.env, mailinglist=self, bytes=bytes)
-        raw.insert()
 
         msg_id = msg['message-id']
         if msg_id:
             msg_id = msg_id.strip()
+        if self.skip_duplicates and msg_id and self.has_message(msg_id):
+            self.env.log.debug("Skipping %s, already archived in %s", msg_id, self)
+            return None
+
+        raw = MailinglistRawMessage(self.env, mailinglist=self, bytes=bytes)
+        raw.insert()
+
         references = msg['references']
         if references:
             references = references.strip()
@@ -203,17 +518,7 @@ class Mailinglist(object):
         if not from_name: 
             from_name = from_email
 
-        db = self.env.get_read_db()
-        cursor = db.cursor()
-        cursor.execute('SELECT sid '
-                       'FROM session_attribute '
-                       'WHERE value = %s '
-                       'AND name = \'email\' AND authenticated = 1 LIMIT 1', (from_email,))
-        row = cursor.fetchone()
-        if row is not None:
-            trac_username = row[0]
-        else:
-            trac_username = from_email
+        trac_username = MailinglistSenderDirectory(self.env).username(from_email) or from_email
 
         to = decode_header(msg['to'])
         cc = decode_header(msg['cc'])
@@ -226,6 +531,7 @@ class Mailinglist(object):
         m.insert()
         if new:
             conv.first = m
+        attachments = False
         for part in msg.walk():
             if part.is_multipart():
                 continue
@@ -242,29 +548,51 @@ class Mailinglist(object):
             attachmentbytes = part.get_payload(decode=True)
             attachment.author = trac_username
             attachment.insert(filename, StringIO(attachmentbytes), len(attachmentbytes), t=date)
-        
+            attachments = True
+
+        if attachments:
+            # counted in the database by the attachment listener
+            db = self.env.get_read_db()
+            cursor = db.cursor()
+            cursor.execute('SELECT attachment_count FROM mailinglistmessages WHERE id = %s',
+                           (m.id,))
+            m.attachment_count = cursor.fetchone()[0] or 0
         return m
         
 
+    def has_message(self, msg_id):
+        """Whether a message with `msg_id` is archived in this list."""
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute('SELECT count(*) FROM mailinglistmessages WHERE list = %s AND msg_id = %s',
+                       (self.id, msg_id))
+        return cursor.fetchone()[0] > 0
+
     def get_conv(self, msg, in_reply_tos, subject, date):
         """
         Returns the `MailinglistConversation` the msg belongs to. If the message is the
         first message in a conversation or if the conversation is unknown
         a newly created conversation is returned.
         """
+        msg_ids = []
         for in_reply_to in in_reply_tos.split():
             match = re.search('<[^>]+>', in_reply_to)
             if match:
-                msg_id = match.group(0)
-                self.env.log.debug("Searching for message with msg_id %s", msg_id)
-                db = self.env.get_read_db()
-                cursor = db.cursor()
-                cursor.execute('SELECT conversation '
-                               'FROM mailinglistmessages '
-                               'WHERE msg_id = %s AND list = %s LIMIT 1', (msg_id, self.id))
-                row = cursor.fetchone()
-                if row is not None:
-                    return MailinglistConversation(self.env, row[0]), False
+                msg_ids.append(match.group(0))
+        if msg_ids:
+            self.env.log.debug("Searching for messages with msg_ids %s", msg_ids)
+            resolver = MailinglistThreadResolver(self.env)
+            conversation_id = resolver.resolve(self, msg_ids)
+            if conversation_id is not None:
+                try:
+                    return MailinglistConversation(self.env, conversation_id), False
+                except ResourceNotFound:
+                    # deleted by another process since it was cached
+                    for msg_id in msg_ids:
+                        resolver.forget(self, msg_id)
+                    conversation_id = resolver.resolve(self, msg_ids)
+                    if conversation_id is not None:
+                        return MailinglistConversation(self.env, conversation_id), False
 
         conv = MailinglistConversation(self.env, mailinglist=self, date=date, subject=subject)
         conv.insert()
@@ -277,40 +605,77 @@ class Mailinglist(object):
         a newly created conversation is returned.
 
         Since Microsoft Outlook/exchange seems to send mail replies without
-        "In-Reply-To" or "References" headers this version tries to
-        locate conversations using the message subject instead.
+        "In-Reply-To" or "References" headers this version locates
+        conversations using the conversation GUID in the "Thread-Index"
+        header, and failing that the message subject.
         """
-        if subject is not None:
-            def prepare_subject_for_compare(subject):
-                if len(subject) > 2 and subject[2] == ':':
-                    subject = subject[3:].lstrip()
-                subject = subject.replace(" ","")
-                return subject
-            topic = prepare_subject_for_compare(subject)
-
-            self.env.log.debug("Searching for message with topic %s", topic)
-            db = self.env.get_read_db()
-            cursor = db.cursor()
-            cursor.execute('SELECT subject, conversation '
-                           'FROM mailinglistmessages '
-                           'WHERE list = %s AND date < %s'
-                           'ORDER BY DATE DESC LIMIT 100', (self.id, to_timestamp(date)))
-            for row in cursor:
-                if row[0] and prepare_subject_for_compare(row[0]) == topic:
-                    return MailinglistConversation(self.env, row[1]), False
-
-        conv = MailinglistConversation(self.env, mailinglist=self, date=date, subject=subject)
+        thread_guid = decode_thread_index(msg['thread-index'])
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        if thread_guid:
+            cursor.execute('SELECT id FROM mailinglistconversations '
+                           'WHERE list = %s AND thread_guid = %s',
+                           (self.id, thread_guid))
+            row = cursor.fetchone()
+            if row is not None:
+                return MailinglistConversation(self.env, row[0]), False
+
+        topic = normalize_subject(subject)
+        if topic:
+            self.env.log.debug("Searching for conversation with topic %s", topic)
+            timestamp = to_timestamp(date)
+            window = MailinglistSystem(self.env).outlook_thread_window
+            window_term = window > 0 and "AND last_date >= %d" % (timestamp - window * 86400) or ""
+            cursor.execute('SELECT id FROM mailinglistconversations '
+                           'WHERE list = %%s AND normalized_subject = %%s AND date <= %%s %s '
+                           'ORDER BY last_date DESC LIMIT 1' % window_term,
+                           (self.id, topic, timestamp))
+            row = cursor.fetchone()
+            if row is not None:
+                conv = MailinglistConversation(self.env, row[0])
+                if thread_guid and not conv.thread_guid:
+                    # Let the rest of the thread find it by key
+                    conv.thread_guid = thread_guid
+                    conv.save_changes()
+                return conv, False
+
+        conv = MailinglistConversation(self.env, mailinglist=self, date=date, subject=subject,
+                                       thread_guid=thread_guid)
         conv.insert()
         return conv, True
 
+    @classmethod
+    def select_visible(cls, env, username, public=True, db=None):
+        """Yield the private lists `username` is a member of, and all
+        public lists if `public`, i.e. the lists they may view when
+        `public` tells whether they have `MAILINGLIST_VIEW` and only the
+        list level permission policies are configured."""
+        if not db:
+            db = env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT id, %s FROM mailinglist "
+                       "WHERE %s id IN (SELECT list FROM mailinglistmembers WHERE username = %%s) "
+                       "ORDER BY date" % (_select_columns(cls._columns),
+                                          public and "private = 0 OR" or ""),
+                       (username,))
+        for row in cursor:
+            mailinglist = cls(env)
+            mailinglist._from_database(row[0], row[1:])
+            _remember_row(env, 'mailinglist', row[0], row[1:])
+            yield mailinglist
+
     @classmethod
     def select(cls, env, db=None):
         if not db:
             db = env.get_read_db()
         cursor = db.cursor()
-        cursor.execute("SELECT id FROM mailinglist ORDER BY date")
+        cursor.execute("SELECT id, %s FROM mailinglist ORDER BY date"
+                       % _select_columns(cls._columns))
         for row in cursor:
-            yield cls(env, row[0])
+            mailinglist = cls(env)
+            mailinglist._from_database(row[0], row[1:])
+            _remember_row(env, 'mailinglist', row[0], row[1:])
+            yield mailinglist
             
     @classmethod
     def select_by_address(cls, env, address, localpart=False, db=None):
@@ -322,57 +687,101 @@ class Mailinglist(object):
         if not db:
             db = env.get_read_db()
         cursor = db.cursor()
-        cursor.execute('SELECT id '
-                       'FROM mailinglist WHERE email = %s', (userpart,))
+        cursor.execute('SELECT id, %s '
+                       'FROM mailinglist WHERE email = %%s' % _select_columns(cls._columns),
+                       (userpart,))
         row = cursor.fetchone()
         if row is None:
             raise ResourceNotFound("No mailing list for %s" % address)
         else:
-            return Mailinglist(env, row[0])
+            mailinglist = cls(env)
+            mailinglist._from_database(row[0], row[1:])
+            _remember_row(env, 'mailinglist', row[0], row[1:])
+            return mailinglist
 
     def count_conversations(self):
-        db = self.env.get_read_db()
-        cursor = db.cursor()
-        cursor.execute("""SELECT count(id) FROM mailinglistconversations
-        WHERE list = %s""", (self.id,))
-        return cursor.fetchone()[0]
+        return self._conversation_count
+
+    def conversations(self, offset=None, limit=None, desc=True, after=None, before=None):
+        """Yield the conversations of this list, newest first unless
+        `desc` is False.
 
-    def conversations(self, offset=None, limit=None, desc=True):
+        `after`/`before` take the `(timestamp, id)` key of a
+        conversation to seek past, so deep pages cost the same as the
+        first one; see `utils.encode_page_token`.
+        """
         db = self.env.get_read_db()
         cursor = db.cursor()
         offset_term = offset and "OFFSET %d" % offset or ""
         limit_term = limit and "LIMIT %d" % limit or ""
-        desc_term = desc and "DESC" or ""
-        cursor.execute("""SELECT id FROM mailinglistconversations
-        WHERE list = %%s ORDER BY date %s %s %s""" % (desc_term, limit_term, offset_term), (self.id,))
-        for row in cursor:
-            yield MailinglistConversation(self.env, row[0])
+        seek_term, seek_args, order_term, backwards = _seek_terms(desc, after, before)
+        cursor.execute("""SELECT id, %s FROM mailinglistconversations
+        WHERE list = %%s%s %s %s %s""" % (_select_columns(MailinglistConversation._columns),
+                                       seek_term, order_term, limit_term, offset_term),
+                       [self.id] + seek_args)
+        rows = backwards and reversed(cursor.fetchall()) or cursor
+        for row in rows:
+            conversation = MailinglistConversation(self.env, mailinglist=self)
+            conversation._from_database(row[0], row[1:])
+            _remember_row(self.env, 'mailinglistconversations', row[0], row[1:])
+            yield conversation
 
     def count_messages(self, insubject=None):
+        if not insubject:
+            return self._message_count
         db = self.env.get_read_db()
         cursor = db.cursor()
-        if insubject:
-            cursor.execute("""SELECT count(id) FROM mailinglistmessages
-            WHERE list = %s AND subject LIKE %s""",(self.id, '%%%s%%' %insubject))
-        else:
-            cursor.execute("""SELECT count(id) FROM mailinglistmessages
-            WHERE list = %s""", (self.id,))
+        cursor.execute("""SELECT count(id) FROM mailinglistmessages
+        WHERE list = %s AND subject LIKE %s""",(self.id, '%%%s%%' %insubject))
         return cursor.fetchone()[0]
+
+    def rebuild_counters(self, db=None):
+        """Recompute the stored counters of this list and its
+        conversations from the messages table."""
+        @self.env.with_transaction(db)
+        def do_rebuild(db):
+            cursor = db.cursor()
+            update_conversation_counters(cursor, 'list = %s', (self.id,))
+            update_list_counters(cursor, 'id = %s', (self.id,))
+        _forget_row(self.env, 'mailinglist')
             
-    def messages(self, offset=None, limit=None, insubject=None, desc=False):
+    def messages(self, offset=None, limit=None, insubject=None, desc=False,
+                 after=None, before=None):
         db = self.env.get_read_db()
         cursor = db.cursor()
         offset_term = offset and "OFFSET %d" % offset or ""
         limit_term = limit and "LIMIT %d" % limit or ""
-        desc_term = desc and "DESC" or ""
+        seek_term, seek_args, order_term, backwards = _seek_terms(desc, after, before, 'm')
+        # Messages come back with their conversation row joined in, so
+        # neither needs a query of its own.
+        message_columns = MailinglistMessage._columns
+        columns = "m.id, %s, %s" % (_select_columns(message_columns, 'm'),
+                                    _select_columns(MailinglistConversation._columns, 'c'))
         if insubject:
-            cursor.execute("""SELECT id FROM mailinglistmessages
-            WHERE list = %%s AND subject LIKE %%s ORDER BY date %s %s %s""" % (desc_term, limit_term, offset_term), (self.id, '%%%s%%' %insubject))
+            cursor.execute("""SELECT %s FROM mailinglistmessages m
+            INNER JOIN mailinglistconversations c ON c.id = m.conversation
+            WHERE m.list = %%s AND m.subject LIKE %%s%s %s %s %s""" % (columns, seek_term, order_term, limit_term, offset_term),
+                           [self.id, '%%%s%%' %insubject] + seek_args)
         else:
-            cursor.execute("""SELECT id FROM mailinglistmessages
-            WHERE list = %%s ORDER BY date %s %s %s""" % (desc_term, limit_term, offset_term), (self.id,))
-        for row in cursor:
-            yield MailinglistMessage(self.env, row[0])
+            cursor.execute("""SELECT %s FROM mailinglistmessages m
+            INNER JOIN mailinglistconversations c ON c.id = m.conversation
+            WHERE m.list = %%s%s %s %s %s""" % (columns, seek_term, order_term, limit_term, offset_term),
+                           [self.id] + seek_args)
+        rows = backwards and reversed(cursor.fetchall()) or cursor
+        conversations = {}
+        split = 1 + len(message_columns)
+        for row in rows:
+            message_row, conversation_row = row[1:split], row[split:]
+            conversation_id = message_row[0]
+            if conversation_id not in conversations:
+                conversation = MailinglistConversation(self.env, mailinglist=self)
+                conversation._from_database(conversation_id, conversation_row)
+                _remember_row(self.env, 'mailinglistconversations', conversation_id, conversation_row)
+                conversations[conversation_id] = conversation
+            message = MailinglistMessage(self.env, conversation=conversations[conversation_id])
+            message._from_database(row[0], message_row)
+            _remember_row(self.env, 'mailinglistmessages', row[0], message_row)
+            yield message
 
     def update_poster(self, user=None, group=None, poster=False, db=None):
         if user:
@@ -381,12 +790,16 @@ class Mailinglist(object):
                 cursor = db.cursor()
                 cursor.execute("""UPDATE mailinglistusersubscription
                 SET poster = %s WHERE username = %s""", (poster and 1 or 0, user))
+                # the poster flag is not set per list, so every list may change
+                MailinglistMembership(self.env).update_members(db=db)
         elif group:
             @self.env.with_transaction(db)
             def do_set(db):
                 cursor = db.cursor()
                 cursor.execute("""UPDATE mailinglistgroupsubscription
                 SET poster = %s WHERE groupname = %s""", (poster and 1 or 0, group))
+                # the poster flag is not set per list, so every list may change
+                MailinglistMembership(self.env).update_members(db=db)
 
     def is_subscribed(self, username):
         subscribers = self.subscribers()
@@ -401,43 +814,7 @@ class Mailinglist(object):
         Return active subscribers of current list and wheather they have
         posting permissions or not.
         """
-        res = {}
-        all_perms = PermissionSystem(self.env).get_all_permissions()
-
-        permission_or_groupnames = set([p[1] for p in all_perms])
-                
-        # can't use 
-        # store.get_users_with_permissions(groupname)
-        # because that requires users to be in session table as authenticated users
-        for groupname, poster in self.groups():
-            for user, permission in all_perms:
-                if permission != groupname:
-                    continue
-                if user in permission_or_groupnames:
-                    continue
-                if res.has_key(user):
-                    res[user]["poster"] |= poster
-                    res[user]["gposter"] |= poster
-                    res[user]["groups"].append(groupname)
-                else:
-                    res[user] = {'groups': [groupname],
-                                   'poster':poster,
-                                   'gposter':poster,
-                                   'individual': False,
-                                   'decline': False}
-        for username, poster in self.individuals():
-            if res.has_key(username):
-                res[username]["poster"] |= poster
-            else:
-                res[username] = {'groups': [],
-                                  'poster':poster,
-                                  'gposter':False,
-                                  'decline': False}
-            res[username]['individual'] = username
-        for username in self.declines():
-            if res.has_key(username):
-                res[username]["decline"] = True
-        return res
+        return MailinglistMembership(self.env).subscribers(self)
 
     def count_members(self):
         """
@@ -461,12 +838,14 @@ class Mailinglist(object):
                 if set_decline:
                     cursor.execute('DELETE FROM mailinglistuserdecline WHERE list = %s '
                                    'AND username = %s', (self.id, user))
+                MailinglistMembership(self.env).update_members(self.id, db=db)
         elif group:
             @self.env.with_transaction(db)
             def do_subscribe(db):
                 cursor = db.cursor()
                 cursor.execute("""INSERT INTO mailinglistgroupsubscription
                 (list, groupname, poster) values (%s,%s,%s)""", (self.id, group, poster and 1 or 0))
+                MailinglistMembership(self.env).update_members(self.id, db=db)
 
     def unsubscribe(self, user=None, group=None, set_decline=True, db=None):
         if user:
@@ -480,12 +859,14 @@ class Mailinglist(object):
                 if set_decline:
                     cursor.execute("""INSERT INTO mailinglistuserdecline
                     (list, username) values (%s,%s)""", (self.id, user))
+                MailinglistMembership(self.env).update_members(self.id, db=db)
         elif group:
             @self.env.with_transaction(db)
             def do_unsubscribe(db):
                 cursor = db.cursor()
                 cursor.execute("""DELETE FROM mailinglistgroupsubscription
                 WHERE list = %s AND groupname = %s""", (self.id, group))
+                MailinglistMembership(self.env).update_members(self.id, db=db)
 
     def individuals(self):
         db = self.env.get_read_db()
@@ -509,6 +890,18 @@ class Mailinglist(object):
             yield row[0]
 
 class MailinglistRawMessage(object):
+    """A message as it was received.
+
+    The bytes are compressed as the `encoding` column says, with their
+    length in `size`, and kept by the `IMailinglistRawStorage` named in
+    the `storage` column, at its `location`.
+
+    Messages with the same bytes, such as one cross-posted to several
+    lists, share a row found by the SHA-1 in `hash`. The row is deleted
+    with the last message using it.
+    """
+
+    chunk_size = 65536
 
     def __init__(self, env, id=None,
                  mailinglist=None, # Mailinglist instance
@@ -522,13 +915,14 @@ class MailinglistRawMessage(object):
             row = None
             db = env.get_read_db()
             cursor = db.cursor()
-            cursor.execute('SELECT list, raw '
+            cursor.execute('SELECT list, encoding, storage, location '
                            'FROM mailinglistraw WHERE id = %s', (id,))
             row = cursor.fetchone()
             if row:
                 self.id = id
-                (mailinglistid, bytes) = row
-                self.bytes = bytes.encode('utf8') # should just be a string of bytes
+                (mailinglistid, encoding, storage, location) = row
+                storage = MailinglistSystem(env).get_raw_storage(storage)
+                self.bytes = unpack_raw(storage.read(id, location, db=db), encoding)
                 self.mailinglist = Mailinglist(env, mailinglistid)
             else:
                 raise ResourceNotFound(_('MailinglistRawMessage %s does not exist.' % id),
@@ -548,40 +942,150 @@ class MailinglistRawMessage(object):
 
     exists = property(__nonzero__)
 
+    @classmethod
+    def _stored(cls, env, id, db=None):
+        if not db:
+            db = env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT encoding, size, storage, location FROM mailinglistraw "
+                       "WHERE id = %s", (id,))
+        row = cursor.fetchone()
+        if not row:
+            raise ResourceNotFound(_('MailinglistRawMessage %s does not exist.' % id),
+                                   _('Invalid Mailinglist Raw Message Number'))
+        return row[0], row[1] or 0, row[2], row[3]
+
+    @classmethod
+    def size(cls, env, id, db=None):
+        """Return the length in bytes of the raw message with `id`,
+        without reading it."""
+        return cls._stored(env, id, db)[1]
+
+    @classmethod
+    def chunks(cls, env, id, start=0, end=None, db=None):
+        """Yield the bytes `start` up to `end` of the raw message with `id`
+        in pieces, reading `chunk_size` stored bytes at a time so the
+        message is never held in memory as a whole."""
+        if not db:
+            db = env.get_read_db()
+        encoding, size, storage, location = cls._stored(env, id, db)
+        if end is None:
+            end = size
+        storage = MailinglistSystem(env).get_raw_storage(storage)
+        def read(offset, length):
+            return storage.read(id, location, offset, length, db)
+
+        if encoding != 'zlib':
+            for offset in xrange(start, end, cls.chunk_size):
+                piece = read(offset, min(cls.chunk_size, end - offset))
+                if not piece:
+                    return
+                yield str(piece)
+            return
+
+        # compressed data can only be read from the start; what comes
+        # before `start` is decompressed and dropped
+        decompressor = zlib.decompressobj()
+        offset = position = 0
+        while position < end:
+            piece = read(offset, cls.chunk_size)
+            if piece:
+                offset += len(piece)
+                out = decompressor.decompress(piece)
+            else:
+                out = decompressor.flush()
+            if position + len(out) > start:
+                yield out[max(start - position, 0):end - position]
+            position += len(out)
+            if not piece:
+                return
+
     def delete(self, db=None):
-        """Delete a mailinglistrawmessage"""
+        """Delete a mailinglistrawmessage, unless messages use it"""
+        removed = []
         @self.env.with_transaction(db)
         def do_delete(db):
             cursor = db.cursor()
-            cursor.execute('DELETE FROM mailinglistraw WHERE id = %s', (self.id,))
-            
+            removed.extend(_delete_raw(cursor, 'id = %%s AND %s' % _unused_raw, (self.id,)))
+        _remove_raw(self.env, removed)
+
     def insert(self, db=None):
-        """Add a new mailinglistrawmessage."""
+        """Add a new mailinglistrawmessage, or take the id of a stored
+        one with the same bytes."""
+        hash = self._hash()
+        duplicates = MailinglistDuplicateFilter(self.env)
+        added = []
         @self.env.with_transaction(db)
         def do_insert(db):
             cursor = db.cursor()
+            if duplicates.may_have_raw(hash):
+                cursor.execute('SELECT id FROM mailinglistraw WHERE hash = %s AND size = %s',
+                               (hash, len(self.bytes)))
+                row = cursor.fetchone()
+                if row:
+                    self.id = row[0]
+                    return
+            bytes, encoding = self._pack()
             cursor.execute('INSERT INTO mailinglistraw '
-                           '(list, raw) '
-                           ' VALUES (%s, %s)',
-                           (self.mailinglist.id, self.bytes))
+                           '(list, encoding, size, hash) '
+                           ' VALUES (%s, %s, %s, %s)',
+                           (self.mailinglist.id, encoding, len(self.bytes), hash))
             self.id = db.get_last_id(cursor, 'mailinglistraw')
+            self._store(bytes, db)
+            added.append(self.id)
+        if added:
+            duplicates.invalidate()
         self.resource = Resource('mailinglist', "%s/raw/%s" % (self.mailinglist.emailaddress,
                                                                self.id),
                                  parent=self.mailinglist.resource)
         return self.id
 
     def save_changes(self, db=None):
+        replaced = []
         @self.env.with_transaction(db)
         def do_save(db):
             cursor = db.cursor()
-            cursor.execute('UPDATE mailinglistraw SET list=%s, raw=%s '
+            bytes, encoding = self._pack()
+            cursor.execute('SELECT storage, location FROM mailinglistraw WHERE id = %s',
+                           (self.id,))
+            storage, location = cursor.fetchone()
+            old = (storage or 'DatabaseRawStorage', location)
+            cursor.execute('UPDATE mailinglistraw SET list=%s, encoding=%s, size=%s, hash=%s '
                            'WHERE id = %s',
-                           (self.mailinglist.id, self.bytes))
+                           (self.mailinglist.id, encoding, len(self.bytes), self._hash(),
+                            self.id))
+            if self._store(bytes, db) != old:
+                replaced.append((self.id,) + old)
+        _remove_raw(self.env, replaced)
         return True
 
+    def _store(self, bytes, db):
+        storage = MailinglistSystem(self.env).raw_storage
+        name = storage.__class__.__name__
+        location = storage.store(self.id, bytes, db)
+        cursor = db.cursor()
+        cursor.execute('UPDATE mailinglistraw SET storage=%s, location=%s WHERE id = %s',
+                       (name, location, self.id))
+        return name, location
+
+    def _hash(self):
+        if isinstance(self.bytes, unicode):
+            self.bytes = self.bytes.encode('utf-8')
+        return hashlib.sha1(self.bytes).hexdigest()
+
+    def _pack(self):
+        if isinstance(self.bytes, unicode):
+            self.bytes = self.bytes.encode('utf-8')
+        encoding = MailinglistSystem(self.env).raw_compression
+        return pack_raw(self.bytes, encoding), encoding
+
 
 class MailinglistMessage(object):
 
+    _columns = ('conversation', 'raw', 'subject', 'body', 'msg_id',
+                'date', 'from_name', 'from_email', 'to_header', 'cc_header',
+                'attachment_count')
+
     def __init__(self, env, id=None,
                  conversation=None, # MailinglistConversation instance
                  subject=u'',
@@ -608,26 +1112,16 @@ class MailinglistMessage(object):
         self.from_email = from_email
         self.to_header = to_header
         self.cc_header = cc_header
+        self.attachment_count = 0
         if raw is None:
             self._raw = None
         else:
             self._raw = raw.id
 
         if id is not None:
-            row = None
-            db = env.get_read_db()
-            cursor = db.cursor()
-            cursor.execute('SELECT conversation, raw, subject, body, msg_id, '
-                           'date, from_name, from_email, to_header, cc_header '
-                           'FROM mailinglistmessages WHERE id = %s', (id,))
-            row = cursor.fetchone()
+            row = _fetch_row(env, 'mailinglistmessages', self._columns, id)
             if row:
-                self.id = id
-                (mailinglistconversationid, self._raw, self.subject, self.body,
-                 self.msg_id, date, self.from_name, self.from_email,
-                 self.to_header, self.cc_header) = row 
-                self.date = datetime.fromtimestamp(date, utc)
-                self.conversation = MailinglistConversation(env, mailinglistconversationid)
+                self._from_database(id, row)
             else:
                 raise ResourceNotFound(_('MailinglistMessage %s does not exist.' % id),
                                        _('Invalid Mailinglist Message Number'))
@@ -637,6 +1131,20 @@ class MailinglistMessage(object):
                                                               self.id),
                                  parent=self.conversation.resource)
 
+    def _from_database(self, id, row):
+        self.id = id
+        (mailinglistconversationid, self._raw, self.subject, self.body,
+         self.msg_id, date, self.from_name, self.from_email,
+         self.to_header, self.cc_header, attachment_count) = row
+        self.date = datetime.fromtimestamp(date, utc)
+        self.attachment_count = attachment_count or 0
+        if self.conversation is None or self.conversation.id != mailinglistconversationid:
+            self.conversation = MailinglistConversation(self.env, mailinglistconversationid)
+        self.resource = Resource('mailinglist', "%s/%s/%s" % (self.conversation.mailinglist.emailaddress,
+                                                              self.conversation.id,
+                                                              self.id),
+                                 parent=self.conversation.resource)
+
     def get_raw(self):
         if self._raw is None:
             raise ResourceNotFound("Raw not set")
@@ -649,6 +1157,7 @@ class MailinglistMessage(object):
             cursor.execute('UPDATE mailinglistmessages SET raw=%s WHERE id = %s',
                            (raw.id, self.id))
             self._raw = raw.id
+        _forget_row(self.env, 'mailinglistmessages', self.id)
 
     raw = property(get_raw, set_raw)
         
@@ -670,14 +1179,18 @@ class MailinglistMessage(object):
     
     def delete(self, db=None):
         """Delete a mailinglistmessage"""
+        removed = []
         @self.env.with_transaction(db)
         def do_delete(db):
             cursor = db.cursor()
             Attachment.delete_all(self.env, self.resource.realm, self.resource.id, db)
-            cursor.execute("""
-            DELETE FROM mailinglistraw WHERE id IN
-            (SELECT raw FROM mailinglistmessages WHERE id = %s)""", (self.id,))
+            raws = _raw_ids(cursor, 'id = %s', (self.id,))
             cursor.execute('DELETE FROM mailinglistmessages WHERE id = %s', (self.id,))
+            removed.extend(_delete_unused_raw(cursor, raws))
+            update_conversation_counters(cursor, 'id = %s', (self.conversation.id,))
+            update_list_counters(cursor, 'id = %s', (self.conversation.mailinglist.id,))
+        _forget_row(self.env, 'mailinglistmessages')
+        _remove_raw(self.env, removed)
 
         for listener in MailinglistSystem(self.env).messagechange_listeners:
             listener.mailinglistmessage_deleted(self)
@@ -688,13 +1201,15 @@ class MailinglistMessage(object):
         def do_insert(db):
             cursor = db.cursor()
             cursor.execute('INSERT INTO mailinglistmessages '
-                           '(conversation, list, raw, subject, body, msg_id, '
-                           'date, from_name, from_email, to_header, cc_header) '
-                           ' VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)',
+                           '(conversation, list, raw, subject, body, snippet, msg_id, '
+                           'date, from_name, from_email, to_header, cc_header, attachment_count) '
+                           ' VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 0)',
                            (self.conversation.id, self.conversation.mailinglist.id, self._raw,
-                            self.subject or '', self.body or '', self.msg_id, to_timestamp(self.date),
+                            self.subject or '', self.body or '', make_snippet(self.body),
+                            self.msg_id, to_timestamp(self.date),
                             self.from_name, self.from_email, self.to_header, self.cc_header))
             self.id = db.get_last_id(cursor, 'mailinglistmessages')
+            self._update_counters_for_insert(cursor)
             
         for listener in MailinglistSystem(self.env).messagechange_listeners:
             listener.mailinglistmessage_created(self)
@@ -704,17 +1219,42 @@ class MailinglistMessage(object):
                                  parent=self.conversation.resource)                                 
         return self.id
 
+    def _update_counters_for_insert(self, cursor):
+        conversation = self.conversation
+        mailinglist = conversation.mailinglist
+        timestamp = to_timestamp(self.date)
+        for table, instance in (('mailinglistconversations', conversation),
+                                ('mailinglist', mailinglist)):
+            cursor.execute('UPDATE %s SET message_count = message_count + 1 '
+                           'WHERE id = %%s' % table, (instance.id,))
+            # an older message arriving late (e.g. from an import) does
+            # not make it the last one
+            cursor.execute('UPDATE %s SET last_date = %%s, last_poster = %%s '
+                           'WHERE id = %%s AND (last_date IS NULL OR last_date <= %%s)' % table,
+                           (timestamp, self.from_name, instance.id, timestamp))
+            instance._message_count += 1
+            if instance.last_date is None or instance.last_date <= self.date:
+                instance.last_date = self.date
+                instance.last_poster = self.from_name
+            _forget_row(self.env, table, instance.id)
+
     def save_changes(self, db=None):
         @self.env.with_transaction(db)
         def do_save(db):
             cursor = db.cursor()
-            cursor.execute('UPDATE mailinglistmessages SET conversation=%s, list=%s, raw=%s'
-                           'subject=%s, body=%s, msg_id=%s, date=%s, '
-                           'from_name=%s, from_email=%s, to_header=%s, cc_header=%s'
+            cursor.execute('SELECT list, date FROM mailinglistmessages WHERE id = %s', (self.id,))
+            row = cursor.fetchone()
+            self.old_values = row and {'list': row[0], 'date': row[1]} or {}
+            cursor.execute('UPDATE mailinglistmessages SET conversation=%s, list=%s, raw=%s, '
+                           'subject=%s, body=%s, snippet=%s, msg_id=%s, date=%s, '
+                           'from_name=%s, from_email=%s, to_header=%s, cc_header=%s '
                            'WHERE id = %s',
                            (self.conversation.id, self.conversation.mailinglist.id, self._raw,
-                            self.subject or '', self.body or '', self.msg_id, to_timestamp(self.date),
-                            self.from_name, self.from_email, self.to_header, self.cc_header))
+                            self.subject or '', self.body or '', make_snippet(self.body),
+                            self.msg_id, to_timestamp(self.date),
+                            self.from_name, self.from_email, self.to_header, self.cc_header,
+                            self.id))
+        _forget_row(self.env, 'mailinglistmessages', self.id)
 
         for listener in MailinglistSystem(self.env).messagechange_listeners:
             listener.mailinglistmessage_changed(self)
@@ -723,10 +1263,14 @@ class MailinglistMessage(object):
 
 class MailinglistConversation(object):
 
+    _columns = ('list', 'date', 'subject', 'first', 'message_count',
+                'last_date', 'last_poster', 'thread_guid')
+
     def __init__(self, env, id=None,
                  mailinglist=None, # Mailinglist instance
                  date=None,
-                 subject=u''):
+                 subject=u'',
+                 thread_guid=None):
         self.env = env
         self.id = None
         self.mailinglist = mailinglist
@@ -735,25 +1279,35 @@ class MailinglistConversation(object):
         else:
             self.date = date
         self.subject = subject
+        self.thread_guid = thread_guid
+        self._first = None
+        self._message_count = 0
+        self.last_date = None
+        self.last_poster = None
 
         if id is not None:
-            row = None
-            db = env.get_read_db()
-            cursor = db.cursor()
-            cursor.execute('SELECT list, date, subject, first '
-                           'FROM mailinglistconversations WHERE id = %s', (id,))
-            row = cursor.fetchone()
+            row = _fetch_row(env, 'mailinglistconversations', self._columns, id)
             if row:
-                self.id = id
-                (mailinglistid, date, self.subject, self._first) = row 
-                self.date = datetime.fromtimestamp(date, utc)
-                self.mailinglist = Mailinglist(env, mailinglistid)
+                self._from_database(id, row)
             else:
                 raise ResourceNotFound(_('MailinglistConversation %s does not exist.' % id),
                                        _('Invalid Mailinglist Conversation Number'))
         self.resource = Resource('mailinglist', "%s/%s" % (self.mailinglist.emailaddress,
                                                            self.id),
                                  parent=self.mailinglist.resource)
+
+    def _from_database(self, id, row):
+        self.id = id
+        (mailinglistid, date, self.subject, self._first,
+         message_count, last_date, self.last_poster, self.thread_guid) = row
+        self.date = datetime.fromtimestamp(date, utc)
+        self._message_count = message_count or 0
+        self.last_date = _from_timestamp(last_date)
+        if self.mailinglist is None or self.mailinglist.id != mailinglistid:
+            self.mailinglist = Mailinglist(self.env, mailinglistid)
+        self.resource = Resource('mailinglist', "%s/%s" % (self.mailinglist.emailaddress,
+                                                           self.id),
+                                 parent=self.mailinglist.resource)
         
     def __repr__(self):
         return '<%s %r: %s>' % (
@@ -769,22 +1323,27 @@ class MailinglistConversation(object):
 
     def delete(self, db=None):
         """Delete a mailinglistconversation"""
+        removed = []
         @self.env.with_transaction(db)
         def do_delete(db):
             # could implement the message deleting part by
             # instantiating and calling delete() on each,
             # but that sounds pretty slower.
             cursor = db.cursor()
-            cursor.execute('SELECT id FROM mailinglistmessages WHERE conversation = %s', (self.id,))
-            for row in cursor:
+            cursor.execute('SELECT id, date FROM mailinglistmessages WHERE conversation = %s',
+                           (self.id,))
+            self.deleted_messages = cursor.fetchall()
+            for row in self.deleted_messages:
                 Attachment.delete_all(self.env, self.resource.realm, "%s/%d/%d" % (self.mailinglist.emailaddress,
                                                                                    self.id,
                                                                                    row[0]), db)
             cursor.execute('DELETE FROM mailinglistconversations WHERE id = %s', (self.id,))
-            cursor.execute("""
-            DELETE FROM mailinglistraw WHERE id IN
-            (SELECT raw FROM mailinglistmessages WHERE conversation = %s)""", (self.id,))
+            raws = _raw_ids(cursor, 'conversation = %s', (self.id,))
             cursor.execute('DELETE FROM mailinglistmessages WHERE conversation = %s', (self.id,))
+            removed.extend(_delete_unused_raw(cursor, raws))
+            update_list_counters(cursor, 'id = %s', (self.mailinglist.id,))
+        _forget_row(self.env, 'mailinglistconversations')
+        _remove_raw(self.env, removed)
 
         for listener in MailinglistSystem(self.env).conversationchange_listeners:
             listener.mailinglistconversation_deleted(self)
@@ -794,11 +1353,17 @@ class MailinglistConversation(object):
         @self.env.with_transaction(db)
         def do_insert(db):
             cursor = db.cursor()
-            cursor.execute('INSERT INTO mailinglistconversations (list, date, subject) '
-                           ' VALUES (%s, %s, %s)',
+            cursor.execute('INSERT INTO mailinglistconversations (list, date, subject, '
+                           'normalized_subject, thread_guid, message_count) '
+                           ' VALUES (%s, %s, %s, %s, %s, 0)',
                            (self.mailinglist.id, to_timestamp(self.date),
-                            self.subject or ""))
+                            self.subject or "", normalize_subject(self.subject),
+                            self.thread_guid))
             self.id = db.get_last_id(cursor, 'mailinglistconversations')
+            cursor.execute('UPDATE mailinglist SET conversation_count = conversation_count + 1 '
+                           'WHERE id = %s', (self.mailinglist.id,))
+            self.mailinglist._conversation_count += 1
+        _forget_row(self.env, 'mailinglist', self.mailinglist.id)
 
         for listener in MailinglistSystem(self.env).conversationchange_listeners:
             listener.mailinglistconversation_created(self)
@@ -811,10 +1376,12 @@ class MailinglistConversation(object):
         @self.env.with_transaction(db)
         def do_save(db):
             cursor = db.cursor()
-            cursor.execute('UPDATE mailinglistconversations SET list=%s, date=%s, subject=%s '
-                           'WHERE id = %s',
+            cursor.execute('UPDATE mailinglistconversations SET list=%s, date=%s, subject=%s, '
+                           'normalized_subject=%s, thread_guid=%s WHERE id = %s',
                            (self.mailinglist.id, to_timestamp(self.date),
-                            self.subject or '', self.id))
+                            self.subject or '', normalize_subject(self.subject),
+                            self.thread_guid, self.id))
+        _forget_row(self.env, 'mailinglistconversations', self.id)
         
         for listener in MailinglistSystem(self.env).conversationchange_listeners:
             listener.mailinglistconversation_changed(self)
@@ -833,23 +1400,26 @@ class MailinglistConversation(object):
             cursor.execute('UPDATE mailinglistconversations SET first=%s WHERE id = %s',
                            (message.id, self.id))
             self._first = message.id
+        _forget_row(self.env, 'mailinglistconversations', self.id)
 
     first = property(get_first, set_first)
 
     def count_messages(self):
-        db = self.env.get_read_db()
-        cursor = db.cursor()
-        cursor.execute("""SELECT count(id) FROM mailinglistmessages
-        WHERE conversation = %s""", (self.id,))
-        return cursor.fetchone()[0]
+        return self._message_count
             
-    def messages(self, offset=None, limit=None, desc=False):
+    def messages(self, offset=None, limit=None, desc=False, after=None, before=None):
         db = self.env.get_read_db()
         cursor = db.cursor()
         offset_term = offset and "OFFSET %d" % offset or ""
         limit_term = limit and "LIMIT %d" % limit or ""
-        desc_term = desc and "DESC" or ""
-        cursor.execute("""SELECT id FROM mailinglistmessages
-        WHERE conversation = %%s ORDER BY date %s %s %s""" % (desc_term, limit_term, offset_term), (self.id,))
-        for row in cursor:
-            yield MailinglistMessage(self.env, row[0])
+        seek_term, seek_args, order_term, backwards = _seek_terms(desc, after, before)
+        cursor.execute("""SELECT id, %s FROM mailinglistmessages
+        WHERE conversation = %%s%s %s %s %s""" % (_select_columns(MailinglistMessage._columns),
+                                               seek_term, order_term, limit_term, offset_term),
+                       [self.id] + seek_args)
+        rows = backwards and reversed(cursor.fetchall()) or cursor
+        for row in rows:
+            message = MailinglistMessage(self.env, conversation=self)
+            message._from_database(row[0], row[1:])
+            _remember_row(self.env, 'mailinglistmessages', row[0], row[1:])
+            yield message
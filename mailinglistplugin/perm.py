@@ -1,56 +1,119 @@
-from trac.perm import IPermissionRequestor, IPermissionPolicy
+from trac.perm import IPermissionRequestor, IPermissionPolicy, PermissionSystem
 from trac.core import Component, implements, TracError, Interface, ExtensionPoint
+from trac.config import ListOption
+from trac.util.compat import any
+from trac.util.concurrency import ThreadLocal
+from trac.web.api import IRequestFilter
+import weakref
 
-from mailinglistplugin.api import MailinglistSystem
-from mailinglistplugin.model import MailinglistConversation, MailinglistMessage
+from mailinglistplugin.directory import MailinglistMembership
+from mailinglistplugin.model import Mailinglist
 
 class MailinglistPermissionPolicy(Component):
-    implements(IPermissionPolicy)
+    """Decides mailinglist permissions at list granularity.
+
+    Conversations, messages and raw messages get the permissions of
+    their list, which is taken from the first part of the resource id,
+    so checking a message does not load it. Decisions are remembered
+    per user, list and action during a web request, as search and
+    timeline check every result on their own. They are dropped when the
+    next request starts, or before if the request object is freed by the
+    garbage collector.
+    """
+
+    implements(IPermissionPolicy, IRequestFilter)
+
+    list_level_policies = ListOption('mailinglist', 'list_level_policies',
+        'MailinglistPermissionPolicy, DefaultPermissionPolicy, LegacyAttachmentPolicy',
+        doc="""Permission policies that decide `MAILINGLIST_VIEW` on a
+        message by its list alone. When all of `[trac] permission_policies`
+        are in this list, search and timeline check each list once instead
+        of every message.""")
+
+    _local = ThreadLocal(decisions=None, request=None)
+
+    def visible_lists(self, perm):
+        """Return the mailinglists where `perm` grants `MAILINGLIST_VIEW`.
+
+        With only the list level policies configured these are found by
+        the subscriptions of the user, otherwise every list is checked
+        through the configured policies.
+        """
+        if self.list_level():
+            return list(Mailinglist.select_visible(self.env, perm.username,
+                                                   "MAILINGLIST_VIEW" in perm))
+        return [mailinglist for mailinglist in Mailinglist.select(self.env)
+                if "MAILINGLIST_VIEW" in perm(mailinglist.resource)]
+
+    def viewable_lists(self, perm, mailinglists):
+        """Return the ids of those `mailinglists` where `perm` grants
+        `MAILINGLIST_VIEW` on every message, checking each list once.
+
+        Returns `None` if a configured policy may decide per message, in
+        which case every message has to be checked on its own.
+        """
+        if not self.list_level():
+            return None
+        return set([mailinglist.id for mailinglist in mailinglists
+                    if "MAILINGLIST_VIEW" in perm(mailinglist.resource)])
+
+    def list_level(self):
+        """Whether all configured policies decide `MAILINGLIST_VIEW` by
+        the list alone."""
+        return not any(policy.__class__.__name__ not in self.list_level_policies
+                       for policy in PermissionSystem(self.env).policies)
+
+    # IRequestFilter methods
+    def pre_process_request(self, req, handler):
+        self._local.decisions = {}
+        self._local.request = weakref.ref(req)
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
 
     # IPermissionPolicy methods
     def check_permission(self, action, username, resource, perm):
 
-        # maybe we need to reorganise a little, to factor up the
-        # "isinstance" business.
-        
         if action is "ATTACHMENT_VIEW":
             self.log.debug("Deciding if %s can do %s on %s", username, action, resource)
             if resource and resource.parent and resource.parent.realm == "mailinglist":
                 return "MAILINGLIST_VIEW" in perm(resource.parent)
 
-        elif action is "MAILINGLIST_VIEW":
-            self.log.debug("Deciding if %s can do %s on %s", username, action, resource)
-            # if no resource, then it's up to the general permissions table
-            if resource and resource.realm == "mailinglist":
-                instance = MailinglistSystem(self.env).get_instance_for_resource(resource)
-                if isinstance(instance, MailinglistMessage):
-                    return action in perm(instance.conversation.resource)
-                elif isinstance(instance, MailinglistConversation):
-                    return action in perm(instance.mailinglist.resource)
-                elif instance.private == False:
-                    # it's a mailinglist
-                    return None # it's up to the general permissions table
-                elif instance.private == True:
-                    # it's a mailinglist
-                    return username in instance.subscribers()
-            
-        elif action is "MAILINGLIST_POST":
-            self.log.debug("Deciding if %s can do %s on %s", username, action, resource)            
+        elif action in ("MAILINGLIST_VIEW", "MAILINGLIST_POST"):
             if resource is None:
-                # In general, people can post...
-                return True
-            if resource.realm == "mailinglist":
-                instance = MailinglistSystem(self.env).get_instance_for_resource(resource)
-                if isinstance(instance, MailinglistMessage):
-                    return action in perm(instance.conversation.resource)
-                elif isinstance(instance, MailinglistConversation):
-                    return action in perm(instance.mailinglist.resource)
-                elif instance.postperm == "OPEN":
-                    return True
-                elif instance.postperm == "RESTRICTED":
-                    try:
-                        return instance.subscribers()[username]['poster']
-                    except KeyError, e:
-                        return False
-                elif instance.postperm == "MEMBERS":
-                    return username in instance.subscribers()
+                # if no resource, then it's up to the general permissions table,
+                # except that in general, people can post...
+                return action == "MAILINGLIST_POST" or None
+            if resource.realm != "mailinglist" or not resource.id:
+                return None
+            emailaddress = resource.id.split("/", 1)[0]
+            decisions = self._decisions(username)
+            if decisions is None:
+                return self._decide(action, username, emailaddress)
+            key = (emailaddress, action)
+            if key not in decisions:
+                decisions[key] = self._decide(action, username, emailaddress)
+            return decisions[key]
+
+    def _decisions(self, username):
+        # not once the request they were made in is freed, which takes
+        # the cyclic garbage collector; else the next request resets them
+        request = self._local.request
+        if request is None or request() is None:
+            self._local.decisions = self._local.request = None
+            return None
+        return self._local.decisions.setdefault(username, {})
+
+    def _decide(self, action, username, emailaddress):
+        self.log.debug("Deciding if %s can do %s on %s", username, action, emailaddress)
+        mailinglist = Mailinglist.select_by_address(self.env, emailaddress, localpart=True)
+        if action == "MAILINGLIST_VIEW" and mailinglist.private == False:
+            return None # it's up to the general permissions table
+        if action == "MAILINGLIST_POST" and mailinglist.postperm == "OPEN":
+            return True
+        member = MailinglistMembership(self.env).member(mailinglist, username)
+        if action == "MAILINGLIST_VIEW" or mailinglist.postperm == "MEMBERS":
+            return member is not None
+        elif mailinglist.postperm == "RESTRICTED":
+            return member is not None and member[0]
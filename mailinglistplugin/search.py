@@ -0,0 +1,342 @@
+import re
+
+from trac.core import Component, implements
+from trac.cache import cached
+from trac.db import DatabaseManager
+from trac.env import IEnvironmentSetupParticipant
+from trac.search import search_to_sql, shorten_result
+from trac.util.datefmt import to_timestamp, utc
+
+from datetime import datetime
+
+from mailinglistplugin.api import IMailinglistChangeListener, \
+     IMailinglistConversationChangeListener, IMailinglistMessageChangeListener
+
+_nonword = re.compile(r'\W+', re.UNICODE)
+
+class SqliteFullText(object):
+    """Full text index in an SQLite FTS5 table, keyed by message id.
+
+    The table is an external content table, reading the text of the
+    messages from `mailinglistmessages` instead of keeping a copy, and is
+    kept in sync by triggers on that table, which are given the values
+    the index has to forget when a message is changed or deleted.
+    """
+
+    table = 'mailinglistmessages_fts'
+    columns = 'subject, body, from_name, from_email, list'
+    triggers = {'insert': "INSERT INTO %(table)s (rowid, %(columns)s) "
+                          "VALUES (new.id, %(new)s);",
+                'delete': "INSERT INTO %(table)s (%(table)s, rowid, %(columns)s) "
+                          "VALUES ('delete', old.id, %(old)s);",
+                'update': "INSERT INTO %(table)s (%(table)s, rowid, %(columns)s) "
+                          "VALUES ('delete', old.id, %(old)s); "
+                          "INSERT INTO %(table)s (rowid, %(columns)s) "
+                          "VALUES (new.id, %(new)s);"}
+
+    def exists(self, cursor):
+        # a table without its triggers is one from before they were used
+        names = [self.table] + ['%s_%s' % (self.table, event) for event in self.triggers]
+        cursor.execute("SELECT count(*) FROM sqlite_master WHERE name IN (%s)"
+                       % ','.join(['%s'] * len(names)), names)
+        return cursor.fetchone()[0] == len(names)
+
+    def create(self, cursor):
+        cursor.execute("CREATE VIRTUAL TABLE %s USING fts5(subject, body, from_name, "
+                       "from_email, list UNINDEXED, content='mailinglistmessages', "
+                       "content_rowid='id')" % self.table)
+        values = {'table': self.table, 'columns': self.columns,
+                  'old': ', '.join(['old.' + c for c in self.columns.split(', ')]),
+                  'new': ', '.join(['new.' + c for c in self.columns.split(', ')])}
+        for event, when in (('insert', 'INSERT'), ('delete', 'DELETE'),
+                            ('update', 'UPDATE OF %s' % self.columns)):
+            cursor.execute("CREATE TRIGGER %s_%s AFTER %s ON mailinglistmessages BEGIN %s END"
+                           % (self.table, event, when, self.triggers[event] % values))
+        cursor.execute("INSERT INTO %s (%s) VALUES ('rebuild')" % (self.table, self.table))
+
+    def drop(self, cursor):
+        for event in self.triggers:
+            cursor.execute("DROP TRIGGER IF EXISTS %s_%s" % (self.table, event))
+        cursor.execute("DROP TABLE IF EXISTS %s" % self.table)
+
+    def add(self, cursor, where='1 = 1', args=()):
+        # done by the triggers
+        pass
+
+    def remove(self, cursor, ids):
+        # done by the triggers
+        pass
+
+    # bm25, lower is better
+    rank = "f.rank"
+    snippet = "snippet(%s, 1, char(2), char(3), '...', 24)" % table
+
+    def source(self, db, terms):
+        # Every term must match, as a word prefix
+        match = ' '.join(['"%s"*' % term.replace('"', '""') for term in terms])
+        return ("%s AS f JOIN mailinglistmessages AS m ON m.id = f.rowid" % self.table, [],
+                "f.%s MATCH %%s" % self.table, [match])
+
+    def available(self, cursor):
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE temp.mailinglist_fts_probe USING fts5(probe)")
+            cursor.execute("DROP TABLE temp.mailinglist_fts_probe")
+        except Exception, e:
+            return False
+        return True
+
+class PostgresFullText(object):
+    """Full text index in a PostgreSQL table of tsvectors with a GIN
+    index, keyed by message id."""
+
+    table = 'mailinglistmessages_fts'
+    document = ("setweight(to_tsvector('simple', coalesce(subject, '')), 'A') || "
+                "to_tsvector('simple', coalesce(from_name, '') || ' ' || "
+                "coalesce(from_email, '') || ' ' || coalesce(body, ''))")
+
+    def exists(self, cursor):
+        cursor.execute("SELECT count(*) FROM pg_catalog.pg_tables "
+                       "WHERE tablename = %s AND schemaname = current_schema()", (self.table,))
+        return cursor.fetchone()[0] > 0
+
+    def create(self, cursor):
+        cursor.execute("CREATE TABLE %s (id integer PRIMARY KEY, list integer, "
+                       "document tsvector)" % self.table)
+        cursor.execute("CREATE INDEX %s_document_idx ON %s USING gin(document)"
+                       % (self.table, self.table))
+
+    def drop(self, cursor):
+        cursor.execute("DROP TABLE IF EXISTS %s" % self.table)
+
+    def add(self, cursor, where='1 = 1', args=()):
+        cursor.execute("INSERT INTO %s (id, list, document) SELECT id, list, %s "
+                       "FROM mailinglistmessages WHERE %s" % (self.table, self.document, where),
+                       args)
+
+    def remove(self, cursor, ids):
+        cursor.executemany("DELETE FROM %s WHERE id = %%s" % self.table,
+                           [(id,) for id in ids])
+
+    # lower is better, as for SQLite
+    rank = "-ts_rank(f.document, query)"
+    snippet = ("ts_headline('simple', coalesce(m.body, ''), query, 'StartSel=' || chr(2) || "
+               "', StopSel=' || chr(3) || ', MaxWords=24, MinWords=8, MaxFragments=2')")
+
+    def source(self, db, terms):
+        # Every term must match, as a word prefix
+        words = []
+        for term in terms:
+            words.extend(_nonword.sub(u' ', term).split())
+        match = ' & '.join(["'%s':*" % word for word in words]) or "''"
+        return ("%s AS f JOIN mailinglistmessages AS m ON m.id = f.id, "
+                "to_tsquery('simple', %%s) AS query" % self.table, [match],
+                "f.document @@ query", [])
+
+    def available(self, cursor):
+        return True
+
+class LikeSearch(object):
+    """Matching with `LIKE`, for when there is no full text index."""
+
+    rank = "0"
+    # the excerpt is made from the body by the caller
+    snippet = "m.body"
+
+    def source(self, db, terms):
+        sql, args = search_to_sql(db, ['m.subject', 'm.body', 'm.from_email', 'm.from_name'],
+                                  terms)
+        return "mailinglistmessages AS m", [], sql, list(args)
+
+# Calendar year of a message date, for the year facet
+_year_sql = {'sqlite': "CAST(strftime('%Y', m.date, 'unixepoch') AS integer)",
+             'postgres': "CAST(extract(year FROM to_timestamp(m.date)) AS integer)",
+             'mysql': "YEAR(FROM_UNIXTIME(m.date))"}
+
+class MailinglistSearchIndex(Component):
+    """Full text index of the archived messages.
+
+    Uses SQLite FTS5 or PostgreSQL text search, depending on the
+    database, and is kept up to date as messages are archived and
+    deleted. On other databases, or an SQLite built without FTS5,
+    searches fall back to matching with `LIKE`. Whether the index
+    exists is shared between processes through trac's cache
+    generations, so one rebuilt by trac-admin is used everywhere.
+    """
+
+    implements(IEnvironmentSetupParticipant, IMailinglistChangeListener,
+               IMailinglistConversationChangeListener, IMailinglistMessageChangeListener)
+
+    _backends = {'sqlite': SqliteFullText,
+                 'postgres': PostgresFullText}
+
+    def __init__(self):
+        self.scheme = DatabaseManager(self.env).connection_uri.split(':', 1)[0]
+        self.backend = self.scheme in self._backends and self._backends[self.scheme]() or None
+
+    def search(self, terms, list_ids, list_id=None, sender=None, year=None,
+               offset=0, limit=None, facets=False):
+        """Find the messages in the lists with `list_ids` that match all
+        `terms`, optionally only those in the list with `list_id`, from
+        `sender` or sent in `year`.
+
+        Returns `(results, total, facets)`. `results` are the rows
+        `(id, subject, from_name, from_email, date, list, conversation,
+        excerpt)` from `offset`, at most `limit`, ordered by relevance
+        decayed by age in years. In the excerpt matches are enclosed in
+        "\\x02" and "\\x03". `total` is the number of matches. If
+        `facets` is set, `facets` maps 'list', 'sender' and 'year' to
+        `(value, count)` pairs, each counted over the matches of the other
+        filters, else it is `None`.
+        """
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        if not list_ids:
+            return [], 0, facets and {'list': [], 'sender': [], 'year': []} or None
+        backend = self._exists and self.backend or LikeSearch()
+        from_sql, from_args, match, match_args = backend.source(db, terms)
+
+        match = "%s AND m.list IN (%s)" % (match, ','.join(['%s'] * len(list_ids)))
+        match_args = match_args + list(list_ids)
+        filters = {}
+        if list_id:
+            filters['list'] = ("m.list = %s", [list_id])
+        if sender:
+            filters['sender'] = ("m.from_email = %s", [sender])
+        if year:
+            start = to_timestamp(datetime(year, 1, 1, tzinfo=utc))
+            end = to_timestamp(datetime(year + 1, 1, 1, tzinfo=utc))
+            filters['year'] = ("m.date >= %s AND m.date < %s", [start, end])
+
+        def where(exclude=None):
+            sql, args = [match], list(match_args)
+            for name, (condition, condition_args) in filters.items():
+                if name != exclude:
+                    sql.append(condition)
+                    args.extend(condition_args)
+            return ' AND '.join(sql), args
+
+        condition, args = where()
+        query = ("SELECT m.id, m.subject, m.from_name, m.from_email, m.date, m.list, "
+                 "m.conversation, %s FROM %s WHERE %s "
+                 "ORDER BY %s / (1 + (%d - m.date) / 31536000.0), m.date DESC, m.id DESC"
+                 % (backend.snippet, from_sql, condition, backend.rank,
+                    to_timestamp(datetime.now(utc))))
+        if limit:
+            query += " LIMIT %d OFFSET %d" % (limit, offset)
+        self.log.debug("Search query: %s", query)
+        cursor.execute(query, from_args + args)
+        results = cursor.fetchall()
+        if isinstance(backend, LikeSearch):
+            results = [row[:-1] + (shorten_result(row[-1], terms),) for row in results]
+
+        if limit:
+            cursor.execute("SELECT count(*) FROM %s WHERE %s" % (from_sql, condition),
+                           from_args + args)
+            total = cursor.fetchone()[0]
+        else:
+            total = len(results)
+
+        counts = None
+        if facets:
+            counts = {}
+            for name, expression in (('list', 'm.list'),
+                                     ('sender', 'm.from_email'),
+                                     ('year', _year_sql.get(self.scheme))):
+                if expression is None:
+                    counts[name] = []
+                    continue
+                condition, args = where(exclude=name)
+                cursor.execute("SELECT %s, count(*) FROM %s WHERE %s "
+                               "GROUP BY %s ORDER BY count(*) DESC, %s"
+                               % (expression, from_sql, condition, expression, expression),
+                               from_args + args)
+                counts[name] = cursor.fetchall()
+        return results, total, counts
+
+    def rebuild(self, db=None):
+        """Recreate the index from the archived messages. Returns whether
+        there is an index."""
+        created = []
+        @self.env.with_transaction(db)
+        def do_rebuild(db):
+            cursor = db.cursor()
+            available = bool(self.backend) and self.backend.available(cursor)
+            # remembered, so the database is only probed again on request
+            cursor.execute("DELETE FROM system WHERE name = %s", (self._unavailable_key,))
+            if not available:
+                cursor.execute("INSERT INTO system (name, value) VALUES (%s, '1')",
+                               (self._unavailable_key,))
+            elif self.backend:
+                self.backend.drop(cursor)
+                self.backend.create(cursor)
+                self.backend.add(cursor)
+                created.append(True)
+            del self._exists
+        return bool(created)
+
+    _unavailable_key = 'mailinglist_fulltext_unavailable'
+
+    @cached
+    def _exists(self, db):
+        return bool(self.backend) and self.backend.exists(db.cursor())
+
+    def _update(self, fn):
+        if self._exists:
+            @self.env.with_transaction()
+            def do_update(db):
+                fn(db.cursor())
+
+    # IEnvironmentSetupParticipant
+
+    def environment_created(self):
+        self.rebuild()
+
+    def environment_needs_upgrade(self, db):
+        if not self.backend:
+            return False
+        cursor = db.cursor()
+        if self.backend.exists(cursor):
+            return False
+        cursor.execute("SELECT count(*) FROM system WHERE name = %s", (self._unavailable_key,))
+        return cursor.fetchone()[0] == 0
+
+    def upgrade_environment(self, db):
+        self.rebuild(db)
+
+    # IMailinglistChangeListener
+
+    def mailinglist_created(self, mailinglist):
+        pass
+
+    def mailinglist_changed(self, mailinglist):
+        pass
+
+    def mailinglist_deleted(self, mailinglist):
+        ids = [id for id, date in mailinglist.deleted_messages]
+        self._update(lambda cursor: self.backend.remove(cursor, ids))
+
+    # IMailinglistConversationChangeListener
+
+    def mailinglistconversation_created(self, conversation):
+        pass
+
+    def mailinglistconversation_changed(self, conversation):
+        pass
+
+    def mailinglistconversation_deleted(self, conversation):
+        ids = [id for id, date in conversation.deleted_messages]
+        self._update(lambda cursor: self.backend.remove(cursor, ids))
+
+    # IMailinglistMessageChangeListener
+
+    def mailinglistmessage_created(self, message):
+        self._update(lambda cursor: self.backend.add(cursor, 'id = %s', (message.id,)))
+
+    def mailinglistmessage_changed(self, message):
+        def reindex(cursor):
+            self.backend.remove(cursor, [message.id])
+            self.backend.add(cursor, 'id = %s', (message.id,))
+        self._update(reindex)
+
+    def mailinglistmessage_deleted(self, message):
+        self._update(lambda cursor: self.backend.remove(cursor, [message.id]))
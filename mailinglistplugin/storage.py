@@ -0,0 +1,175 @@
+import errno
+import hashlib
+import mmap
+import os
+import tempfile
+import time
+
+from trac.core import Component, implements
+from trac.config import IntOption, Option
+
+from mailinglistplugin.api import IMailinglistRawStorage
+
+class DatabaseRawStorage(Component):
+    """Keeps received messages in the `data` column of `mailinglistraw`."""
+
+    implements(IMailinglistRawStorage)
+
+    def store(self, id, data, db):
+        cursor = db.cursor()
+        cursor.execute("UPDATE mailinglistraw SET data = %s WHERE id = %s", (buffer(data), id))
+        return None
+
+    def read(self, id, location, offset=0, length=None, db=None):
+        if not db:
+            db = self.env.get_read_db()
+        cursor = db.cursor()
+        if offset == 0 and length is None:
+            cursor.execute("SELECT data FROM mailinglistraw WHERE id = %s", (id,))
+        else:
+            # SQL strings count from 1
+            cursor.execute("SELECT substr(data, %s, %s) FROM mailinglistraw WHERE id = %s",
+                           (offset + 1, length is None and 2 ** 31 - 1 or length, id))
+        row = cursor.fetchone()
+        return row and row[0] or ''
+
+    def remove(self, id, location, db):
+        cursor = db.cursor()
+        cursor.execute("UPDATE mailinglistraw SET data = NULL WHERE id = %s", (id,))
+
+class FileRawStorage(Component):
+    """Keeps received messages in files outside the database, named by
+    the SHA-1 of their stored bytes in two levels of fan-out directories.
+
+    Files are written to a temporary name, synced and then renamed, so a
+    file is either complete or not there at all. They are read through
+    `mmap`, so only the ranges read are brought into memory. Messages
+    with the same bytes share a file.
+
+    Files are not removed with their messages, as another message with
+    the same bytes may be about to use the file, nor can a removal be
+    undone when the transaction is rolled back. Instead `sweep` removes
+    the files no message uses that were last stored longer ago than
+    `raw_storage_sweep_age`.
+    """
+
+    implements(IMailinglistRawStorage)
+
+    directory = Option('mailinglist', 'raw_storage_dir', 'files/mailinglist',
+        """Directory of the `FileRawStorage` message files, relative to
+        the environment if not absolute.""")
+
+    sweep_age = IntOption('mailinglist', 'raw_storage_sweep_age', 86400,
+        """Seconds since a `FileRawStorage` message file was last stored
+        before it can be removed, when no message uses it.""")
+
+    def store(self, id, data, db):
+        location = hashlib.sha1(data).hexdigest()
+        path = self._path(location)
+        try:
+            # keeps the file from being swept until the message is committed
+            os.utime(path, None)
+            return location
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            os.rename(temp, path)
+        except:
+            os.unlink(temp)
+            raise
+        self._sync_directory(directory)
+        return location
+
+    def read(self, id, location, offset=0, length=None, db=None):
+        f = open(self._path(location), 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            end = length is None and size or min(offset + length, size)
+            if offset >= end:
+                return ''
+            m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                return m[offset:end]
+            finally:
+                m.close()
+        finally:
+            f.close()
+
+    def remove(self, id, location, db):
+        # left to `sweep`
+        pass
+
+    def sweep(self, age=None):
+        """Remove the message files no message uses that were stored more
+        than `age` seconds ago, by default `raw_storage_sweep_age`, and
+        return their number."""
+        if age is None:
+            age = self.sweep_age
+        root = os.path.join(self.env.path, self.directory)
+        removed = 0
+        for directory, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                if filename.endswith('.sweep'):
+                    # left by an interrupted sweep
+                    filename = filename[:-len('.sweep')]
+                    path = path[:-len('.sweep')]
+                    os.rename(path + '.sweep', path)
+                if self._is_old(path, age) and self._sweep(path, filename, age):
+                    removed += 1
+        return removed
+
+    def _sweep(self, path, filename, age):
+        # Moved aside first: a message stored from here on writes the file
+        # anew, and one stored before has made it recent or is in the
+        # database by now.
+        swept = path + '.sweep'
+        os.rename(path, swept)
+        used = False
+        if not filename.startswith('.tmp'):
+            db = self.env.get_read_db()
+            cursor = db.cursor()
+            cursor.execute("SELECT count(*) FROM mailinglistraw WHERE location = %s",
+                           (os.path.basename(path),))
+            used = cursor.fetchone()[0] > 0
+        if used or not self._is_old(swept, age):
+            os.rename(swept, path)
+            return False
+        os.unlink(swept)
+        return True
+
+    def _is_old(self, path, age):
+        return os.stat(path).st_mtime < time.time() - age
+
+    def _path(self, location):
+        directory = os.path.join(self.env.path, self.directory)
+        return os.path.join(directory, location[:2], location[2:4], location)
+
+    def _sync_directory(self, directory):
+        # makes the rename itself durable; not possible everywhere
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+        finally:
+            os.close(fd)
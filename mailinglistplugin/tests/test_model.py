@@ -3,20 +3,32 @@ import os.path
 from StringIO import StringIO
 import tempfile
 import shutil
+import hashlib
 import unittest
 import time
+import gc
 
 from trac import core
 from trac.web.session import DetachedSession
 from trac.attachment import Attachment
 from trac.core import TracError, implements
 from trac.resource import ResourceNotFound
-from trac.test import EnvironmentStub
-from trac.util.datefmt import from_utimestamp, to_utimestamp, utc
+from trac.test import EnvironmentStub, Mock
+from trac.util.datefmt import from_utimestamp, to_utimestamp, to_timestamp, utc
 
 from mailinglistplugin.api import MailinglistSystem
 from mailinglistplugin.perm import MailinglistPermissionPolicy
-from mailinglistplugin.model import Mailinglist, Mailinglist
+from mailinglistplugin.threader import MailinglistThreadResolver
+from mailinglistplugin.directory import MailinglistSenderDirectory, MailinglistMembership
+from mailinglistplugin.search import MailinglistSearchIndex
+from mailinglistplugin.timeline import MailinglistTimelineCache
+from mailinglistplugin.duplicates import MailinglistDuplicateFilter
+from mailinglistplugin.storage import DatabaseRawStorage, FileRawStorage
+from mailinglistplugin.admin import MailinglistAdmin
+from mailinglistplugin.model import Mailinglist, MailinglistConversation, MailinglistMessage, ModelIdentityMap, \
+     MailinglistRawMessage, select_attachments, select_first_snippets
+from mailinglistplugin.utils import encode_page_token, decode_page_token, LRUCache, \
+     decode_thread_index, search_terms, highlight_excerpt, make_snippet, BloomFilter
 
 from testdata import rawmsgs, raw_message_with_attachment
 
@@ -35,6 +47,15 @@ class MailinglistTestCase(unittest.TestCase):
         self.env = EnvironmentStub(enable=[MailinglistPermissionPolicy,
                                            DefaultPermissionPolicy,
                                            MailinglistSystem,
+                                           MailinglistThreadResolver,
+                                           MailinglistSenderDirectory,
+                                           MailinglistMembership,
+                                           MailinglistSearchIndex,
+                                           MailinglistTimelineCache,
+                                           MailinglistDuplicateFilter,
+                                           DatabaseRawStorage,
+                                           FileRawStorage,
+                                           MailinglistAdmin,
                                            DefaultPermissionStore,
                                            SQLiteConnector])
         self.env.config.set('trac', 'permission_policies', 'MailinglistPermissionPolicy, DefaultPermissionPolicy')
@@ -148,7 +169,7 @@ class MailinglistTestCase(unittest.TestCase):
                                   postperm="OPEN")
         mailinglist.insert()
         
-        mailinglist.insert_raw_email(raw_message_with_attachment % dict(sender="Jack Sparrow",
+        inserted = mailinglist.insert_raw_email(raw_message_with_attachment % dict(sender="Jack Sparrow",
                                                                         email="jack@example.com",
                                                                         list="list1",
                                                                         domain="example.com",
@@ -156,13 +177,59 @@ class MailinglistTestCase(unittest.TestCase):
                                                                         asctime=time.asctime(),
                                                                         id="asdfasdf",
                                                                         body="Need images of boats."))
+        assert inserted.attachment_count == 1
         
         message = mailinglist.conversations().next().messages().next()
+        assert message.attachment_count == 1
+        other = mailinglist.insert_raw_email(rawmsgs[3] % dict(sender="Will Turner",
+                                                               email="will@example.com",
+                                                               list="list1",
+                                                               domain="example.com",
+                                                               subject="Boats",
+                                                               asctime=time.asctime(),
+                                                               body="Have boats."))
+        attachments = select_attachments(self.env, [message, other])
+        assert attachments.keys() == [message.id]
+        assert [a.filename for a in attachments[message.id]] == \
+               [a.filename for a in Attachment.select(self.env, message.resource.realm, message.resource.id)]
         attachment_path = Attachment.select(self.env, message.resource.realm, message.resource.id).next().path
         assert os.path.exists(attachment_path)        
         message.delete()
         assert not os.path.exists(attachment_path)
 
+    def test_sender_directory(self):
+        directory = MailinglistSenderDirectory(self.env)
+        session = DetachedSession(self.env, 'sparrowj')
+        session['email'] = 'Jack@Example.com'
+        session.save()
+        directory.invalidate()
+        assert directory.username('jack@example.com') == 'sparrowj'
+        assert directory.username('will@example.com') is None
+
+        mailinglist = Mailinglist(self.env,
+                                  emailaddress="LIST1", name="Sample List 1", private=True,
+                                  postperm="OPEN")
+        mailinglist.insert()
+        message = mailinglist.insert_raw_email(raw_message_with_attachment % dict(sender="Jack Sparrow",
+                                                                                  email="jack@example.com",
+                                                                                  list="list1",
+                                                                                  domain="example.com",
+                                                                                  subject="Boats",
+                                                                                  asctime=time.asctime(),
+                                                                                  body="Need boats."))
+        attachment = Attachment.select(self.env, message.resource.realm, message.resource.id).next()
+        assert attachment.author == 'sparrowj'
+        attachment.delete()
+        assert MailinglistMessage(self.env, message.id).attachment_count == 0
+
+        # a user's next request after changing their address refreshes the map
+        session['email'] = 'captain@example.com'
+        session.save()
+        req = Mock(authname='sparrowj', session=session)
+        directory.pre_process_request(req, None)
+        assert directory.username('jack@example.com') is None
+        assert directory.username('captain@example.com') == 'sparrowj'
+
     def test_add_list_member(self):
         mailinglist = Mailinglist(self.env,
                                   emailaddress="LIST1", private=True, postperm="MEMBERS")
@@ -245,6 +312,30 @@ class MailinglistTestCase(unittest.TestCase):
         mailinglist.unsubscribe(group="group1")
         assert "sparrowj" not in mailinglist.subscribers()        
 
+    def test_subscribers_cached(self):
+        mailinglist = Mailinglist(self.env,
+                                  emailaddress="LIST1", private=True, postperm="MEMBERS")
+        mailinglist.insert()
+        mailinglist.subscribe(group="group1", poster=True)
+        assert mailinglist.subscribers() == {}
+        # permissions are edited in the web admin
+        session = {}
+        membership = MailinglistMembership(self.env)
+        membership.pre_process_request(Mock(path_info='/admin/general/perm', method='GET',
+                                            session=session), None)
+        membership.pre_process_request(Mock(path_info='/admin/general/perm', method='POST',
+                                            session=session), None)
+        PermissionSystem(self.env).grant_permission('sparrowj', 'group1')
+        assert mailinglist.subscribers() == {}
+        membership.pre_process_request(Mock(path_info='/admin/general/perm', method='GET',
+                                            session=session), None)
+        assert mailinglist.subscribers()["sparrowj"]['groups'] == ['group1']
+        assert session == {}
+        mailinglist.update_poster(group="group1", poster=False)
+        assert not mailinglist.subscribers()["sparrowj"]['poster']
+        mailinglist.unsubscribe(user="sparrowj")
+        assert not mailinglist.is_subscribed("sparrowj")
+
     def test_read_private_list_accepted(self):
         mailinglist = Mailinglist(self.env,
                                   emailaddress="LIST1", private=True, postperm="RESTRICTED")
@@ -254,6 +345,85 @@ class MailinglistTestCase(unittest.TestCase):
         PermissionCache(self.env, 'sparrowj',
                         mailinglist.resource).assert_permission('MAILINGLIST_VIEW')
 
+    def test_permission_decisions_per_list(self):
+        mailinglist = Mailinglist(self.env,
+                                  emailaddress="LIST1", private=True, postperm="MEMBERS")
+        mailinglist.insert()
+        mailinglist.subscribe(user="sparrowj", poster=True)
+        # decided from the list part of the id, the message is not loaded
+        message = mailinglist.resource.child('mailinglist', "list1/1/1")
+        policy = MailinglistPermissionPolicy(self.env)
+        req = Mock()
+        policy.pre_process_request(req, None)
+        assert 'MAILINGLIST_VIEW' in PermissionCache(self.env, 'sparrowj', message)
+        assert 'MAILINGLIST_POST' not in PermissionCache(self.env, 'smithj', message)
+        mailinglist.subscribe(user="smithj", poster=True)
+        # remembered for the rest of the request
+        assert 'MAILINGLIST_POST' not in PermissionCache(self.env, 'smithj', message)
+        assert 'MAILINGLIST_POST' in PermissionCache(self.env, 'sparrowj', message)
+        del req
+        gc.collect()
+        assert 'MAILINGLIST_POST' in PermissionCache(self.env, 'smithj', message)
+        assert MailinglistPermissionPolicy._local.decisions is None
+
+    def test_viewable_lists(self):
+        mailinglist = Mailinglist(self.env,
+                                  emailaddress="LIST1", private=True, postperm="MEMBERS")
+        mailinglist.insert()
+        public = Mailinglist(self.env,
+                             emailaddress="LIST2", private=False, postperm="MEMBERS")
+        public.insert()
+        mailinglist.subscribe(user="sparrowj", poster=True)
+        PermissionSystem(self.env).grant_permission('sparrowj', 'MAILINGLIST_VIEW')
+        policy = MailinglistPermissionPolicy(self.env)
+        lists = [mailinglist, public]
+        assert policy.viewable_lists(PermissionCache(self.env, 'sparrowj'), lists) \
+               == set([mailinglist.id, public.id])
+        assert policy.viewable_lists(PermissionCache(self.env, 'smithj'), lists) == set()
+        # another policy could decide per message
+        self.env.config.set('mailinglist', 'list_level_policies', 'DefaultPermissionPolicy')
+        assert policy.viewable_lists(PermissionCache(self.env, 'sparrowj'), lists) is None
+
+    def test_members_table(self):
+        mailinglist = Mailinglist(self.env,
+                                  emailaddress="LIST1", private=True, postperm="MEMBERS")
+        mailinglist.insert()
+        public = Mailinglist(self.env,
+                             emailaddress="LIST2", private=False, postperm="MEMBERS")
+        public.insert()
+        membership = MailinglistMembership(self.env)
+        PermissionSystem(self.env).grant_permission('sparrowj', 'group1')
+        mailinglist.subscribe(group="group1", poster=False)
+        mailinglist.subscribe(user="smithj", poster=True)
+        assert membership.member(mailinglist, "sparrowj") == (False, False)
+        assert membership.member(mailinglist, "smithj") == (True, False)
+        assert membership.member(mailinglist, "pipern") is None
+        mailinglist.unsubscribe(user="smithj")
+        assert membership.member(mailinglist, "smithj") is None
+        mailinglist.update_poster(group="group1", poster=True)
+        assert membership.member(mailinglist, "sparrowj") == (True, False)
+
+        # group changes are picked up by the web admin
+        PermissionSystem(self.env).grant_permission('pipern', 'group1')
+        assert membership.member(mailinglist, "pipern") is None
+        membership.pre_process_request(Mock(path_info='/mailinglist', method='GET',
+                                            session={'mailinglist_sync_members': '1'}), None)
+        assert membership.member(mailinglist, "pipern") == (True, False)
+        assert membership.update_members() == 0
+
+        assert [m.id for m in Mailinglist.select_visible(self.env, "pipern")] == [mailinglist.id, public.id]
+        assert [m.id for m in Mailinglist.select_visible(self.env, "pipern", public=False)] == [mailinglist.id]
+        assert [m.id for m in Mailinglist.select_visible(self.env, "smithj")] == [public.id]
+        policy = MailinglistPermissionPolicy(self.env)
+        PermissionSystem(self.env).grant_permission('pipern', 'MAILINGLIST_VIEW')
+        assert [m.id for m in policy.visible_lists(PermissionCache(self.env, "pipern"))] == [mailinglist.id, public.id]
+        # other policies are asked about every list
+        self.env.config.set('mailinglist', 'list_level_policies', 'MailinglistPermissionPolicy')
+        assert [m.id for m in policy.visible_lists(PermissionCache(self.env, "pipern"))] == [mailinglist.id, public.id]
+        assert [m.id for m in policy.visible_lists(PermissionCache(self.env, "smithj"))] == []
+        mailinglist.delete()
+        assert membership.member(mailinglist, "pipern") is None
+
     def test_read_nonprivate_list_accepted(self):
         PermissionSystem(self.env).grant_permission('members', 'MAILINGLIST_VIEW')
         PermissionSystem(self.env).grant_permission('randomuser', 'members')
@@ -286,3 +456,619 @@ class MailinglistTestCase(unittest.TestCase):
         mailinglist.subscribe(user="sparrowj", poster=True)
         PermissionCache(self.env, 'randomuser',
                         mailinglist.resource).assert_permission('MAILINGLIST_VIEW')
+
+    def _insert_sample_message(self):
+        mailinglist = Mailinglist(self.env,
+                                  emailaddress="LIST1", name="Sample List 1", private=True,
+                                  postperm="OPEN")
+        mailinglist.insert()
+        return mailinglist.insert_raw_email(rawmsgs[0] % dict(sender="Jack Sparrow",
+                                                              email="jack@example.com",
+                                                              list="list1",
+                                                              domain="example.com",
+                                                              subject="Boats",
+                                                              asctime=time.asctime(),
+                                                              id="asdfasdf",
+                                                              body="Need boats."))
+
+    def test_identity_map_loads_rows_once(self):
+        message = self._insert_sample_message()
+        idmap = ModelIdentityMap.activate(self.env)
+        try:
+            MailinglistMessage(self.env, message.id)
+            @self.env.with_transaction()
+            def do_delete(db):
+                cursor = db.cursor()
+                cursor.execute("DELETE FROM mailinglistmessages")
+                cursor.execute("DELETE FROM mailinglistconversations")
+                cursor.execute("DELETE FROM mailinglist")
+            found = MailinglistMessage(self.env, str(message.id))
+            assert found.subject == message.subject
+            assert found.conversation.mailinglist.emailaddress == "list1"
+        finally:
+            idmap.deactivate()
+        assert ModelIdentityMap.current(self.env) is None
+
+    def test_identity_map_ends_with_request(self):
+        message = self._insert_sample_message()
+        req = Mock()
+        MailinglistSystem(self.env).pre_process_request(req, None)
+        MailinglistMessage(self.env, message.id)
+        assert ModelIdentityMap.current(self.env).get('mailinglistmessages', message.id)
+        # the next request starts afresh
+        other = Mock()
+        MailinglistSystem(self.env).pre_process_request(other, None)
+        assert ModelIdentityMap.current(self.env).get('mailinglistmessages', message.id) is None
+        # and a freed request ends its map, as trac collects it
+        del other
+        gc.collect()
+        assert ModelIdentityMap.current(self.env) is None
+
+    @raises(ResourceNotFound)
+    def test_identity_map_inactive(self):
+        message = self._insert_sample_message()
+        MailinglistMessage(self.env, message.id)
+        @self.env.with_transaction()
+        def do_delete(db):
+            db.cursor().execute("DELETE FROM mailinglistmessages")
+        MailinglistMessage(self.env, message.id)
+
+    def test_identity_map_forgets_changes(self):
+        message = self._insert_sample_message()
+        idmap = ModelIdentityMap.activate(self.env)
+        try:
+            mailinglist = Mailinglist(self.env, message.conversation.mailinglist.id)
+            mailinglist.name = "Renamed"
+            mailinglist.save_changes()
+            assert Mailinglist(self.env, mailinglist.id).name == "Renamed"
+        finally:
+            idmap.deactivate()
+
+    def test_list_messages_hydrated(self):
+        mailinglist = Mailinglist(self.env,
+                                  emailaddress="LIST1", name="Sample List 1", private=True,
+                                  postperm="OPEN")
+        mailinglist.insert()
+        for subject in ("Boats", "Sails"):
+            mailinglist.insert_raw_email(rawmsgs[0] % dict(sender="Jack Sparrow",
+                                                           email="jack@example.com",
+                                                           list="list1",
+                                                           domain="example.com",
+                                                           subject=subject,
+                                                           asctime=time.asctime(),
+                                                           id=subject,
+                                                           body="Need boats."))
+        messages = list(mailinglist.messages())
+        assert len(messages) == 2
+        for message in messages:
+            assert message.conversation.mailinglist is mailinglist
+            assert message.conversation.subject == message.subject
+            assert message.resource.id == "list1/%s/%s" % (message.conversation.id, message.id)
+        assert [m.subject for m in mailinglist.messages(insubject="Sail")] == ["Sails"]
+        conversation = mailinglist.conversations().next()
+        assert conversation.mailinglist is mailinglist
+        assert conversation.messages().next().conversation is conversation
+
+    def test_conversations_keyset_pages(self):
+        mailinglist = Mailinglist(self.env,
+                                  emailaddress="LIST1", name="Sample List 1", private=True,
+                                  postperm="OPEN")
+        mailinglist.insert()
+        start = datetime(2010, 11, 9, tzinfo=utc)
+        for i in range(7):
+            # pairs of conversations share a date, so the id breaks ties
+            MailinglistConversation(self.env, mailinglist=mailinglist,
+                                    date=start + timedelta(days=i // 2),
+                                    subject="Conversation %d" % i).insert()
+        expected = [c.id for c in mailinglist.conversations()]
+        assert len(expected) == 7
+
+        seen = []
+        after = None
+        while True:
+            page = list(mailinglist.conversations(limit=3, after=after))
+            if not page:
+                break
+            seen.extend(c.id for c in page)
+            after = (to_timestamp(page[-1].date), page[-1].id)
+        assert seen == expected
+
+        keys = [(to_timestamp(c.date), c.id) for c in mailinglist.conversations()]
+        tail = list(mailinglist.conversations(after=keys[2]))
+        assert [c.id for c in tail] == expected[3:]
+        back = list(mailinglist.conversations(limit=2, before=keys[4]))
+        assert [c.id for c in back] == expected[2:4]
+        oldest_first = list(mailinglist.conversations(desc=False, limit=2, after=keys[4]))
+        assert [c.id for c in oldest_first] == [expected[3], expected[2]]
+
+    def test_page_tokens(self):
+        token = encode_page_token(1289322524, 42)
+        assert decode_page_token(token) == (1289322524, 42)
+        assert "=" not in token
+
+    @raises(ValueError)
+    def test_invalid_page_token(self):
+        decode_page_token("not a token")
+
+    def test_counters(self):
+        message = self._insert_sample_message()
+        mailinglist = Mailinglist(self.env, message.conversation.mailinglist.id)
+        reply = mailinglist.insert_raw_email(rawmsgs[1] % dict(sender="Will Turner",
+                                                               email="will@example.com",
+                                                               list="list1",
+                                                               domain="example.com",
+                                                               subject="Re: Boats",
+                                                               asctime="Tue, 09 Nov 2010 17:08:44 +0000",
+                                                               id="asdfasdf",
+                                                               body="Have boats."))
+        assert reply.conversation.id == message.conversation.id
+        conversation = MailinglistConversation(self.env, message.conversation.id)
+        assert conversation.count_messages() == 2
+        assert conversation.get_first().id == message.id
+        mailinglist = Mailinglist(self.env, mailinglist.id)
+        assert mailinglist.count_conversations() == 1
+        assert mailinglist.count_messages() == 2
+        # the reply is dated in 2010, so the first message stays the last
+        assert mailinglist.last_poster == "Jack Sparrow"
+        assert conversation.last_date == message.date
+
+        @self.env.with_transaction()
+        def do_corrupt(db):
+            cursor = db.cursor()
+            cursor.execute("UPDATE mailinglist SET message_count = 42")
+            cursor.execute("UPDATE mailinglistconversations SET message_count = 42, first = NULL")
+        mailinglist.rebuild_counters()
+        assert Mailinglist(self.env, mailinglist.id).count_messages() == 2
+        conversation = MailinglistConversation(self.env, conversation.id)
+        assert conversation.count_messages() == 2
+        # the message that started it, though the reply is dated earlier
+        assert conversation.get_first().id == message.id
+        assert select_first_snippets(self.env, [conversation]) == {conversation.id: u"Need boats."}
+
+        MailinglistMessage(self.env, message.id).delete()
+        conversation = MailinglistConversation(self.env, conversation.id)
+        assert conversation.count_messages() == 1
+        assert conversation.last_poster == "Will Turner"
+        assert Mailinglist(self.env, mailinglist.id).count_messages() == 1
+        conversation.delete()
+        mailinglist = Mailinglist(self.env, mailinglist.id)
+        assert mailinglist.count_conversations() == 0
+        assert mailinglist.count_messages() == 0
+        assert mailinglist.last_date is None
+
+    def test_schema_upgrade(self):
+        message = self._insert_sample_message()
+        message.conversation.mailinglist.subscribe(user="sparrowj", poster=True)
+        db = self.env.get_db_cnx()
+        assert not self.mailinglist_system.environment_needs_upgrade(db)
+        cursor = db.cursor()
+        for index in ('mailinglistmessages_list_msg_id_idx',
+                      'mailinglistmessages_list_date_idx',
+                      'mailinglistmessages_conversation_date_idx',
+                      'mailinglistconversations_list_date_idx',
+                      'mailinglistconversations_list_normalized_subject_idx',
+                      'mailinglistconversations_list_thread_guid_idx'):
+            cursor.execute("DROP INDEX %s" % index)
+        for column in ('normalized_subject', 'thread_guid'):
+            cursor.execute("ALTER TABLE mailinglistconversations DROP COLUMN %s" % column)
+        for column in ('snippet', 'attachment_count'):
+            cursor.execute("ALTER TABLE mailinglistmessages DROP COLUMN %s" % column)
+        cursor.execute("DROP TABLE mailinglistmembers")
+        cursor.execute("DROP TABLE mailinglisttimeline")
+        raw = message.raw.bytes
+        cursor.execute("ALTER TABLE mailinglistraw ADD COLUMN raw text")
+        cursor.execute("UPDATE mailinglistraw SET raw = %s", (raw.decode('utf-8'),))
+        cursor.execute("DROP INDEX mailinglistraw_location_idx")
+        cursor.execute("DROP INDEX mailinglistraw_hash_idx")
+        cursor.execute("ALTER TABLE mailinglist DROP COLUMN skip_duplicates")
+        cursor.execute("DROP INDEX mailinglistmessages_raw_idx")
+        for column in ('data', 'encoding', 'size', 'storage', 'location', 'hash'):
+            cursor.execute("ALTER TABLE mailinglistraw DROP COLUMN %s" % column)
+        cursor.execute("UPDATE system SET value = '2' WHERE name = 'mailinglist_version'")
+        assert self.mailinglist_system.environment_needs_upgrade(db)
+        self.mailinglist_system.upgrade_environment(db)
+        assert not self.mailinglist_system.environment_needs_upgrade(db)
+        cursor.execute("SELECT count(*) FROM sqlite_master WHERE type = 'index' "
+                       "AND name LIKE 'mailinglist%%_date_idx'")
+        assert cursor.fetchone()[0] == 3
+        cursor.execute("SELECT normalized_subject FROM mailinglistconversations WHERE id = %s",
+                       (message.conversation.id,))
+        assert cursor.fetchone()[0] == "boats"
+        cursor.execute("SELECT username, poster, declined FROM mailinglistmembers")
+        assert cursor.fetchall() == [("sparrowj", 1, 0)]
+        cursor.execute("SELECT snippet FROM mailinglistmessages WHERE id = %s", (message.id,))
+        assert cursor.fetchone()[0] == make_snippet(message.body)
+        cursor.execute("SELECT attachment_count FROM mailinglistmessages WHERE id = %s", (message.id,))
+        assert cursor.fetchone()[0] == 0
+        assert message.raw.bytes == raw
+        cursor.execute("SELECT raw, encoding, size FROM mailinglistraw")
+        assert cursor.fetchall() == [(None, "zlib", len(raw))]
+        cursor.execute("SELECT hash FROM mailinglistraw")
+        assert cursor.fetchall() == [(hashlib.sha1(raw).hexdigest(),)]
+        assert message.conversation.mailinglist.skip_duplicates is False
+
+    def test_snippet(self):
+        body = ("Will do.\n\nOn Monday, Will Turner wrote:\n> Have boats?\n>\n"
+                "Bring   sails.\n-- \nJack")
+        assert make_snippet(body) == "Will do. Bring sails."
+        assert make_snippet("> only quoted") == "> only quoted"
+        assert make_snippet("x" * 300) == "x" * 200
+        assert make_snippet(None) == ""
+        message = self._insert_sample_message()
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT snippet FROM mailinglistmessages WHERE id = %s", (message.id,))
+        assert cursor.fetchone()[0] == make_snippet(message.body)
+
+    def test_outlook_threading(self):
+        message = self._insert_sample_message()
+        mailinglist = message.conversation.mailinglist
+        headers = dict(sender="Will Turner",
+                       email="will@example.com",
+                       list="list1",
+                       domain="example.com",
+                       asctime=time.asctime(),
+                       body="Have boats.")
+        reply = mailinglist.insert_raw_email(rawmsgs[3] % dict(headers, subject="SV: [list1] RE:  boats"))
+        assert reply.conversation.id == message.conversation.id
+        other = mailinglist.insert_raw_email(rawmsgs[3] % dict(headers, subject="RE: Sails"))
+        assert other.conversation.id != message.conversation.id
+        self.env.config.set('mailinglist', 'outlook_thread_window', 1)
+        later = mailinglist.insert_raw_email(rawmsgs[3] % dict(headers, subject="RE: Boats",
+                                                               asctime=time.asctime(time.localtime(time.time() + 3 * 86400))))
+        assert later.conversation.id != message.conversation.id
+
+    def test_thread_index(self):
+        guid = "0123456789abcdef0123456789abcdef"
+        root = ("01cb9a7c45d3" + guid).decode('hex')
+        child = root + "0000a1b2c3".decode('hex')
+        assert decode_thread_index(root.encode('base64')) == guid
+        assert decode_thread_index(child.encode('base64')) == guid
+        assert decode_thread_index(root[:-1].encode('base64')) is None
+        assert decode_thread_index("Boats") is None
+        assert decode_thread_index(None) is None
+
+        mailinglist = Mailinglist(self.env,
+                                  emailaddress="LIST1", name="Sample List 1", private=True,
+                                  postperm="OPEN")
+        mailinglist.insert()
+        headers = dict(sender="Jack Sparrow",
+                       email="jack@example.com",
+                       list="list1",
+                       domain="example.com",
+                       asctime=time.asctime(),
+                       body="Need boats.")
+        message = mailinglist.insert_raw_email((rawmsgs[3] % dict(headers, subject="Boats"))
+                                               .replace("Thread-Index: Boats",
+                                                        "Thread-Index: " + root.encode('base64').strip()))
+        assert message.conversation.thread_guid == guid
+        # the subject changed, but the thread index still matches
+        reply = mailinglist.insert_raw_email((rawmsgs[3] % dict(headers, subject="Sails"))
+                                             .replace("Thread-Index: Sails",
+                                                      "Thread-Index: " + child.encode('base64').strip()))
+        assert reply.conversation.id == message.conversation.id
+
+    def test_thread_resolver(self):
+        message = self._insert_sample_message()
+        mailinglist = message.conversation.mailinglist
+        resolver = MailinglistThreadResolver(self.env)
+        assert resolver.resolve(mailinglist, ["<asdfasdf@example.com>"]) == message.conversation.id
+        assert resolver.resolve(mailinglist, ["<unknown@example.com>"]) is None
+        # earlier references win, also over cached ones
+        other = mailinglist.insert_raw_email(rawmsgs[0] % dict(sender="Jack Sparrow",
+                                                               email="jack@example.com",
+                                                               list="list1",
+                                                               domain="example.com",
+                                                               subject="Sails",
+                                                               asctime=time.asctime(),
+                                                               id="other",
+                                                               body="Need sails."))
+        resolver._reset()
+        assert resolver.resolve(mailinglist, ["<unknown@example.com>",
+                                              "<other@example.com>",
+                                              "<asdfasdf@example.com>"]) == other.conversation.id
+        reply = mailinglist.insert_raw_email(rawmsgs[2] % dict(sender="Will Turner",
+                                                               email="will@example.com",
+                                                               list="list1",
+                                                               domain="example.com",
+                                                               subject="Re: Boats",
+                                                               id="asdfasdf",
+                                                               body="Have boats."))
+        assert reply.conversation.id == message.conversation.id
+        message.conversation.delete()
+        assert resolver.resolve(mailinglist, ["<asdfasdf@example.com>"]) is None
+        # without a cache every lookup asks the database
+        self.env.config.set('mailinglist', 'thread_cache_size', '0')
+        resolver._cache = LRUCache(resolver.cache_size)
+        resolver._reset()
+        assert resolver.resolve(mailinglist, ["<other@example.com>"]) == other.conversation.id
+        assert resolver.resolve(mailinglist, ["<other@example.com>"]) == other.conversation.id
+        assert len(resolver._cache) == 0
+
+    def test_search_index(self):
+        message = self._insert_sample_message()
+        mailinglist = message.conversation.mailinglist
+        index = MailinglistSearchIndex(self.env)
+        # without the index, LIKE matching is used
+        assert [row[0] for row in index.search(["boat"], [mailinglist.id])[0]] == [message.id]
+        assert index.rebuild()
+        assert [row[0] for row in index.search(["boat"], [mailinglist.id])[0]] == [message.id]
+        assert index.search(["boat"], [mailinglist.id + 1])[0] == []
+        reply = mailinglist.insert_raw_email(rawmsgs[1] % dict(sender="Will Turner",
+                                                               email="will@example.com",
+                                                               list="list1",
+                                                               domain="example.com",
+                                                               subject="Re: Boats",
+                                                               asctime=time.asctime(),
+                                                               id="asdfasdf",
+                                                               body="Have some boats, and sails."))
+        assert [row[0] for row in index.search(["sails"], [mailinglist.id])[0]] == [reply.id]
+        assert [row[0] for row in index.search(["boats", "will"], [mailinglist.id])[0]] == [reply.id]
+        assert sorted([row[0] for row in index.search(["boats"], [mailinglist.id])[0]]) == [message.id, reply.id]
+        reply.body = "Have some masts."
+        reply.save_changes()
+        assert index.search(["sails"], [mailinglist.id])[0] == []
+        assert [row[0] for row in index.search(["masts"], [mailinglist.id])[0]] == [reply.id]
+        reply.delete()
+        assert index.search(["sails"], [mailinglist.id])[0] == []
+        message.conversation.delete()
+        assert index.search(["boats"], [mailinglist.id])[0] == []
+        other = mailinglist.insert_raw_email(rawmsgs[1] % dict(sender="Will Turner",
+                                                               email="will@example.com",
+                                                               list="list1",
+                                                               domain="example.com",
+                                                               subject="Re: Boats",
+                                                               asctime=time.asctime(),
+                                                               id="qwerty",
+                                                               body="Have some boats."))
+        mailinglist.delete()
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        # fails unless the index agrees with the messages
+        cursor.execute("INSERT INTO mailinglistmessages_fts (mailinglistmessages_fts, rank) "
+                       "VALUES ('integrity-check', 1)")
+        assert not index.environment_needs_upgrade(db)
+        # an index keeping its own copy of the text is replaced
+        cursor.execute("DROP TRIGGER mailinglistmessages_fts_insert")
+        assert index.environment_needs_upgrade(db)
+        index.upgrade_environment(db)
+        assert not index.environment_needs_upgrade(db)
+
+    def test_search_ranking_and_facets(self):
+        message = self._insert_sample_message()
+        mailinglist = message.conversation.mailinglist
+        index = MailinglistSearchIndex(self.env)
+        assert index.rebuild()
+        reply = mailinglist.insert_raw_email(rawmsgs[1] % dict(sender="Will Turner",
+                                                               email="will@example.com",
+                                                               list="list1",
+                                                               domain="example.com",
+                                                               subject="Re: Boats",
+                                                               asctime=time.asctime(),
+                                                               id="asdfasdf",
+                                                               body="Have some boats, and sails."))
+        year = datetime.now(utc).year
+        results, total, facets = index.search(["boats"], [mailinglist.id], limit=1, facets=True)
+        assert len(results) == 1 and total == 2
+        assert "\x02" in results[0][-1] and "\x03" in results[0][-1]
+        assert facets["list"] == [(mailinglist.id, 2)]
+        assert sorted(facets["sender"]) == [(message.from_email, 1), ("will@example.com", 1)]
+        assert [row[0] for row in index.search(["boats"], [mailinglist.id], offset=1, limit=1)[0]] \
+               == [row[0] for row in index.search(["boats"], [mailinglist.id])[0][1:]]
+        # a filter narrows the results, but not its own facet
+        results, total, facets = index.search(["boats"], [mailinglist.id],
+                                              sender="will@example.com", facets=True)
+        assert [row[0] for row in results] == [reply.id] and total == 1
+        assert len(facets["sender"]) == 2
+        assert facets["year"] == [(year, 1)]
+        assert index.search(["boats"], [mailinglist.id], year=year - 1)[1] == 0
+
+    def test_search_terms(self):
+        assert search_terms('boats "black pearl" -sails') == ["boats", "black pearl", "-sails"]
+        fragment = highlight_excerpt(u"a \x02boat\x03 and sails")
+        assert unicode(fragment) == u'a <em class="match">boat</em> and sails'
+
+    def test_timeline_cache(self):
+        message = self._insert_sample_message()
+        mailinglist = message.conversation.mailinglist
+        timeline = MailinglistTimelineCache(self.env)
+        now = to_timestamp(datetime.now(utc))
+        start, stop = now - 3 * 86400, now + 60
+        assert [row[0] for row in timeline.events([mailinglist.id], start, stop)] == [message.id]
+        # cached: a row changed behind its back is not seen
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("UPDATE mailinglistmessages SET subject = 'Sails' WHERE id = %s",
+                       (message.id,))
+        db.commit()
+        assert timeline.events([mailinglist.id], start, stop)[0][1] == message.subject
+        # but a new message drops today's buckets
+        headers = dict(sender="Will Turner", email="will@example.com", list="list1",
+                       domain="example.com", asctime=time.asctime(), body="Have boats.")
+        reply = mailinglist.insert_raw_email(rawmsgs[3] % dict(headers, subject="Re: Boats"))
+        events = timeline.events([mailinglist.id], start, stop)
+        assert sorted([row[0] for row in events]) == [message.id, reply.id]
+        assert "Sails" in [row[1] for row in events]
+        # and an older message the earlier days
+        old = mailinglist.insert_raw_email(rawmsgs[3] % dict(headers, subject="Masts",
+            asctime=time.asctime(time.localtime(time.time() - 2 * 86400))))
+        assert sorted([row[0] for row in timeline.events([mailinglist.id], start, stop)]) \
+               == sorted([message.id, reply.id, old.id])
+        assert [row[0] for row in timeline.events([mailinglist.id], start, now - 86400)] == [old.id]
+        # only the buckets of the day of a change are read again
+        cursor.execute("UPDATE mailinglistmessages SET subject = 'Rigging' WHERE id = %s",
+                       (old.id,))
+        db.commit()
+        older = mailinglist.insert_raw_email(rawmsgs[3] % dict(headers, subject="Hulls",
+            asctime=time.asctime(time.localtime(time.time() - 3 * 86400))))
+        events = dict((row[0], row[1]) for row in timeline.events([mailinglist.id], start, stop))
+        assert events[old.id] == "Masts"
+        assert older.id in events
+        reply.delete()
+        assert reply.id not in [row[0] for row in timeline.events([mailinglist.id], start, stop)]
+        # without a cache every bucket is read
+        self.env.config.set('mailinglist', 'timeline_cache_size', '0')
+        timeline._cache = LRUCache(timeline.cache_size)
+        assert sorted([row[0] for row in timeline.events([mailinglist.id], start, stop)]) \
+               == sorted([message.id, old.id, older.id])
+        assert len(timeline._cache) == 0
+
+    def test_raw_chunks(self):
+        message = self._insert_sample_message()
+        raw = message.raw
+        size = MailinglistRawMessage.size(self.env, raw.id)
+        assert size == len(raw.bytes)
+        chunk_size = MailinglistRawMessage.chunk_size
+        MailinglistRawMessage.chunk_size = 7
+        try:
+            chunks = list(MailinglistRawMessage.chunks(self.env, raw.id))
+            assert "".join(chunks) == raw.bytes
+            assert "".join(MailinglistRawMessage.chunks(self.env, raw.id, 10, 30)) == raw.bytes[10:30]
+        finally:
+            MailinglistRawMessage.chunk_size = chunk_size
+        # lengths and ranges are in bytes
+        raw = MailinglistRawMessage(self.env, mailinglist=message.conversation.mailinglist,
+                                    bytes=u"From: Bj\xf6rn")
+        raw.insert()
+        raw = MailinglistRawMessage(self.env, raw.id)
+        assert MailinglistRawMessage.size(self.env, raw.id) == len(raw.bytes) == 12
+        assert "".join(MailinglistRawMessage.chunks(self.env, raw.id, 8)) == raw.bytes[8:]
+
+    def test_raw_storage(self):
+        mailinglist = Mailinglist(self.env, emailaddress="LIST1", name="Sample List 1",
+                                  private=True, postperm="OPEN")
+        mailinglist.insert()
+        # 8 bit messages are kept as they are
+        bytes = "From: Bj\xf6rn\n\n" + "Boats, boats and more boats. " * 10000
+        raw = MailinglistRawMessage(self.env, mailinglist=mailinglist, bytes=bytes)
+        raw.insert()
+        assert MailinglistRawMessage(self.env, raw.id).bytes == bytes
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT encoding, length(data) FROM mailinglistraw WHERE id = %s", (raw.id,))
+        encoding, stored = cursor.fetchone()
+        assert encoding == "zlib" and stored < len(bytes) / 10
+        assert MailinglistRawMessage.size(self.env, raw.id) == len(bytes)
+        chunk_size = MailinglistRawMessage.chunk_size
+        MailinglistRawMessage.chunk_size = 100
+        try:
+            assert "".join(MailinglistRawMessage.chunks(self.env, raw.id)) == bytes
+            assert "".join(MailinglistRawMessage.chunks(self.env, raw.id, 1000, 250000)) \
+                   == bytes[1000:250000]
+            self.env.config.set('mailinglist', 'raw_compression', 'none')
+            plain = MailinglistRawMessage(self.env, mailinglist=mailinglist, bytes=bytes)
+            plain.insert()
+            assert MailinglistRawMessage(self.env, plain.id).bytes == bytes
+            assert "".join(MailinglistRawMessage.chunks(self.env, plain.id, 5, 1005)) \
+                   == bytes[5:1005]
+        finally:
+            MailinglistRawMessage.chunk_size = chunk_size
+
+    def test_raw_file_storage(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.env.config.set('mailinglist', 'raw_storage', 'FileRawStorage')
+            self.env.config.set('mailinglist', 'raw_storage_dir', directory)
+            message = self._insert_sample_message()
+            raw = message.raw
+            db = self.env.get_read_db()
+            cursor = db.cursor()
+            cursor.execute("SELECT storage, location, data FROM mailinglistraw WHERE id = %s",
+                           (raw.id,))
+            storage, location, data = cursor.fetchone()
+            assert storage == "FileRawStorage" and data is None
+            path = os.path.join(directory, location[:2], location[2:4], location)
+            assert os.path.isfile(path)
+            assert MailinglistRawMessage(self.env, raw.id).bytes == raw.bytes
+            assert "".join(MailinglistRawMessage.chunks(self.env, raw.id, 10, 30)) == raw.bytes[10:30]
+            # the same bytes share a file
+            copy = MailinglistRawMessage(self.env, mailinglist=raw.mailinglist, bytes=raw.bytes)
+            copy.insert()
+            copy.delete()
+            assert os.path.isfile(path)
+            storage = FileRawStorage(self.env)
+            os.utime(path, (0, 0))
+            assert storage.sweep() == 0
+            assert os.path.isfile(path)
+
+            MailinglistAdmin(self.env)._do_migrate_raw('DatabaseRawStorage')
+            assert MailinglistRawMessage(self.env, raw.id).bytes == raw.bytes
+            # unused files are only swept once they are old enough
+            os.utime(path, None)
+            assert storage.sweep() == 0
+            os.utime(path, (0, 0))
+            assert storage.sweep() == 1
+            assert not os.path.exists(path)
+            MailinglistAdmin(self.env)._do_migrate_raw('FileRawStorage')
+            assert os.path.isfile(path)
+            cursor.execute("SELECT data FROM mailinglistraw WHERE id = %s", (raw.id,))
+            assert cursor.fetchone()[0] is None
+            message.conversation.mailinglist.delete()
+            os.utime(path, (0, 0))
+            # left by an interrupted sweep
+            os.rename(path, path + '.sweep')
+            assert storage.sweep() == 1
+            assert os.listdir(os.path.dirname(path)) == []
+        finally:
+            shutil.rmtree(directory)
+
+    def test_raw_deduplication(self):
+        message = self._insert_sample_message()
+        list1 = message.conversation.mailinglist
+        list2 = Mailinglist(self.env, emailaddress="LIST2", name="Sample List 2",
+                            private=True, postperm="OPEN")
+        list2.insert()
+        # cross-posted
+        other = list2.insert_raw_email(message.raw.bytes)
+        assert other._raw == message._raw
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT count(*) FROM mailinglistraw")
+        assert cursor.fetchone()[0] == 1
+        # as when archiving failed after the raw message was stored
+        MailinglistRawMessage(self.env, mailinglist=list2, bytes=message.raw.bytes).insert()
+        list1.delete()
+        assert MailinglistRawMessage(self.env, other._raw).bytes == message.raw.bytes
+        other.delete()
+        cursor.execute("SELECT count(*) FROM mailinglistraw")
+        assert cursor.fetchone()[0] == 0
+
+    def test_skip_duplicates(self):
+        message = self._insert_sample_message()
+        mailinglist = message.conversation.mailinglist
+        raw = message.raw.bytes
+        assert mailinglist.insert_raw_email(raw) is not None
+        mailinglist.skip_duplicates = True
+        mailinglist.save_changes()
+        mailinglist = Mailinglist(self.env, mailinglist.id)
+        assert mailinglist.skip_duplicates
+        assert mailinglist.insert_raw_email(raw) is None
+        assert mailinglist.count_messages() == 2
+        assert mailinglist.has_message(message.msg_id)
+        assert not mailinglist.has_message("<unknown@example.com>")
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000)
+        for i in range(1000):
+            bloom.add("key%d" % i)
+        assert all(["key%d" % i in bloom for i in range(1000)])
+        false_positives = len([i for i in range(10000) if "other%d" % i in bloom])
+        assert false_positives < 300
+        assert u"\xf6" not in bloom
+        bloom.add(u"\xf6")
+        assert u"\xf6" in bloom
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache["a"] = 1
+        cache["b"] = 2
+        assert cache.get("a") == 1
+        cache["c"] = 3
+        assert "b" not in cache
+        assert cache.get("a") == 1 and cache.get("c") == 3
+        assert cache.pop("a") == 1
+        assert len(cache) == 1
+        disabled = LRUCache(0)
+        disabled["a"] = 1
+        disabled["b"] = 2
+        assert len(disabled) == 0 and disabled.get("a") is None
@@ -0,0 +1,118 @@
+from trac.core import Component, implements
+from trac.config import IntOption
+
+from mailinglistplugin.api import IMailinglistChangeListener, \
+     IMailinglistConversationChangeListener, IMailinglistMessageChangeListener
+from mailinglistplugin.utils import LRUCache
+
+class MailinglistThreadResolver(Component):
+    """Finds the conversation an incoming message replies to.
+
+    Keeps a bounded map from `(list id, Message-ID)` to conversation id,
+    warmed with the most recent messages on first use and kept up to
+    date as messages are archived. Message-IDs that are not in the map
+    are looked up together in one query.
+    """
+
+    implements(IMailinglistChangeListener, IMailinglistConversationChangeListener,
+               IMailinglistMessageChangeListener)
+
+    cache_size = IntOption('mailinglist', 'thread_cache_size', 10000,
+        """Number of Message-IDs whose conversation is kept in memory
+        for threading incoming mail, 0 to always ask the database.""")
+
+    def __init__(self):
+        self._cache = LRUCache(self.cache_size)
+        self._warm = False
+
+    def resolve(self, mailinglist, msg_ids):
+        """Return the id of the conversation in `mailinglist` holding the
+        first of `msg_ids` that has been archived, or `None`."""
+        if not self._warm:
+            self._warm_up()
+        misses = []
+        for msg_id in msg_ids:
+            conversation_id = self._cache.get((mailinglist.id, msg_id))
+            if conversation_id is not None:
+                break
+            misses.append(msg_id)
+        else:
+            conversation_id = None
+        if not misses:
+            return conversation_id
+        # a Message-ID earlier in the header wins over a cached one
+        found = self._lookup(mailinglist.id, misses)
+        for msg_id in misses:
+            if msg_id in found:
+                return found[msg_id]
+        return conversation_id
+
+    def forget(self, mailinglist, msg_id):
+        """Drop `msg_id` from the map, e.g. when it points to a
+        conversation that turned out to be gone."""
+        self._cache.pop((mailinglist.id, msg_id))
+
+    def _lookup(self, list_id, msg_ids):
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT msg_id, conversation FROM mailinglistmessages "
+                       "WHERE list = %%s AND msg_id IN (%s)" % ','.join(['%s'] * len(msg_ids)),
+                       [list_id] + list(msg_ids))
+        found = {}
+        for msg_id, conversation_id in cursor:
+            found.setdefault(msg_id, conversation_id)
+            self._cache[(list_id, msg_id)] = found[msg_id]
+        return found
+
+    def _warm_up(self):
+        self._warm = True
+        if self.cache_size <= 0:
+            return
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT list, msg_id, conversation FROM mailinglistmessages "
+                       "WHERE msg_id IS NOT NULL ORDER BY date DESC LIMIT %d" % self.cache_size)
+        # oldest first, so the most recent messages end up most recently used
+        for list_id, msg_id, conversation_id in reversed(cursor.fetchall()):
+            self._cache[(list_id, msg_id)] = conversation_id
+        self.log.debug("Warmed thread resolver with %d message ids", len(self._cache))
+
+    def _reset(self):
+        self._cache.clear()
+        self._warm = False
+
+    # IMailinglistChangeListener
+
+    def mailinglist_created(self, mailinglist):
+        pass
+
+    def mailinglist_changed(self, mailinglist):
+        pass
+
+    def mailinglist_deleted(self, mailinglist):
+        self._reset()
+
+    # IMailinglistConversationChangeListener
+
+    def mailinglistconversation_created(self, conversation):
+        pass
+
+    def mailinglistconversation_changed(self, conversation):
+        pass
+
+    def mailinglistconversation_deleted(self, conversation):
+        self._reset()
+
+    # IMailinglistMessageChangeListener
+
+    def mailinglistmessage_created(self, message):
+        if message.msg_id:
+            self._cache[(message.conversation.mailinglist.id, message.msg_id)] = \
+                message.conversation.id
+
+    def mailinglistmessage_changed(self, message):
+        pass
+
+    def mailinglistmessage_deleted(self, message):
+        if message.msg_id:
+            self._cache.pop((message.conversation.mailinglist.id, message.msg_id))
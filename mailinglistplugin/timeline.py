@@ -0,0 +1,191 @@
+from datetime import datetime
+
+from trac.core import Component, implements
+from trac.cache import cached
+from trac.config import IntOption
+from trac.util.datefmt import to_timestamp, utc
+
+from mailinglistplugin.api import IMailinglistChangeListener, \
+     IMailinglistConversationChangeListener, IMailinglistMessageChangeListener
+from mailinglistplugin.utils import LRUCache
+
+DAY = 86400
+
+class MailinglistTimelineCache(Component):
+    """Keeps the messages shown by the timeline, per list and UTC day.
+
+    Days before today rarely change, so their buckets are kept until a
+    message dated on such a day is archived, changed or removed. Each
+    such bucket has a generation in the `mailinglisttimeline` table,
+    raised when one of its messages changes, along with one generation
+    shared between processes for all past days. Only when the latter
+    has changed are the generations of the cached buckets read, and
+    only those that differ are read again. Today's buckets are dropped
+    whenever a message arrives, by another shared generation.
+    """
+
+    implements(IMailinglistChangeListener, IMailinglistConversationChangeListener,
+               IMailinglistMessageChangeListener)
+
+    cache_size = IntOption('mailinglist', 'timeline_cache_size', 5000,
+        """Number of (day, list) buckets of timeline messages kept in
+        memory, 0 to read them from the database every time.""")
+
+    def __init__(self):
+        self._cache = LRUCache(self.cache_size)
+
+    # A new token every time the generation is invalidated, possibly
+    # by another process; buckets remember the token they were read under.
+
+    @cached
+    def _past_generation(self, db):
+        return object()
+
+    @cached
+    def _today_generation(self, db):
+        return object()
+
+    def events(self, list_ids, start, stop):
+        """Return the rows `(id, subject, snippet, from_name, from_email,
+        date, list, conversation)` of the messages in the lists with
+        `list_ids` dated from `start` to `stop`, both timestamps."""
+        today = to_timestamp(datetime.now(utc)) // DAY
+        past, current = self._past_generation, self._today_generation
+        buckets = {}
+        missing = set()
+        stale = {}
+        for day in range(start // DAY, stop // DAY + 1):
+            for list_id in list_ids:
+                key = (day, list_id)
+                entry = self._cache.get(key)
+                if entry is None:
+                    missing.add(key)
+                elif entry[0] is (day < today and past or current):
+                    buckets[key] = entry[2]
+                elif day < today and entry[1] is not None:
+                    stale[key] = entry
+                else:
+                    missing.add(key)
+
+        # read before the messages, so a change committed in between
+        # makes the bucket stale
+        generations = self._generations([key for key in missing if key[0] < today]
+                                        + stale.keys())
+        for key, entry in stale.iteritems():
+            if generations.get(key, 0) == entry[1]:
+                self._cache[key] = (past, entry[1], entry[2])
+                buckets[key] = entry[2]
+            else:
+                missing.add(key)
+
+        if missing:
+            for key in missing:
+                buckets[key] = []
+            db = self.env.get_read_db()
+            cursor = db.cursor()
+            # one query per run of consecutive days with missing buckets,
+            # so the cached days between them are not read again
+            runs = []
+            for day in sorted(set([day for day, list_id in missing])):
+                if runs and runs[-1][1] == day - 1:
+                    runs[-1][1] = day
+                else:
+                    runs.append([day, day])
+            for first, last in runs:
+                lists = set([list_id for day, list_id in missing if first <= day <= last])
+                cursor.execute("SELECT id, subject, snippet, from_name, from_email, date, list, "
+                               "conversation FROM mailinglistmessages "
+                               "WHERE date >= %%s AND date < %%s AND list IN (%s)"
+                               % ','.join(['%s'] * len(lists)),
+                               [first * DAY, (last + 1) * DAY] + list(lists))
+                for row in cursor:
+                    key = (row[5] // DAY, row[6])
+                    if key in missing:
+                        buckets[key].append(row)
+            for key in missing:
+                # days to come are still being written
+                if key[0] < today:
+                    self._cache[key] = (past, generations.get(key, 0), buckets[key])
+                elif key[0] == today:
+                    self._cache[key] = (current, None, buckets[key])
+
+        events = []
+        for rows in buckets.itervalues():
+            events.extend([row for row in rows if start <= row[5] <= stop])
+        return events
+
+    def _generations(self, keys):
+        if not keys:
+            return {}
+        days = [day for day, list_id in keys]
+        lists = set([list_id for day, list_id in keys])
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT day, list, generation FROM mailinglisttimeline "
+                       "WHERE day >= %%s AND day <= %%s AND list IN (%s)"
+                       % ','.join(['%s'] * len(lists)),
+                       [min(days), max(days)] + list(lists))
+        return dict(((day, list_id), generation) for day, list_id, generation in cursor)
+
+    def _invalidate(self, list_id, timestamps):
+        """Drop the buckets of the list with `list_id` on the days of
+        `timestamps`."""
+        today = to_timestamp(datetime.now(utc)) // DAY
+        days = set([timestamp // DAY for timestamp in timestamps])
+        past = [day for day in days if day < today]
+        if past:
+            @self.env.with_transaction()
+            def do_invalidate(db):
+                cursor = db.cursor()
+                for day in sorted(past):
+                    cursor.execute("UPDATE mailinglisttimeline SET generation = generation + 1 "
+                                   "WHERE list = %s AND day = %s", (list_id, day))
+                    cursor.execute("SELECT generation FROM mailinglisttimeline "
+                                   "WHERE list = %s AND day = %s", (list_id, day))
+                    if not cursor.fetchone():
+                        cursor.execute("INSERT INTO mailinglisttimeline (list, day, generation) "
+                                       "VALUES (%s, %s, 1)", (list_id, day))
+            del self._past_generation
+        if len(past) < len(days):
+            del self._today_generation
+
+    def _invalidate_message(self, message):
+        self._invalidate(message.conversation.mailinglist.id, [to_timestamp(message.date)])
+
+    # IMailinglistChangeListener
+
+    def mailinglist_created(self, mailinglist):
+        pass
+
+    def mailinglist_changed(self, mailinglist):
+        pass
+
+    def mailinglist_deleted(self, mailinglist):
+        self._invalidate(mailinglist.id, [date for id, date in mailinglist.deleted_messages])
+
+    # IMailinglistConversationChangeListener
+
+    def mailinglistconversation_created(self, conversation):
+        pass
+
+    def mailinglistconversation_changed(self, conversation):
+        pass
+
+    def mailinglistconversation_deleted(self, conversation):
+        self._invalidate(conversation.mailinglist.id,
+                         [date for id, date in conversation.deleted_messages])
+
+    # IMailinglistMessageChangeListener
+
+    def mailinglistmessage_created(self, message):
+        self._invalidate_message(message)
+
+    def mailinglistmessage_changed(self, message):
+        self._invalidate_message(message)
+        # it may also have moved from another list or day
+        old = message.old_values
+        if old:
+            self._invalidate(old['list'], [old['date']])
+
+    def mailinglistmessage_deleted(self, message):
+        self._invalidate_message(message)
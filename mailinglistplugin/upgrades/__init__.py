@@ -0,0 +1,11 @@
+from trac.db import DatabaseManager
+
+def create_indexes(env, cursor, table):
+    """Create the indices of `table`, a `Table` of the indexed columns of
+    an existing table, as the database connector creates them with a new
+    table, e.g. with the prefix length MySQL needs to index a text
+    column."""
+    db_backend = DatabaseManager(env)._get_connector()[0]
+    # the first statement creates the table itself
+    for stmt in list(db_backend.to_sql(table))[1:]:
+        cursor.execute(stmt)
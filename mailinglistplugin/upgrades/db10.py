@@ -0,0 +1,13 @@
+from trac.db import Table, Column, Index
+
+from mailinglistplugin.upgrades import create_indexes
+
+def do_upgrade(env, ver, cursor):
+    """Record where the bytes of each raw message are stored. The
+    messages already stored stay in the database."""
+    cursor.execute("ALTER TABLE mailinglistraw ADD COLUMN storage text")
+    cursor.execute("ALTER TABLE mailinglistraw ADD COLUMN location text")
+    create_indexes(env, cursor, Table('mailinglistraw')[
+        Column('location'),
+        Index(['location']),
+        ])
@@ -0,0 +1,50 @@
+import hashlib
+import os
+import zlib
+
+from trac.db import Table, Column, Index
+
+from mailinglistplugin.upgrades import create_indexes
+
+def do_upgrade(env, ver, cursor):
+    """Add the content hash of raw messages, an index to find the
+    messages using a raw message, and the option of lists to skip
+    messages already archived. Raw messages stored more than once so far
+    are left as they are, as are the hashes of messages kept by a
+    storage other than the database or the files."""
+    cursor.execute("ALTER TABLE mailinglist ADD COLUMN skip_duplicates integer")
+    cursor.execute("UPDATE mailinglist SET skip_duplicates = 0")
+    cursor.execute("ALTER TABLE mailinglistraw ADD COLUMN hash text")
+    create_indexes(env, cursor, Table('mailinglistraw')[
+        Column('hash'),
+        Index(['hash']),
+        ])
+    create_indexes(env, cursor, Table('mailinglistmessages')[
+        Column('raw', type='int'),
+        Index(['raw']),
+        ])
+    # read as stored at this version, not through the storages enabled now
+    directory = os.path.join(env.path, env.config.get('mailinglist', 'raw_storage_dir',
+                                                      'files/mailinglist'))
+    last = 0
+    while True:
+        cursor.execute("SELECT id, data, encoding, storage, location FROM mailinglistraw "
+                       "WHERE id > %s ORDER BY id LIMIT 100", (last,))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        for id, data, encoding, storage, location in rows:
+            last = id
+            if data is None and location:
+                if storage != 'FileRawStorage':
+                    continue
+                f = open(os.path.join(directory, location[:2], location[2:4], location), 'rb')
+                try:
+                    data = f.read()
+                finally:
+                    f.close()
+            data = str(data or '')
+            if encoding == 'zlib':
+                data = zlib.decompress(data)
+            cursor.execute("UPDATE mailinglistraw SET hash = %s WHERE id = %s",
+                           (hashlib.sha1(data).hexdigest(), id))
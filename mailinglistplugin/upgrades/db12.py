@@ -0,0 +1,13 @@
+from trac.db import Table, Column
+from trac.db import DatabaseManager
+
+def do_upgrade(env, ver, cursor):
+    """Add the generations of the timeline buckets of past days."""
+    table = Table('mailinglisttimeline', key=('list', 'day'))[
+        Column('list', type='int'),
+        Column('day', type='int'),
+        Column('generation', type='int'),
+        ]
+    db_backend = DatabaseManager(env)._get_connector()[0]
+    for stmt in db_backend.to_sql(table):
+        cursor.execute(stmt)
@@ -0,0 +1,31 @@
+def do_upgrade(env, ver, cursor):
+    """Add the stored message counts and last activity columns, and
+    fill them from the existing messages."""
+    for table, columns in (('mailinglist', [('conversation_count', 'integer'),
+                                            ('message_count', 'integer'),
+                                            ('last_date', 'bigint'),
+                                            ('last_poster', 'text')]),
+                           ('mailinglistconversations', [('message_count', 'integer'),
+                                                         ('last_date', 'bigint'),
+                                                         ('last_poster', 'text')])):
+        for column, type in columns:
+            cursor.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, type))
+    # as of this version, not as the model computes them today
+    last = ("(SELECT %s FROM mailinglistmessages m WHERE m.%s = %s.id "
+            "ORDER BY m.date DESC, m.id DESC LIMIT 1)")
+    cursor.execute("""
+        UPDATE mailinglistconversations SET
+        message_count = (SELECT count(m.id) FROM mailinglistmessages m
+                         WHERE m.conversation = mailinglistconversations.id),
+        last_date = %s,
+        last_poster = %s""" % (last % ('m.date', 'conversation', 'mailinglistconversations'),
+                               last % ('m.from_name', 'conversation', 'mailinglistconversations')))
+    cursor.execute("""
+        UPDATE mailinglist SET
+        conversation_count = (SELECT count(c.id) FROM mailinglistconversations c
+                              WHERE c.list = mailinglist.id),
+        message_count = (SELECT count(m.id) FROM mailinglistmessages m
+                         WHERE m.list = mailinglist.id),
+        last_date = %s,
+        last_poster = %s""" % (last % ('m.date', 'list', 'mailinglist'),
+                               last % ('m.from_name', 'list', 'mailinglist')))
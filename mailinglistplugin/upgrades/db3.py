@@ -0,0 +1,21 @@
+from trac.db import Table, Column, Index
+
+from mailinglistplugin.upgrades import create_indexes
+
+def do_upgrade(env, ver, cursor):
+    """Add composite indexes for threading lookups, the timeline and the
+    date ordered listings."""
+    create_indexes(env, cursor, Table('mailinglistmessages')[
+        Column('list', type='int'),
+        Column('conversation', type='int'),
+        Column('msg_id'),
+        Column('date', type='int64'),
+        Index(['list', 'msg_id']),
+        Index(['list', 'date']),
+        Index(['conversation', 'date']),
+        ])
+    create_indexes(env, cursor, Table('mailinglistconversations')[
+        Column('list', type='int'),
+        Column('date', type='int64'),
+        Index(['list', 'date']),
+        ])
@@ -0,0 +1,18 @@
+from trac.db import Table, Column, Index
+
+from mailinglistplugin.upgrades import create_indexes
+from mailinglistplugin.utils import normalize_subject
+
+def do_upgrade(env, ver, cursor):
+    """Add the normalized subject used to thread Outlook replies, and
+    fill it for the existing conversations."""
+    cursor.execute("ALTER TABLE mailinglistconversations ADD COLUMN normalized_subject text")
+    create_indexes(env, cursor, Table('mailinglistconversations')[
+        Column('list', type='int'),
+        Column('normalized_subject'),
+        Index(['list', 'normalized_subject']),
+        ])
+    cursor.execute("SELECT id, subject FROM mailinglistconversations")
+    rows = [(normalize_subject(subject), id) for id, subject in cursor.fetchall()]
+    cursor.executemany("UPDATE mailinglistconversations SET normalized_subject = %s "
+                       "WHERE id = %s", rows)
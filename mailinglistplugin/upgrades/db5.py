@@ -0,0 +1,28 @@
+from email.Parser import HeaderParser
+
+from trac.db import Table, Column, Index
+
+from mailinglistplugin.upgrades import create_indexes
+from mailinglistplugin.utils import decode_thread_index
+
+def do_upgrade(env, ver, cursor):
+    """Add the Thread-Index conversation GUID of conversations, taken
+    from the stored first message of each existing conversation."""
+    cursor.execute("ALTER TABLE mailinglistconversations ADD COLUMN thread_guid text")
+    create_indexes(env, cursor, Table('mailinglistconversations')[
+        Column('list', type='int'),
+        Column('thread_guid'),
+        Index(['list', 'thread_guid']),
+        ])
+    cursor.execute("SELECT c.id, m.raw FROM mailinglistconversations AS c "
+                   "JOIN mailinglistmessages AS m ON m.id = c.first")
+    parser = HeaderParser()
+    for id, raw in cursor.fetchall():
+        cursor.execute("SELECT raw FROM mailinglistraw WHERE id = %s", (raw,))
+        row = cursor.fetchone()
+        if not row or not row[0]:
+            continue
+        thread_guid = decode_thread_index(parser.parsestr(row[0])['thread-index'])
+        if thread_guid:
+            cursor.execute("UPDATE mailinglistconversations SET thread_guid = %s "
+                           "WHERE id = %s", (thread_guid, id))
@@ -0,0 +1,18 @@
+from trac.db import Table, Column, Index
+from trac.db import DatabaseManager
+
+from mailinglistplugin.directory import sync_members
+
+def do_upgrade(env, ver, cursor):
+    """Add the materialized effective membership of the lists."""
+    table = Table('mailinglistmembers', key=('list', 'username'))[
+        Column('list', type='int'),
+        Column('username'),
+        Column('poster', type='int'),
+        Column('declined', type='int'),
+        Index(['username']),
+        ]
+    db_backend = DatabaseManager(env)._get_connector()[0]
+    for stmt in db_backend.to_sql(table):
+        cursor.execute(stmt)
+    sync_members(env, cursor)
@@ -0,0 +1,16 @@
+from mailinglistplugin.utils import make_snippet
+
+def do_upgrade(env, ver, cursor):
+    """Add the stored snippet of messages, shown by the timeline, and
+    fill it in for the existing messages a batch at a time."""
+    cursor.execute("ALTER TABLE mailinglistmessages ADD COLUMN snippet text")
+    last = 0
+    while True:
+        cursor.execute("SELECT id, body FROM mailinglistmessages WHERE id > %s "
+                       "ORDER BY id LIMIT 500", (last,))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        cursor.executemany("UPDATE mailinglistmessages SET snippet = %s WHERE id = %s",
+                           [(make_snippet(body), id) for id, body in rows])
+        last = rows[-1][0]
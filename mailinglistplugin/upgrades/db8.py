@@ -0,0 +1,14 @@
+def do_upgrade(env, ver, cursor):
+    """Add the stored number of attachments of messages, counted from
+    the attachment table."""
+    cursor.execute("ALTER TABLE mailinglistmessages ADD COLUMN attachment_count integer")
+    cursor.execute("UPDATE mailinglistmessages SET attachment_count = 0")
+    cursor.execute("SELECT id, count(*) FROM attachment WHERE type = 'mailinglist' "
+                   "GROUP BY id")
+    counts = []
+    for id, count in cursor.fetchall():
+        parts = id.split('/')
+        if len(parts) == 3 and parts[2].isdigit():
+            counts.append((count, int(parts[2])))
+    cursor.executemany("UPDATE mailinglistmessages SET attachment_count = %s WHERE id = %s",
+                       counts)
@@ -0,0 +1,24 @@
+from mailinglistplugin.api import MailinglistSystem, binary_type
+from mailinglistplugin.utils import pack_raw
+
+def do_upgrade(env, ver, cursor):
+    """Move raw messages from the text column to a binary one, compressed
+    as configured, a batch at a time. The text of each moved message is
+    cleared, as the column can not be dropped on every database."""
+    cursor.execute("ALTER TABLE mailinglistraw ADD COLUMN data %s" % binary_type(env))
+    cursor.execute("ALTER TABLE mailinglistraw ADD COLUMN encoding text")
+    cursor.execute("ALTER TABLE mailinglistraw ADD COLUMN size integer")
+    encoding = MailinglistSystem(env).raw_compression
+    last = 0
+    while True:
+        cursor.execute("SELECT id, raw FROM mailinglistraw WHERE id > %s "
+                       "ORDER BY id LIMIT 100", (last,))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        for id, raw in rows:
+            bytes = (raw or u'').encode('utf-8')
+            cursor.execute("UPDATE mailinglistraw SET data = %s, encoding = %s, size = %s, "
+                           "raw = NULL WHERE id = %s",
+                           (buffer(pack_raw(bytes, encoding)), encoding, len(bytes), id))
+        last = rows[-1][0]
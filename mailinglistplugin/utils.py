@@ -6,19 +6,33 @@ from email.MIMEMultipart import MIMEMultipart
 from email.Utils import formatdate, make_msgid
 
 from datetime import datetime
+import base64
+import hashlib
+import math
 import re
+import struct
+import zlib
 
+from genshi.builder import tag
 from trac.util.datefmt import utc, to_timestamp
+from trac.util.concurrency import threading
+
+# Where mail clients start the original message below a reply
+_original_markers = ('________________________________\n\nFr',
+                     '-----Original Message-----\nFr',
+                     '-----Ursprungligt meddelande-----\nFr',
+                     'Please help Logica to respect the environment by not printing this email')
+
+def _find_original(text):
+    for marker in _original_markers:
+        idx = text.find(marker)
+        if idx != -1:
+            return idx
+    return -1
 
 def wrap_and_quote(text, width):
     text = re.sub('(\n *){3,}', '\n\n', text)
-    idx = text.find('________________________________\n\nFr')
-    if idx == -1:
-        idx = text.find('-----Original Message-----\nFr')
-    if idx == -1:
-        idx = text.find('-----Ursprungligt meddelande-----\nFr')
-    if idx == -1:
-        idx = text.find('Please help Logica to respect the environment by not printing this email')
+    idx = _find_original(text)
         
     if idx > 20:
         return wrap(text[:idx], width), wrap(text[idx:], width)
@@ -82,3 +96,254 @@ def parse_rfc2822_date(text):
     """
     t = email.Utils.mktime_tz(email.Utils.parsedate_tz(text))
     return datetime.fromtimestamp(t, utc)
+
+# Reply and forward prefixes in English, Scandinavian, German and Dutch
+# mail clients, optionally counted ("Re[2]:"), and [list] tags.
+_subject_prefix = re.compile(r'^\s*(?:(?:re|sv|vs|aw|antw|fw|fwd|vb|wg|tr)\s*(?:\[\d+\])?\s*:|\[[^\]]*\])',
+                             re.IGNORECASE | re.UNICODE)
+_whitespace = re.compile(r'\s+', re.UNICODE)
+
+def normalize_subject(subject):
+    """
+    Reduce a subject to the form used to match replies to their
+    conversation: reply/forward prefixes and list tags are stripped,
+    whitespace removed and the result lower cased.
+    """
+    if not subject:
+        return u''
+    stripped = None
+    while stripped != subject:
+        stripped = subject
+        subject = _subject_prefix.sub(u'', subject, 1)
+    return _whitespace.sub(u'', subject).lower()
+
+# "On ... wrote:" and its translations, introducing a quote
+_attribution = re.compile(r'(?:wrote|skrev|schrieb|schreef)\s*:\s*$', re.IGNORECASE | re.UNICODE)
+
+def make_snippet(body, length=200):
+    """
+    Shorten a message body for listings like the timeline: the quoted
+    original, quoted lines with their attribution line and the signature
+    are left out, whitespace is collapsed and the result cut at `length`.
+    """
+    if not body:
+        return u''
+    text = body
+    idx = _find_original(text)
+    if idx > 0:
+        text = text[:idx]
+    idx = text.find('\n-- \n')
+    if idx > 0:
+        text = text[:idx]
+    lines = []
+    for line in text.splitlines():
+        if line.lstrip().startswith('>'):
+            if lines and _attribution.search(lines[-1]):
+                lines.pop()
+            continue
+        lines.append(line)
+    snippet = _whitespace.sub(u' ', u' '.join(lines)).strip()
+    if not snippet:
+        # nothing but quotes
+        snippet = _whitespace.sub(u' ', body).strip()
+    return snippet[:length]
+
+def decode_thread_index(value):
+    """
+    Return the conversation GUID of a Microsoft "Thread-Index" header as
+    a hex string, or `None` if the header is missing or malformed.
+
+    The decoded header is a 22 byte header block (a reserved byte and
+    the 5 most significant bytes of a FILETIME, followed by the 16 byte
+    GUID) and a 5 byte child block for every reply, so all messages of a
+    conversation share the GUID.
+    """
+    if not value:
+        return None
+    try:
+        data = base64.b64decode(''.join(str(value).split()))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+    if len(data) < 22 or (len(data) - 22) % 5:
+        return None
+    return data[6:22].encode('hex')
+
+def search_terms(query):
+    """
+    Split a search query into terms at whitespace, keeping quoted
+    phrases together, the way the Trac search does.
+    """
+    terms = []
+    for term in re.split('(".*?")|(\'.*?\')|(\s+)', query):
+        if term is not None and term.strip():
+            if term[0] == term[-1] and term[0] in "'\"":
+                term = term[1:-1]
+            terms.append(term)
+    return terms
+
+def highlight_excerpt(excerpt):
+    """
+    Turn an excerpt from the search index, where matches are enclosed in
+    "\\x02" and "\\x03", into markup emphasising the matches.
+    """
+    if not excerpt:
+        return tag()
+    parts = excerpt.split(u'\x02')
+    fragment = tag(parts[0].replace(u'\x03', u''))
+    for part in parts[1:]:
+        match = part.split(u'\x03', 1)
+        fragment.append(tag.em(match[0], class_='match'))
+        fragment.append(match[1:] and match[1] or u'')
+    return fragment
+
+def encode_page_token(timestamp, id):
+    """
+    Encode the `(timestamp, id)` key of a listing row as an opaque,
+    URL safe page token.
+    """
+    return base64.urlsafe_b64encode('%d:%d' % (timestamp, id)).rstrip('=')
+
+def decode_page_token(token):
+    """
+    Decode a token made by `encode_page_token` back into its
+    `(timestamp, id)` key. Raises `ValueError` for malformed tokens.
+    """
+    try:
+        token = str(token)
+        token += '=' * (-len(token) % 4)
+        timestamp, id = base64.urlsafe_b64decode(token).split(':')
+        return int(timestamp), int(id)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid page token %r" % (token,))
+
+def pack_raw(bytes, encoding):
+    """
+    Encode a raw message for storage as `encoding` says: 'zlib'
+    compresses it, 'none' keeps it as it is.
+    """
+    if encoding == 'zlib':
+        return zlib.compress(bytes)
+    return bytes
+
+def unpack_raw(data, encoding):
+    """
+    Return the raw message stored in `data` as `encoding`.
+    """
+    if encoding == 'zlib':
+        return zlib.decompress(data)
+    return str(data)
+
+class BloomFilter(object):
+    """
+    Set of strings in a fixed amount of memory, sized for `capacity`
+    members with an `error_rate` chance of wrongly containing a string
+    that was not added. A string that was added is always contained.
+    Not thread safe.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.bits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(float(self.bits) / capacity * math.log(2))), 1)
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        # two independent hashes from one digest, combined as h1 + i * h2
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        for i in xrange(self.hashes):
+            yield (h1 + i * h2) % self.bits
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self._array[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+class LRUCache(object):
+    """
+    Thread safe mapping holding at most `size` entries. When full, the
+    least recently used entry is dropped. With a `size` of 0 or less
+    nothing is kept.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            # circular doubly linked list of [prev, next, key, value]
+            # links, most recently used first
+            self._root = root = []
+            root[:] = [root, root, None, None]
+            self._links = {}
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._links.get(key)
+            if link is None:
+                return default
+            self._unlink(link)
+            self._link_first(link)
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def __setitem__(self, key, value):
+        if self.size <= 0:
+            return
+        self._lock.acquire()
+        try:
+            link = self._links.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[3] = value
+            else:
+                if len(self._links) >= self.size:
+                    oldest = self._root[0]
+                    self._unlink(oldest)
+                    del self._links[oldest[2]]
+                link = self._links[key] = [None, None, key, value]
+            self._link_first(link)
+        finally:
+            self._lock.release()
+
+    def pop(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._links.pop(key, None)
+            if link is None:
+                return default
+            self._unlink(link)
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _link_first(self, link):
+        root = self._root
+        first = root[1]
+        link[0], link[1] = root, first
+        first[0] = root[1] = link
+
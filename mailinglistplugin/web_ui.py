@@ -3,28 +3,38 @@ from trac.core import *
 from trac.perm import IPermissionRequestor
 from trac.resource import Resource, IResourceManager, get_resource_url, ResourceNotFound
 from trac.config import BoolOption, IntOption, ListOption
-from trac.web.chrome import INavigationContributor, ITemplateProvider, \
+from trac.web.chrome import INavigationContributor, ITemplateProvider, Chrome, \
                             add_stylesheet, add_javascript, add_link, \
                             add_ctxtnav, prevnext_nav, add_notice
+from trac.web.api import RequestDone
 from trac.web.main import IRequestHandler
 from trac.timeline.api import ITimelineEventProvider
 from trac.util.translation import _
-from trac.attachment import Attachment, AttachmentModule
-from trac.util.compat import any, partial
+from trac.attachment import AttachmentModule
+from trac.util.compat import any
 from trac.wiki.api import IWikiSyntaxProvider
-from trac.util.datefmt import format_datetime, utc, to_timestamp
-from trac.search import ISearchSource, search_to_sql, shorten_result
-from trac.util.presentation import Paginator
+from trac.util.datefmt import format_datetime, utc, to_timestamp, http_date
+from trac.search import ISearchSource
+from trac.util.presentation import to_json
 
 from datetime import datetime
 import re
 from genshi.builder import tag
 
 from mailinglistplugin.api import MailinglistSystem
-from mailinglistplugin.model import Mailinglist, MailinglistConversation, MailinglistMessage
+from mailinglistplugin.model import Mailinglist, MailinglistConversation, MailinglistMessage, \
+     MailinglistRawMessage, select_attachments, select_first_snippets
+from mailinglistplugin.perm import MailinglistPermissionPolicy
+from mailinglistplugin.search import MailinglistSearchIndex
+from mailinglistplugin.timeline import MailinglistTimelineCache
+from mailinglistplugin.utils import encode_page_token, decode_page_token, \
+     search_terms, highlight_excerpt, parse_rfc2822_date
 
 import pkg_resources
 
+# A single range of the Range header; several ranges get the whole message
+_byte_range = re.compile(r'^bytes=(\d*)-(\d*)$')
+
 class MailinglistModule(Component):
     implements(IRequestHandler, ITemplateProvider, INavigationContributor,
                IWikiSyntaxProvider, ISearchSource, ITimelineEventProvider)
@@ -89,36 +99,29 @@ class MailinglistModule(Component):
         mailinglist_realm = Resource('mailinglist')
 
         lists = {}
-        for mailinglist in Mailinglist.select(self.env):
-            if "MAILINGLIST_VIEW" in req.perm(mailinglist.resource):         
-                lists[mailinglist.id] = mailinglist
+        for mailinglist in MailinglistPermissionPolicy(self.env).visible_lists(req.perm):
+            lists[mailinglist.id] = mailinglist
+                
+        viewable = MailinglistPermissionPolicy(self.env).viewable_lists(req.perm, lists.values())
+        if viewable is not None:
+            lists = dict([(id, m) for id, m in lists.items() if id in viewable])
                 
         if not lists:
             self.log.debug("This user can't view any lists, so not searching.")
             return
         
-        db = self.env.get_read_db()
-        sql, args = search_to_sql(db, ['subject','body','from_email','from_name'], terms)
-
-        cursor = db.cursor()
-        query = """
-            SELECT id, subject, body, from_name, from_email, date, list, conversation
-            FROM mailinglistmessages
-            WHERE list IN (%s) AND %s
-            """ % (",".join(map(str,lists.keys())), sql,)
-        self.log.debug("Search query: %s", query)
-        cursor.execute(query, args)
-        for mid, subject, body, from_name, from_email, date, mlist, conversation in cursor:
+        results = MailinglistSearchIndex(self.env).search(terms, lists.keys())[0]
+        for mid, subject, from_name, from_email, date, mlist, conversation, excerpt in results:
             # build resource ourself to speed things up
             m = mailinglist_realm(id="%s/%d/%d" % (lists[mlist].emailaddress,
                                                    conversation,
                                                    mid))
-            if 'MAILINGLIST_VIEW' in req.perm(m):
+            if viewable is not None or 'MAILINGLIST_VIEW' in req.perm(m):
                 yield (req.href.mailinglist(m.id),
                        tag("%s: %s" % (lists[mlist].name, subject)),
                        datetime.fromtimestamp(date, utc),
                        "%s <%s>" % (from_name, from_email),
-                       shorten_result(body, terms))
+                       highlight_excerpt(excerpt))
         
         # Attachments
         for result in AttachmentModule(self.env).get_search_results(
@@ -126,6 +129,62 @@ class MailinglistModule(Component):
             yield result        
         
 
+    def _search(self, req, data):
+        """Ranked search of the lists in `data['mailinglists']`, narrowed
+        down by the list, sender and year facets."""
+        query = req.args.get('q', '').strip()
+        lists = dict([(m.id, m) for m in data['mailinglists']])
+        viewable = MailinglistPermissionPolicy(self.env).viewable_lists(req.perm, lists.values())
+        if viewable is not None:
+            lists = dict([(id, m) for id, m in lists.items() if id in viewable])
+        by_address = dict([(m.emailaddress, m) for m in lists.values()])
+        selected = by_address.get(req.args.get('list'))
+        sender = req.args.get('sender') or None
+        try:
+            year = int(req.args.get('year') or 0) or None
+            offset = max(int(req.args.get('offset') or 0), 0)
+        except ValueError:
+            raise TracError(_('Invalid search arguments'))
+        terms = search_terms(query)
+
+        results, total, facets = [], 0, None
+        if terms:
+            rows, total, facets = MailinglistSearchIndex(self.env).search(
+                terms, lists.keys(), list_id=selected and selected.id, sender=sender,
+                year=year, offset=offset, limit=self.limit, facets=True)
+            for mid, subject, from_name, from_email, date, mlist, conversation, excerpt in rows:
+                if viewable is None and 'MAILINGLIST_VIEW' not in \
+                       req.perm('mailinglist', "%s/%d/%d" % (lists[mlist].emailaddress,
+                                                             conversation, mid)):
+                    continue
+                results.append({'href': req.href.mailinglist(lists[mlist].emailaddress,
+                                                             conversation, mid),
+                                'subject': subject,
+                                'mailinglist': lists[mlist],
+                                'author': from_name or from_email,
+                                'date': datetime.fromtimestamp(date, utc),
+                                'excerpt': highlight_excerpt(excerpt)})
+            facets['list'] = [(lists[id], count) for id, count in facets['list']]
+
+        args = {'q': query, 'list': selected and selected.emailaddress,
+                'sender': sender, 'year': year}
+        def search_href(**changes):
+            kwargs = dict(args)
+            kwargs.update(changes)
+            return req.href.mailinglist(**dict([(k, v) for k, v in kwargs.items() if v]))
+        if offset + self.limit < total:
+            add_link(req, 'next', search_href(offset=offset + self.limit), _('Next Page'))
+        if offset > 0:
+            add_link(req, 'prev', search_href(offset=max(offset - self.limit, 0)),
+                     _('Previous Page'))
+        prevnext_nav(req, _('Previous Page'), _('Next Page'))
+        add_link(req, 'up', req.href.mailinglist(), _("List of mailinglists"))
+
+        data.update({'query': query, 'results': results, 'total': total,
+                     'offset': offset, 'facets': facets, 'search_href': search_href,
+                     'selected': dict(args, list=selected)})
+        return 'mailinglist_search.html', data, None
+
     # IRequestHandler methods
     def match_request(self, req):
         if req.path_info.startswith("/mailinglist"):
@@ -140,30 +199,67 @@ class MailinglistModule(Component):
                 req.args['messageid'] = match.group(1)
             return True
 
-    def process_request(self, req):
-        offset = req.args.get("offset",0)
-        page = req.args.get('page', 1)
+    def _page_key(self, req, name):
+        token = req.args.get(name)
+        if not token:
+            return None
         try:
-            offset = int(offset)
-        except:
-            raise TracError(_('Invalid offset used: %(offset)s', offset=offset))        
-        
-        try:
-            page = int(page)
-        except:
-            raise TracError(_('Invalid page used: %(page)s', page=page))
-                
-        offset = (page - 1) * self.limit
-        
+            return decode_page_token(token)
+        except ValueError:
+            raise TracError(_('Invalid page used: %(page)s', page=token))
+
+    def _keyset_page(self, req, select):
+        """Fetch the page of `select` asked for by the `after` or `before`
+        token of the request. One extra row is read to learn whether the
+        listing goes on; returns `(items, has_previous, has_next)`."""
+        before = self._page_key(req, 'before')
+        if before is not None:
+            items = list(select(limit=self.limit + 1, before=before))
+            if len(items) > self.limit:
+                return items[1:], True, True
+            # ran into the start of the listing, so show the first page
+            after = None
+        else:
+            after = self._page_key(req, 'after')
+        items = list(select(limit=self.limit + 1, after=after))
+        has_next = len(items) > self.limit
+        return items[:self.limit], after is not None, has_next
+
+    def _add_page_links(self, req, resource, items, has_previous, has_next,
+                        previous_label, next_label):
+        if not items:
+            return
+        if has_next:
+            add_link(req, 'next', self._page_href(req, resource, after=items[-1]), next_label)
+        if has_previous:
+            add_link(req, 'prev', self._page_href(req, resource, before=items[0]),
+                     previous_label)
+
+    def _page_href(self, req, resource, **kwargs):
+        """Link to the page of `resource` starting `after` or ending
+        `before` the given item."""
+        for name, item in kwargs.items():
+            kwargs[name] = encode_page_token(to_timestamp(item.date), item.id)
+        return get_resource_url(self.env, resource, req.href, **kwargs)
+
+    def _send_fragment(self, req, template, data):
+        """Send the rendered `template` with the link to the items that
+        follow as JSON, for mailinglist.js to append to the page."""
+        # Rendering takes the notices and warnings kept in the session
+        # after a redirect; they are left for the next full page.
+        pending = [(name, value) for name, value in req.session.items()
+                   if name.startswith('chrome.notices.') or name.startswith('chrome.warnings.')]
+        html = Chrome(self.env).render_template(req, template, data, fragment=True)
+        for name, value in pending:
+            req.session[name] = value
+        req.send(to_json({'html': html.render('html', encoding=None),
+                          'next': data['next_href']}), 'application/json')
+
+    def process_request(self, req):
         add_stylesheet(req, 'mailinglist/css/mailinglist.css')
         add_javascript(req, 'mailinglist/mailinglist.js')
             
-        mailinglists = [m for m in Mailinglist.select(self.env)
-                        if "MAILINGLIST_VIEW" in req.perm(m.resource)]
-
-        data = {"mailinglists": mailinglists,
-                "offset": offset,
-                "limit": self.limit}
+        data = {"limit": self.limit}
 
         if req.method == 'POST':
 
@@ -213,6 +309,11 @@ class MailinglistModule(Component):
                 # individual mailing list homepage
                 req.redirect(req.href.mailinglist(mailinglist_email))
 
+        # answered before the models of the page are built
+        validators = self._validators(req)
+        if validators:
+            self._check_modified(req, *validators)
+
         #for mailinglist in mailinglists:
         #    add_ctxtnav(req,
         #                _("List: %s") % mailinglist.name,
@@ -224,14 +325,7 @@ class MailinglistModule(Component):
             # that's a problem...
             req.perm(message.resource).require("MAILINGLIST_VIEW")
             if req.args.get('format') == "raw":
-                req.send_header('Content-Disposition', 'attachment')
-                req.send_response(200)
-                content = message.raw.bytes
-                req.send_header('Content-Type', 'application/mbox')
-                req.send_header('Content-Length', len(content))
-                req.end_headers()
-                if req.method != 'HEAD':
-                    req.write(content)
+                self._send_raw(req, message)
                 return
 
             context = Context.from_request(req, message.resource)
@@ -239,8 +333,7 @@ class MailinglistModule(Component):
             data['message'] = message
             data['attachments'] = AttachmentModule(self.env).attachment_data(context)
 
-            add_link(req, 'up', get_resource_url(self.env, message.conversation.resource, req.href,
-                                                 offset=data['offset']),
+            add_link(req, 'up', get_resource_url(self.env, message.conversation.resource, req.href),
                      _("Back to conversation"))
 
             prevnext_nav(req, _("Newer message"), _("Older message"), 
@@ -262,31 +355,19 @@ class MailinglistModule(Component):
             # also leaks the subject of the first email in the error message
             req.perm(conversation.resource).require("MAILINGLIST_VIEW")
             data['conversation'] = conversation
-            data['attachmentselect'] = partial(Attachment.select, self.env)
-            
-            results = Paginator(conversation.messages(), page - 1, self.limit)
-            if results.has_next_page:
-                next_href = get_resource_url(self.env, conversation.resource, req.href, page=page + 1) 
-                add_link(req, 'next', next_href, _('Next Page'))
-
-            if results.has_previous_page:
-                prev_href = get_resource_url(self.env, conversation.resource, req.href, page=page - 1) 
-                add_link(req, 'prev', prev_href, _('Previous Page'))
             
-            shown_pages = results.get_shown_pages()
-            pagedata = [{'href': get_resource_url(self.env,
-                                                  conversation.resource,
-                                                  req.href, page=page),
-                         'class': None, 'string': str(page),
-                         'title': _('Page %(num)d', num=page)}
-                        for page in shown_pages]
-            results.shown_pages = pagedata
-            results.current_page = {'href': None, 'class': 'current',
-                                    'string': str(results.page + 1),
-                                    'title': None}
-            data['paginator'] = results
-            add_link(req, 'up', get_resource_url(self.env, conversation.mailinglist.resource, req.href,
-                                                 offset=data['offset']),
+            messages, has_previous, has_next = self._keyset_page(req, conversation.messages)
+            data['messages'] = messages
+            data['attachments'] = select_attachments(self.env, messages)
+            data['next_href'] = has_next and \
+                self._page_href(req, conversation.resource, after=messages[-1]) or None
+            if req.args.get('format') == 'json':
+                # later messages, loaded as the conversation is scrolled
+                self._send_fragment(req, 'mailinglist_conversation_messages.html', data)
+            self._add_page_links(req, conversation.resource, messages,
+                                 has_previous, has_next,
+                                 _('Previous Page'), _('Next Page'))
+            add_link(req, 'up', get_resource_url(self.env, conversation.mailinglist.resource, req.href),
                      _("List of conversations"))
 
             prevnext_nav(req, _("Newer conversation"), _("Older conversation"), 
@@ -313,7 +394,7 @@ class MailinglistModule(Component):
 
             return 'mailinglist_conversation.html', data, None
 
-        elif 'listname' in req.args:
+        if 'listname' in req.args:
             mailinglist = Mailinglist.select_by_address(self.env,
                                                         req.args['listname'], localpart=True)
             # leaks the name of the mailinglist
@@ -321,42 +402,12 @@ class MailinglistModule(Component):
 
             data['mailinglist'] = mailinglist
 
-            results = Paginator(mailinglist.conversations(),
-                            page - 1,
-                            self.limit)
-
-            if results.has_next_page:
-                next_href = get_resource_url(self.env, mailinglist.resource, req.href, page=page + 1) 
-                add_link(req, 'next', next_href, _('Next Page'))
-
-            if results.has_previous_page:
-                prev_href = get_resource_url(self.env, mailinglist.resource, req.href, page=page - 1) 
-                add_link(req, 'prev', prev_href, _('Previous Page'))
-
-            shown_pages = results.get_shown_pages()
-            pagedata = [{'href': get_resource_url(self.env,
-                                                  mailinglist.resource,
-                                                  req.href, page=page),
-                         'class': None, 'string': str(page),
-                         'title': _('Page %(num)d', num=page)}
-                        for page in shown_pages]
-            results.shown_pages = pagedata
-            results.current_page = {'href': None, 'class': 'current',
-                                    'string': str(results.page + 1),
-                                    'title': None}
-            data['paginator'] = results
-
-            if data['offset'] + data['limit'] < mailinglist.count_conversations():
-                add_link(req, 'next',
-                         get_resource_url(self.env, mailinglist.resource, req.href,
-                                          offset=data['offset']+data['limit']),
-                         _("Older conversations"))
-
-            if offset > 0:
-                add_link(req, 'prev',
-                         get_resource_url(self.env, mailinglist.resource, req.href,
-                                          offset=data['offset']-data['limit']),
-                         _("Newer conversations"))
+            conversations, has_previous, has_next = self._keyset_page(req, mailinglist.conversations)
+            data['conversations'] = conversations
+            data['snippets'] = select_first_snippets(self.env, conversations)
+            self._add_page_links(req, mailinglist.resource, conversations,
+                                 has_previous, has_next,
+                                 _("Newer conversations"), _("Older conversations"))
 
             add_link(req, 'up', req.href.mailinglist(), _("List of mailinglists"))
 
@@ -382,9 +433,171 @@ class MailinglistModule(Component):
 
             return 'mailinglist_conversations.html', data, None
 
+        data['mailinglists'] = mailinglists = \
+            MailinglistPermissionPolicy(self.env).visible_lists(req.perm)
+        if 'q' in req.args:
+            return self._search(req, data)
+
         else:
+            if not validators:
+                # other policies decide which lists are shown
+                self._check_modified(req, *self._index_validators(req, mailinglists))
             return 'mailinglist_list.html', data, None
 
+    def _send_raw(self, req, message):
+        """Send the raw message as it was received, in chunks read one
+        after the other, or the byte range of it the client asks for."""
+        if message._raw is None:
+            raise ResourceNotFound("Raw not set")
+        size = MailinglistRawMessage.size(self.env, message._raw)
+        start, end = 0, size
+        match = _byte_range.match(req.get_header('Range') or '')
+        first, last = match and match.groups() or (None, None)
+        if first and last and int(last) < int(first):
+            # not a valid range, so the header is ignored (RFC 7233)
+            first = last = None
+        # a weak ETag never matches If-Range, only the date can
+        if_range = req.get_header('If-Range')
+        if (first or last) and (not if_range or if_range == http_date(message.date)):
+            if first:
+                start = int(first)
+                end = last and min(int(last) + 1, size) or size
+            elif last:
+                start = max(size - int(last), 0)
+            if start >= end:
+                req.send_response(416)
+                req.send_header('Content-Range', 'bytes */%d' % size)
+                req.send_header('Content-Length', 0)
+                req.end_headers()
+                return
+            req.send_response(206)
+            req.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size))
+        else:
+            req.send_response(200)
+        req.send_header('Content-Disposition', 'attachment')
+        req.send_header('Content-Type', 'application/mbox')
+        req.send_header('Accept-Ranges', 'bytes')
+        req.send_header('Content-Length', end - start)
+        req.end_headers()
+        if req.method != 'HEAD':
+            for chunk in MailinglistRawMessage.chunks(self.env, message._raw, start, end):
+                req.write(chunk)
+
+    # The values of a list its pages show, besides its messages
+    _list_columns = ("l.id, l.email, l.name, l.description, l.private, l.postperm, "
+                     "l.replyto, l.conversation_count, l.message_count")
+
+    def _validators(self, req):
+        """Return the `(last_modified, extra, immutable)` validators of
+        the page asked for by `req`, read in one query before any model
+        is built, once `MAILINGLIST_VIEW` is checked. Returns `None` if
+        the page is not found that way, or for the list index when other
+        permission policies decide which lists are shown."""
+        if req.method not in ('GET', 'HEAD') or 'q' in req.args:
+            return None
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        extra = [req.authname, 'MAILINGLIST_ADMIN' in req.perm]
+        match = re.match(r'/mailinglist/([^/]+)(?:/([0-9]+)(?:/([0-9]+))?)?$', req.path_info)
+        if not match:
+            if not MailinglistPermissionPolicy(self.env).list_level():
+                return None
+            # every list, with the members shown and deciding which ones
+            # the user sees
+            cursor.execute("SELECT l.last_date, %s, mm.username FROM mailinglist AS l "
+                           "LEFT JOIN mailinglistmembers AS mm "
+                           "ON mm.list = l.id AND mm.declined = 0 "
+                           "ORDER BY l.id, mm.username" % self._list_columns)
+            lists = {}
+            last_modified = None
+            for row in cursor:
+                last_modified = max(last_modified, row[0])
+                lists.setdefault(row[1:-1], []).append(row[-1])
+            extra += ['MAILINGLIST_VIEW' in req.perm, sorted(lists.items())]
+            return self._from_timestamp(last_modified), extra, False
+
+        emailaddress, conversation_id, message_id = match.groups()
+        emailaddress = emailaddress.lower()
+        subscribed = ("(SELECT count(*) FROM mailinglistmembers AS mm WHERE mm.list = l.id "
+                      "AND mm.username = %s AND mm.declined = 0)")
+        if message_id:
+            cursor.execute("SELECT m.date, l.email, m.conversation, m.id, m.raw, "
+                           "m.subject, m.attachment_count, %s, %s "
+                           "FROM mailinglistmessages AS m JOIN mailinglist AS l ON l.id = m.list "
+                           "WHERE m.id = %%s AND m.conversation = %%s AND l.email = %%s"
+                           % (self._list_columns, subscribed),
+                           (req.authname, int(message_id), int(conversation_id), emailaddress))
+        elif conversation_id:
+            cursor.execute("SELECT c.last_date, l.email, c.id, c.subject, "
+                           "c.message_count, %s, %s "
+                           "FROM mailinglistconversations AS c JOIN mailinglist AS l "
+                           "ON l.id = c.list WHERE c.id = %%s AND l.email = %%s"
+                           % (self._list_columns, subscribed),
+                           (req.authname, int(conversation_id), emailaddress))
+        else:
+            cursor.execute("SELECT l.last_date, l.email, %s, %s FROM mailinglist AS l "
+                           "WHERE l.email = %%s" % (self._list_columns, subscribed),
+                           (req.authname, emailaddress))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        last_modified, emailaddress = self._from_timestamp(row[0]), row[1]
+        if message_id:
+            resource_id = "%s/%s/%s" % (emailaddress, row[2], row[3])
+        elif conversation_id:
+            resource_id = "%s/%s" % (emailaddress, row[2])
+        else:
+            resource_id = emailaddress
+        req.perm(Resource('mailinglist', resource_id)).require("MAILINGLIST_VIEW")
+        if req.args.get('format') == 'raw':
+            return last_modified, [row[3], row[4]], True
+        return last_modified, extra + list(row[2:]), False
+
+    def _index_validators(self, req, mailinglists):
+        """Return the validators of the list index showing `mailinglists`."""
+        last_dates = [m.last_date for m in mailinglists if m.last_date]
+        return (last_dates and max(last_dates) or None,
+                [req.authname, 'MAILINGLIST_ADMIN' in req.perm] +
+                [(m.id, m.emailaddress, m.name, m.description, m.private, m.postperm,
+                  m.replyto, m.count_conversations(), m.count_messages(),
+                  sorted([username for username, details in m.subscribers().iteritems()
+                          if not details['decline']]))
+                 for m in mailinglists],
+                False)
+
+    def _from_timestamp(self, timestamp):
+        return timestamp is not None and datetime.fromtimestamp(timestamp, utc) or None
+
+    def _check_modified(self, req, last_modified, extra, immutable=False):
+        """Answer `304 Not Modified` if the client has the current version
+        of the page, else send the validators along with the page.
+
+        The ETag is made from `last_modified`, the date of the latest
+        message, and the `extra` values the page is built from, as list
+        settings, subscriptions and permissions change pages too. For the
+        same reason If-Modified-Since on its own is only trusted for
+        `immutable` content.
+        """
+        if req.method not in ('GET', 'HEAD'):
+            return
+        if req.session.get('chrome.notices.0') or req.session.get('chrome.warnings.0'):
+            # notices are shown once, so the page will differ next time
+            return
+        last_modified = last_modified or datetime.fromtimestamp(0, utc)
+        req.send_header('Last-Modified', http_date(last_modified))
+        since = req.get_header('If-Modified-Since')
+        if immutable and since and not req.get_header('If-None-Match'):
+            try:
+                since = to_timestamp(parse_rfc2822_date(since))
+            except (TypeError, ValueError, OverflowError):
+                since = None
+            if since is not None and to_timestamp(last_modified) <= since:
+                req.send_response(304)
+                req.send_header('Content-Length', 0)
+                req.end_headers()
+                raise RequestDone
+        req.check_modified(last_modified, extra)
+
     # ITimelineEventProvider methods
 
     def get_timeline_filters(self, req):
@@ -396,9 +609,13 @@ class MailinglistModule(Component):
             mailinglist_realm = Resource('mailinglist')
 
             lists = {}
-            for mailinglist in Mailinglist.select(self.env):
-                if "MAILINGLIST_VIEW" in req.perm(mailinglist.resource):         
-                    lists[mailinglist.id] = mailinglist
+            for mailinglist in MailinglistPermissionPolicy(self.env).visible_lists(req.perm):
+                lists[mailinglist.id] = mailinglist
+
+            viewable = MailinglistPermissionPolicy(self.env).viewable_lists(req.perm,
+                                                                            lists.values())
+            if viewable is not None:
+                lists = dict([(id, m) for id, m in lists.items() if id in viewable])
 
             if not lists:
                 self.log.debug("This user can't view any lists, so not listing timeline events.")
@@ -406,26 +623,21 @@ class MailinglistModule(Component):
 
             self.log.debug("Searching for timeline events in %s", lists)
 
-            db = self.env.get_read_db()
-
-            cursor = db.cursor()
-            cursor.execute("SELECT id, subject, body, from_name, from_email, date, list, conversation "
-                           "FROM mailinglistmessages "
-                           "WHERE date>=%%s AND date<=%%s AND list IN (%s)" % ",".join(map(str,lists.keys())),
-                           (to_timestamp(start), to_timestamp(stop)))
-            # 
-            for mid, subject, body, from_name, from_email, date, mlist, conversation in cursor:
+            events = MailinglistTimelineCache(self.env).events(lists.keys(),
+                                                               to_timestamp(start),
+                                                               to_timestamp(stop))
+            for mid, subject, snippet, from_name, from_email, date, mlist, conversation in events:
                 # build resource ourself to speed things up
                 m = mailinglist_realm(id="%s/%d/%d" % (lists[mlist].emailaddress,
                                                        conversation,
                                                        mid))
-                if 'MAILINGLIST_VIEW' in req.perm(m):
+                if viewable is not None or 'MAILINGLIST_VIEW' in req.perm(m):
                     yield ('mailinglist', 
                            datetime.fromtimestamp(date, utc),
                            "%s" % (from_name,),
                            (mid,
                             subject, 
-                            body.lstrip()[:200],
+                            snippet or '',
                             lists[mlist].name, 
                             lists[mlist].emailaddress, 
                             conversation))
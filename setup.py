@@ -42,7 +42,7 @@ setup(
     license='BSD',
     url='http://define.primeportal.com/',
     description = 'Mailing list archive.',
-    packages = ['mailinglistplugin'],
+    packages = ['mailinglistplugin', 'mailinglistplugin.upgrades'],
     package_data = {'mailinglistplugin': [
         'templates/*.html',
         'htdocs/*.js',
@@ -56,9 +56,15 @@ setup(
             ],
         'trac.plugins': [
             'mailinglistplugin.api = mailinglistplugin.api',
+            'mailinglistplugin.directory = mailinglistplugin.directory',
+            'mailinglistplugin.duplicates = mailinglistplugin.duplicates',
             'mailinglistplugin.admin = mailinglistplugin.admin',            
             'mailinglistplugin.model = mailinglistplugin.model',
             'mailinglistplugin.perm = mailinglistplugin.perm',
+            'mailinglistplugin.search = mailinglistplugin.search',
+            'mailinglistplugin.storage = mailinglistplugin.storage',
+            'mailinglistplugin.threader = mailinglistplugin.threader',
+            'mailinglistplugin.timeline = mailinglistplugin.timeline',
             'mailinglistplugin.web_ui = mailinglistplugin.web_ui',
             'mailinglistplugin.macros = mailinglistplugin.macros',
             ]},